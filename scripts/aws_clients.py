@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+import threading
+import boto3
+from botocore.config import Config
+import run_trace
+import transfer_metrics
+
+###############
+## Constants ##
+###############
+
+# botocore default is 10 sockets per client
+DEFAULT_POOL_SIZE = 10
+
+###############
+## Registry  ##
+###############
+
+# process-wide state, shared by every workflow of the process
+lock      = threading.Lock()
+sessions  = {}
+clients   = {}
+resources = {}
+pool_size = DEFAULT_POOL_SIZE
+
+###############
+## Functions ##
+###############
+
+# grow the connection pool of clients created from now on
+def set_pool_size(size):
+    global pool_size
+    with lock:
+        pool_size = max(pool_size, int(size or 0))
+
+# credentials tuple from the aws config
+def credentials(aws_conf):
+    creds = aws_conf['aws']['credentials']
+    return creds['access_key'], creds['secret_key'], creds['region']
+
+# one boto3 session per set of credentials
+def get_session(ak, sk, rg):
+    with lock:
+        key = (ak, sk, rg)
+        if key not in sessions:
+            sessions[key] = boto3.Session(aws_access_key_id=ak,
+                                          aws_secret_access_key=sk,
+                                          region_name=rg)
+        return sessions[key]
+
+# cached client, rebuilt only when the pool has to grow
+def client(service, ak, sk, rg):
+    session = get_session(ak, sk, rg)
+    with lock:
+        key = (ak, sk, rg, service)
+        cached = clients.get(key)
+        if cached is None or cached[1] < pool_size:
+            with run_trace.span('client_create', service=service, pool=pool_size):
+                clt = session.client(service, config=Config(max_pool_connections=pool_size))
+                transfer_metrics.instrument(clt)
+            clients[key] = (clt, pool_size)
+            print("[+] Boto3 client created (", service, ", pool", pool_size, ")")
+        return clients[key][0]
+
+# cached resource, rebuilt only when the pool has to grow
+def resource(service, ak, sk, rg):
+    session = get_session(ak, sk, rg)
+    with lock:
+        key = (ak, sk, rg, service)
+        cached = resources.get(key)
+        if cached is None or cached[1] < pool_size:
+            with run_trace.span('client_create', service=service, pool=pool_size, resource=True):
+                res = session.resource(service, config=Config(max_pool_connections=pool_size))
+                transfer_metrics.instrument(res.meta.client)
+            resources[key] = (res, pool_size)
+            print("[+] Boto3 resource created (", service, ", pool", pool_size, ")")
+        return resources[key][0]
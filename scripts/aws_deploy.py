@@ -3,6 +3,15 @@ import boto3
 import paramiko
 import time
 import json
+import aws_clients
+import ssh_ready
+import instance_pool
+import remote_exec
+import ssh_session
+import run_trace
+import log_shipper
+import sizing
+import image_cache
 
 # Fetches arguments
 def get_arguments():
@@ -13,6 +22,10 @@ def get_arguments():
     parser.add_option('-n', '--project_name', dest='project_name', help='Specify Project Name')
     parser.add_option('-d', '--database', dest='db', help='Provide Database to use (16s - ITS)')
     parser.add_option('-l', '--link', dest='link', help='Provide Gitlab Link. ( https://gitlab.com/dvilanova/16s_amazon )')
+    parser.add_option('--dry_run', dest='dry_run', action='store_true', default=False, help='Show the sizing decision without launching')
+    parser.add_option('--pool', dest='pool', action='store_true', default=False, help='Reuse stopped instances from the warm pool instead of launching from the AMI')
+    parser.add_option('--refresh_image', dest='refresh_image', action='store_true', default=False, help='Pull the pipeline image tag again instead of the cached digest')
+    parser.add_option('--resume', dest='resume', action='store_true', default=False, help='Restore the Nextflow work dir and cache from S3, run with -resume and save them back')
     
     # get args
     (options, arguments) = parser.parse_args()
@@ -28,87 +41,141 @@ def get_arguments():
     #return objects
     return options
 
-# Creates AWS EC2 resource
+# Gets shared AWS EC2 resource
 def resource_ec2(ak,sk,rg):
-    #declare objects
-    ec2 = boto3.resource('ec2',
-                    rg,
-                    aws_access_key_id=ak,
-                    aws_secret_access_key=sk)
+    #declare objects, reused across workflows
+    ec2 = aws_clients.resource('ec2', ak, sk, rg)
     # return objects
     return ec2
 
-# Creates AWS EC2 client
+# Gets shared AWS EC2 client
 def client_ec2(ak, sk,rg):
-    #declare objects
-    ec2 = boto3.client('ec2',
-                    rg,
-                    aws_access_key_id=ak,
-                    aws_secret_access_key=sk)
+    #declare objects, reused across workflows
+    ec2 = aws_clients.client('ec2', ak, sk, rg)
     # return objects
     return ec2
 
 # Load config
 def load_config():
     try:
-        # Opening JSON file
-        f = open('../configs/aws_conf.json')
-        # Load JSON file
-        aws_conf = json.load(f)
+        with run_trace.span('load_config'):
+            # Opening JSON file
+            f = open('../configs/aws_conf.json')
+            # Load JSON file
+            aws_conf = json.load(f)
     except Exception as e:
         print("[-] AWS-Config file not found, (/configs/aws_conf.json)")
     return aws_conf
 
 # Launches AWS EC2 Instance with AMI ID
-def launch_instance_ami(ec2_resource, ami_id, key_pair_name, sec_group_id,subnet_id, ec2_client, type):
+def launch_instance_ami(ec2_resource, ami_id, key_pair_name, sec_group_id,subnet_id, ec2_client, type, tags=None, watcher=None):
     instance_ids = []
     try:
         # create instance
-        instances = ec2_resource.create_instances(
-            MinCount = 1,
-            MaxCount = 1,
-            ImageId=ami_id,
-            InstanceType=type,
-            KeyName=key_pair_name,
-            SecurityGroupIds=[
-                sec_group_id,
-            ],
-            SubnetId=subnet_id,
-            TagSpecifications=[
-                {
-                    'ResourceType': 'instance',
-                    'Tags': [
-                        {
-                            'Key': 'Name',
-                            'Value': 'ec2-nextflow-instance-run'
-                        },
-                    ]
-                },
-            ]
-        )
+        with run_trace.span('create_instances', ami=ami_id, type=type):
+            instances = ec2_resource.create_instances(
+                MinCount = 1,
+                MaxCount = 1,
+                ImageId=ami_id,
+                InstanceType=type,
+                KeyName=key_pair_name,
+                SecurityGroupIds=[
+                    sec_group_id,
+                ],
+                SubnetId=subnet_id,
+                TagSpecifications=[
+                    {
+                        'ResourceType': 'instance',
+                        'Tags': [
+                            {
+                                'Key': 'Name',
+                                'Value': 'ec2-nextflow-instance-run'
+                            },
+                        ] + (tags or [])
+                    },
+                ]
+            )
         print("[+] Instance Created")
         # fetch instance ID
         for instance in instances:
             print(" - Instance ID: ", instance.id)
             print("[x] Wait until running")
-            instance.wait_until_running()
+            with run_trace.span('wait_until_running', instance=instance.id):
+                if watcher:
+                    watcher.wait_running(instance.id)
+                else:
+                    instance.wait_until_running()
             print("[+] Instance started")
-            response = ec2_client.associate_iam_instance_profile(
-                IamInstanceProfile={
-                    'Arn': 'arn:aws:iam::451861820529:instance-profile/ecsInstanceRole',
-                    'Name': 'ecsInstanceRole'
-                },
-                InstanceId=instance.id
-            )
+            with run_trace.span('associate_iam_instance_profile', instance=instance.id):
+                response = ec2_client.associate_iam_instance_profile(
+                    IamInstanceProfile={
+                        'Arn': 'arn:aws:iam::451861820529:instance-profile/ecsInstanceRole',
+                        'Name': 'ecsInstanceRole'
+                    },
+                    InstanceId=instance.id
+                )
 
     except Exception as e:
         print("[-] Instance can not be created")
         raise e
     return instance.id
 
+# resume from the saved work dir when asked on the command line or in the config
+def resume_enabled(opt, aws_conf):
+    return bool(getattr(opt, 'resume', False) or aws_conf['aws'].get('pipeline', {}).get('resume', False))
+
+# local dirs and s3 prefix keeping the nextflow state of a project (or shard)
+def state_paths(pName, db, shard=None):
+    name   = str(pName) if shard is None else str(pName)+'_shard'+str(shard['index'])
+    prefix = 's3://triggersnextflow/'+str(db)+'/'+str(pName)+'/nextflow/'
+    if shard is not None:
+        prefix += 'shard'+str(shard['index'])+'/'
+    return {
+        'workdir': '/nextflow_workdir/'+name if shard is None else shard['workdir'],
+        'launch':  '/nextflow_launch/'+name,
+        'prefix':  prefix,
+    }
+
+# commands restoring and saving the work dir and .nextflow cache, files in the work dir belong to root
+def state_commands(pName, db, shard=None):
+    paths = state_paths(pName, db, shard)
+    sync  = 'sudo aws s3 sync --only-show-errors '
+    restore = ('sudo mkdir -p '+paths['workdir']+' '+paths['launch']+' && '
+               +sync+paths['prefix']+'work/ '+paths['workdir']+' && '
+               +sync+paths['prefix']+'launch/ '+paths['launch'])
+    # staged inputs are symlinks to S3 copies, they are not saved
+    save = (sync+'--delete --no-follow-symlinks '+paths['workdir']+' '+paths['prefix']+'work/ && '
+            +sync+'--delete '+paths['launch']+' '+paths['prefix']+'launch/')
+    return restore, save
+
+# Builds the docker/nextflow command for a project
+# shard is a sharding.shard_prefixes() dict when running one subset of the samples
+# with resume nextflow starts in a kept launch dir, where its .nextflow cache lives
+# image is the (reference, pull policy) pair from image_cache.image_for_run
+def pipe_command(pName, link, db, memory='70g', cpus=None, shard=None, resume=False, image=None):
+    ref, pull = image or (image_cache.DEFAULT_IMAGE, 'always')
+    limits = ' --memory '+str(memory)
+    params = ''
+    if cpus:
+        limits += ' --cpus '+str(cpus)
+        params += ' --max_cpus '+str(cpus)+' --max_memory "'+str(memory).rstrip('g')+'.GB"'
+    inputs  = 's3://triggersnextflow/'+str(db)+'/'+ str(pName) +'/backups/sample/'
+    results = 's3://triggersnextflow/16s/'+ str(pName) +'/results/'
+    workdir = '/nextflow_workdir/'+str(pName)
+    if shard:
+        inputs  = 's3://triggersnextflow/'+shard['input']
+        results = 's3://triggersnextflow/'+shard['results']
+        workdir = shard['workdir']
+    if resume:
+        launch  = state_paths(pName, db, shard)['launch']
+        limits += ' -v '+launch+':'+launch+' -w '+launch
+        # restored files get new timestamps, lenient caching only hashes path and size
+        params += ' -resume -process.cache=lenient'
+    return 'docker run --pull='+pull+limits+' -v /var/run/docker.sock:/var/run/docker.sock -v '+workdir+':'+workdir+' '+ref+' '+str(link)+' -profile batch -r main --input_path "'+inputs+'*.fastq.gz" --pairs_path "'+inputs+'*_{R1,R2}.fastq.gz" --outdir_multiqc "'+results+'" --outdir_finalres "'+results+'" -w "'+workdir+'"'+params
+
 # Connect to AWS EC2 Instance
 # function to execute pipeline using EC2 instance
-def execute_pipe(ec2,ssh_key_file, pName, link , db, instance_id):
+def execute_pipe(ec2,ssh_key_file, pName, link , db, instance_id, memory='70g', cpus=None, shard=None, resume=False, image=None, aws_conf=None):
     
     #find target instances
     target_instances = ec2.describe_instances(
@@ -131,17 +198,15 @@ def execute_pipe(ec2,ssh_key_file, pName, link , db, instance_id):
 
     try:
         print("[+] Validating pem file...")
-        k = paramiko.RSAKey.from_private_key_file(ssh_key_file)
-
-        print("[+] Creating SSH client...")
-
-        c = paramiko.SSHClient()
-
-        c.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        if aws_conf is None:
+            aws_conf = load_config()
+        settings = ssh_session.session_settings(aws_conf)
+        session  = ssh_session.SSHSession(ids[0], ssh_key_file, attempts=settings['attempts'],
+                                          keepalive=settings['keepalive'])
 
         print("[+] Connecting to SSH client")
 
-        c.connect(hostname=ids[0], username="ec2-user", pkey=k, allow_agent=False, look_for_keys=False)
+        session.connect()
 
         print("[+] Connected to SSH client")              
     except Exception as e:
@@ -150,27 +215,48 @@ def execute_pipe(ec2,ssh_key_file, pName, link , db, instance_id):
         raise(e)
 
     commands = [
-        'docker run --pull=always --memory 70g -v /var/run/docker.sock:/var/run/docker.sock -v /nextflow_workdir/'+str(pName)+':/nextflow_workdir/'+str(pName)+' danova/nextflow-aws:22.04.3 '+str(link)+' -profile batch -r main --input_path "s3://triggersnextflow/'+str(db)+'/'+ str(pName) +'/backups/sample/*.fastq.gz" --pairs_path "s3://triggersnextflow/'+str(db)+'/'+ str(pName) +'/backups/sample/*_{R1,R2}.fastq.gz" --outdir_multiqc "s3://triggersnextflow/16s/'+ str(pName) +'/results/" --outdir_finalres "s3://triggersnextflow/16s/'+ str(pName) +'/results/" -w "/nextflow_workdir/'+str(pName) +'"',
+        pipe_command(pName, link, db, memory, cpus, shard, resume, image),
         #'sudo rm -rf /nextflow_workdir/*'    
     ]
+    # restore the previous state first, save it even when the pipeline fails
+    if resume:
+        restore, save = state_commands(pName, db, shard)
+        commands = [restore] + commands + [save]
     
+    # stream output live, teed to a rotating local log
+    label    = str(pName) if shard is None else str(pName)+'#'+str(shard['index'])
+    log_path = remote_exec.log_path_for('pipeline', label.replace('#', '_shard'))
+    statuses = []
+    # shipped to S3 while it runs, the log outlives the instance
+    shipper  = None
     try:
+        shipper = log_shipper.open_shipper(aws_conf, db, pName, 'pipeline', label)
+        sinks   = [shipper.write] if shipper else []
+        # disk, memory and container usage on their own channels while the pipeline runs
+        session.start_monitors(pName, settings['monitor_interval'], log_path, '['+label+'] ', extra=ssh_session.PIPE_MONITORS, sinks=sinks)
         for command in commands:
             print("running command: {}".format(command))
-            stdin , stdout, stderr = c.exec_command(command)
-            print(stdout.read())
-            print(stderr.read())
-        c.close()
+            with run_trace.span('remote_command', project=pName, command=command) as rec:
+                status = session.run(command, log_path, prefix='['+label+'] ', sinks=sinks)
+                rec['exit_status'] = status
+            if status != 0:
+                print("[-] Command exited with status", status)
+            statuses.append(status)
     except Exception as e:
         print(e)
         raise(e)
-    return True
+    finally:
+        session.close()
+        if shipper:
+            shipper.close()
+    return all(status == 0 for status in statuses)
 
 # Terminates AWS EC2 Instance
 def terminate_instance(ec2_resource, instanceID):
     try:
-        instance = ec2_resource.Instance(instanceID)
-        instance.terminate()
+        with run_trace.span('terminate_instance', instance=instanceID):
+            instance = ec2_resource.Instance(instanceID)
+            instance.terminate()
         print("[x] Instance Terminated")
     except Exception as e:
         print("Can not terminate instance")
@@ -179,6 +265,7 @@ def terminate_instance(ec2_resource, instanceID):
 def main():
     # get arguments
     opt = get_arguments()
+    run_trace.start(opt.project_name)
 
     # load aws-config file
     aws_conf = load_config()
@@ -197,23 +284,36 @@ def main():
         # ec2
     ec2_res = resource_ec2(access_key, secret_key,region)
     ec2_clt = client_ec2(access_key, secret_key,region)
+    s3_clt  = aws_clients.client('s3', access_key, secret_key, region)
+
+    # SIZE instance and container from the project input
+    plan = sizing.plan_for_project(aws_conf, s3_clt, opt.db, opt.project_name)
+    sizing.show_plan(opt.project_name, opt.db, plan)
+    if opt.dry_run:
+        return
+    type = plan['type']
 
     # EXECUTE AMI LAUNCH
-    instance_id = launch_instance_ami(ec2_res, ami_ID, key_pair, sg_id, subnet_id,ec2_clt, type)
+    pool = instance_pool.pool_settings(aws_conf)
+    use_pool = opt.pool or pool['enabled']
+    if use_pool:
+        instance_id = instance_pool.acquire_instance(ec2_res, ec2_clt, 'pipe', ami_ID, key_pair, sg_id, subnet_id, type, pool, launch_instance_ami)
+    else:
+        instance_id = launch_instance_ami(ec2_res, ami_ID, key_pair, sg_id, subnet_id,ec2_clt, type)
 
     
-    # CONNECT to instance
-    print("[*] Waiting for port 22")
-    time.sleep(25)
-    print("[*] .")
-    time.sleep(15)
-    print("[*] ..")
-    time.sleep(10)
-    print("[*]...")
-    execute_pipe(ec2_clt, ssh_key_file , opt.project_name, opt.link , opt.db, instance_id)
+    # CONNECT to instance once sshd answers
+    ready_timeout, status_checks = ssh_ready.ssh_settings(aws_conf)
+    ssh_ready.wait_instance_ready(ec2_clt, instance_id, ready_timeout, status_checks)
+    image = image_cache.image_for_run(aws_conf, opt.project_name, opt.refresh_image)
+    execute_pipe(ec2_clt, ssh_key_file , opt.project_name, opt.link , opt.db, instance_id, plan['memory'], plan['cpus'],
+                 resume=resume_enabled(opt, aws_conf), image=image, aws_conf=aws_conf)
     
-    # TERMINATE Instance
-    terminate_instance(ec2_res, instance_id)
+    # TERMINATE Instance, or stop it back into the pool
+    if use_pool:
+        instance_pool.release_instance(ec2_res, instance_id, 'pipe', pool)
+    else:
+        terminate_instance(ec2_res, instance_id)
 
 ####################
 ## Call functions ##
@@ -5,7 +5,20 @@ import paramiko
 import time
 import json
 import os
-from boto3.s3.transfer import TransferConfig
+import aws_clients
+import upload_engine
+import upload_sync
+import stream_upload
+import ssh_ready
+import instance_pool
+import remote_exec
+import ssh_session
+import run_trace
+import log_shipper
+import catalog
+import url_stream
+import checksums
+import transfer_metrics
 ###############
 ## Functions ##
 ###############
@@ -19,6 +32,13 @@ def get_arguments():
     parser.add_option('-n', '--project_name', dest='project_name', help='Specify Project Name')
     parser.add_option('-d', '--database', dest='db', help='Provide Database to use (16s - ITS)')
     parser.add_option('-s', '--sequences', dest = 'seqs', help = 'Provide File With URL Sequences')
+    parser.add_option('--compress_seqs', dest='compress_seqs', action='store_true', default=False, help='Gzip the FileSeqs on the fly while uploading, stored as fileseqs_<project>.txt.gz and expanded on the instance (remote mode)')
+    parser.add_option('--workers', dest='workers', type='int', help='Files uploaded in parallel, default aws.transfer.workers (local mode)')
+    parser.add_option('--max_concurrency', dest='max_concurrency', type='int', help='Global upload concurrency budget shared by all files, default aws.transfer.max_concurrency (local mode)')
+    parser.add_option('--refresh_catalog', dest='refresh_catalog', action='store_true', default=False, help='Refresh the local project catalog from S3 before checking the project')
+    parser.add_option('--pool', dest='pool', action='store_true', default=False, help='Reuse stopped instances from the warm pool instead of launching from the AMI')
+    parser.add_option('--sync', dest='sync', action='store_true', default=False, help='Skip files already uploaded and resume interrupted uploads (local mode)')
+    parser.add_option('--direct', dest='direct', action='store_true', default=False, help='Stream the URLs straight into S3 from this machine, no EC2 instance (remote mode)')
     
     # get args
     (options, arguments) = parser.parse_args()
@@ -34,15 +54,11 @@ def get_arguments():
     #return objects
     return options
 
-# function to create AWS EC2 client
+# function to get a shared AWS client
 def client_aws(ak, sk, rg, service):
     try:
-        #declare objects
-        clt = boto3.client(service,
-                        rg,
-                        aws_access_key_id=ak,
-                        aws_secret_access_key=sk)
-        print("[+] Boto3 client created")
+        #declare objects, reused across workflows
+        clt = aws_clients.client(service, ak, sk, rg)
 
     except Exception as e:
         print("[-] Boto3 client can not be created")
@@ -51,15 +67,11 @@ def client_aws(ak, sk, rg, service):
     # return objects
     return clt
 
-# function to create aws s3 client
+# function to get a shared AWS resource
 def resource_aws(ak, sk, rg, service):
     try:
-        #declare objects
-        res = boto3.resource(service,
-                        rg,
-                        aws_access_key_id=ak,
-                        aws_secret_access_key=sk)
-        print("[+] Boto3 resource created")
+        #declare objects, reused across workflows
+        res = aws_clients.resource(service, ak, sk, rg)
 
     except Exception as e:
         print("[-] Boto3 resource can not be created")
@@ -71,41 +83,78 @@ def resource_aws(ak, sk, rg, service):
 # Load config
 def load_config():
     try:
-        # Opening JSON file
-        f = open('../configs/aws_conf.json')
-        # Load JSON file
-        aws_conf = json.load(f)
+        with run_trace.span('load_config'):
+            # Opening JSON file
+            f = open('../configs/aws_conf.json')
+            # Load JSON file
+            aws_conf = json.load(f)
     except Exception as e:
         print("[-] AWS-Config file not found, (/configs/aws_conf.json)")
     return aws_conf
 
 # function to check if project is already created
-def folder_exists(s3, db, pName):
+def folder_exists(s3, db, pName, catalog=None, refresh=False, bucket='triggersnextflow'):
     '''
     Folder should exists. 
     Folder should not be empty.
+    Answered from the local catalog when one is given.
     '''
-    
+    if catalog is not None:
+        with run_trace.span('folder_exists', project=pName, catalog=True):
+            return catalog.project_exists(db, pName, refresh)
+
     path = str(db)+'/'+ str(pName)
-    resp = s3.list_objects(Bucket='triggersnextflow', Prefix=path, Delimiter='/',MaxKeys=1)
+    with run_trace.span('folder_exists', project=pName):
+        resp = s3.list_objects(Bucket=bucket, Prefix=path, Delimiter='/',MaxKeys=1)
     return 'CommonPrefixes' in resp
 
+# s3 key of the FileSeqs of a project, .gz when uploaded compressed
+def fileseqs_key(db, pName, compress=False):
+    return str(db)+'/' +str(pName)+'/fileseqs_'+ str(pName) + '.txt' + ('.gz' if compress else '')
+
+# remote command expanding a compressed FileSeqs into the .txt key seqs_dwn_hash.py reads,
+# only the upload from here is compressed, the copy back runs inside the region
+def inflate_command(bucket, db, pName):
+    return ("python3 -c \"import boto3, gzip; s3 = boto3.client('s3'); "
+            "s3.put_object(Bucket='" + str(bucket) + "', Key='" + fileseqs_key(db, pName) + "', "
+            "Body=gzip.decompress(s3.get_object(Bucket='" + str(bucket) + "', Key='" + fileseqs_key(db, pName, True) + "')['Body'].read()))\"")
+
 # upload fileseqs.txt to s3
-def upload_seqs_s3(file, s3, db, pName):
-    #open file and store content
-    f = open(file, 'r')
-    contents = f.read()
-    print("[+] Reading Locally URLs from FileSeqs ")
+def upload_seqs_s3(file, s3, db, pName, compress=False,
+                   threshold=stream_upload.MULTIPART_THRESHOLD, bucket='triggersnextflow'):
+    '''
+    Streams the file from disk, memory stays bounded
+    by one part whatever the file size. A compressed upload is
+    stored as .txt.gz, execute_pipe expands it on the instance.
+    '''
+    size = os.path.getsize(file)
+    print("[+] Streaming URLs from FileSeqs (", size, "bytes )")
 
     # create object
-    object = s3.Object('triggersnextflow', str(db)+'/' +str(pName)+'/fileseqs_'+ str(pName) + '.txt')
-    
+    key = fileseqs_key(db, pName, compress)
+    object = s3.Object(bucket, key)
+
     #execute upload
-    result = object.put(Body=contents)
+    transfer_metrics.expect(key, size)
+    with run_trace.span('upload', project=pName, files=1, bytes=size):
+        with open(file, 'rb') as f:
+            if not compress and size < threshold:
+                # small file, single streamed PUT
+                result = object.put(Body=f)
+                transfer_metrics.progress(key, size)
+            else:
+                chunks = stream_upload.iter_chunks(f)
+                if compress:
+                    chunks = stream_upload.gzip_chunks(chunks)
+                result = stream_upload.multipart_from_chunks(s3.meta.client, object.bucket_name,
+                                                             object.key, chunks,
+                                                             callback=lambda n: transfer_metrics.progress(key, n),
+                                                             ContentType='text/plain')
     #get response
     res = result.get('ResponseMetadata')
 
     #check response
+    transfer_metrics.finish(key, res.get('HTTPStatusCode') == 200)
     if res.get('HTTPStatusCode') == 200:
         print('[+] FileSeqs Provided Uploaded Successfully')
         return True
@@ -114,46 +163,52 @@ def upload_seqs_s3(file, s3, db, pName):
         return False
 
 # Launches AWS EC2 Instance with AMI ID
-def launch_instance_ami(ec2_resource, ami_id, key_pair_name, sec_group_id,subnet_id, ec2_client, type):
+def launch_instance_ami(ec2_resource, ami_id, key_pair_name, sec_group_id,subnet_id, ec2_client, type, tags=None, watcher=None):
     instance_ids = []
     try:
         # create instance
-        instances = ec2_resource.create_instances(
-            MinCount = 1,
-            MaxCount = 1,
-            ImageId=ami_id,
-            InstanceType=type,
-            KeyName=key_pair_name,
-            SecurityGroupIds=[
-                sec_group_id,
-            ],
-            SubnetId=subnet_id,
-            TagSpecifications=[
-                {
-                    'ResourceType': 'instance',
-                    'Tags': [
-                        {
-                            'Key': 'Name',
-                            'Value': 'ec2-nextflow-instance-run'
-                        },
-                    ]
-                },
-            ]
-        )
+        with run_trace.span('create_instances', ami=ami_id, type=type):
+            instances = ec2_resource.create_instances(
+                MinCount = 1,
+                MaxCount = 1,
+                ImageId=ami_id,
+                InstanceType=type,
+                KeyName=key_pair_name,
+                SecurityGroupIds=[
+                    sec_group_id,
+                ],
+                SubnetId=subnet_id,
+                TagSpecifications=[
+                    {
+                        'ResourceType': 'instance',
+                        'Tags': [
+                            {
+                                'Key': 'Name',
+                                'Value': 'ec2-nextflow-instance-run'
+                            },
+                        ] + (tags or [])
+                    },
+                ]
+            )
         print("[+] Instance Created")
         # fetch instance ID
         for instance in instances:
             print(" - Instance ID: ", instance.id)
             print("[x] Wait until running")
-            instance.wait_until_running()
+            with run_trace.span('wait_until_running', instance=instance.id):
+                if watcher:
+                    watcher.wait_running(instance.id)
+                else:
+                    instance.wait_until_running()
             print("[+] Instance started")
-            response = ec2_client.associate_iam_instance_profile(
-                IamInstanceProfile={
-                    'Arn': 'arn:aws:iam::451861820529:instance-profile/ecsInstanceRole',
-                    'Name': 'ecsInstanceRole'
-                },
-                InstanceId=instance.id
-            )
+            with run_trace.span('associate_iam_instance_profile', instance=instance.id):
+                response = ec2_client.associate_iam_instance_profile(
+                    IamInstanceProfile={
+                        'Arn': 'arn:aws:iam::451861820529:instance-profile/ecsInstanceRole',
+                        'Name': 'ecsInstanceRole'
+                    },
+                    InstanceId=instance.id
+                )
             print(response)
             # wait until running
 
@@ -164,7 +219,7 @@ def launch_instance_ami(ec2_resource, ami_id, key_pair_name, sec_group_id,subnet
 
 # Connect to AWS EC2 Instance
 # function to execute pipeline using EC2 instance
-def execute_pipe(ec2,ssh_key_file, pName, db, instance_id, bucket):
+def execute_pipe(ec2,ssh_key_file, pName, db, instance_id, bucket, compressed=False, aws_conf=None):
     
     #find target instances
     target_instances = ec2.describe_instances(
@@ -187,17 +242,15 @@ def execute_pipe(ec2,ssh_key_file, pName, db, instance_id, bucket):
 
     try:
         print("[+] Validating pem file...")
-        k = paramiko.RSAKey.from_private_key_file(ssh_key_file)
-
-        print("[+] Creating SSH client...")
-
-        c = paramiko.SSHClient()
-
-        c.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        if aws_conf is None:
+            aws_conf = load_config()
+        settings = ssh_session.session_settings(aws_conf)
+        session  = ssh_session.SSHSession(ids[0], ssh_key_file, attempts=settings['attempts'],
+                                          keepalive=settings['keepalive'])
 
         print("[+] Connecting to SSH client")
 
-        c.connect(hostname=ids[0], username="ec2-user", pkey=k, allow_agent=False, look_for_keys=False)
+        session.connect()
 
         print("[+] Connected to SSH client")              
     except Exception as e:
@@ -208,27 +261,48 @@ def execute_pipe(ec2,ssh_key_file, pName, db, instance_id, bucket):
     #link = "https://gitlab.com/dvilanova/16s_amazon"
 
     commands = [
-        'python3 seqs_dwn_hash.py '+str(bucket)+' '+str(db)+' '+str(pName)+' > execution_'+str(pName)+'.log',
+        # teed, the instance keeps its copy for logs_upload.py and the output streams back live
+        'set -o pipefail; python3 seqs_dwn_hash.py '+str(bucket)+' '+str(db)+' '+str(pName)+' 2>&1 | tee execution_'+str(pName)+'.log',
         'python3 logs_upload.py '+str(bucket)+' '+str(db)+' '+str(pName)
 
     ]
+    if compressed:
+        commands = [inflate_command(bucket, db, pName)] + commands
+    # stream output live, teed to a rotating local log
+    log_path = remote_exec.log_path_for('upload', pName)
+    statuses = []
+    # shipped to S3 while it runs, the log outlives the instance
+    shipper  = None
     try:
+        shipper = log_shipper.open_shipper(aws_conf, db, pName, 'upload')
+        sinks   = [shipper.write] if shipper else []
+        # disk, memory and download progress on their own channels while the commands run
+        session.start_monitors(pName, settings['monitor_interval'], log_path, '['+str(pName)+'] ', extra=ssh_session.UPLOAD_MONITORS, sinks=sinks)
         for command in commands:
             print("running command: {}".format(command))
-            stdin , stdout, stderr = c.exec_command(command)
-            print(stdout.read())
-            print(stderr.read())
-        c.close()
+            # the download span times the transfer without the instance boot
+            with run_trace.span('remote_command', project=pName, command=command,
+                                download='seqs_dwn_hash.py' in command) as rec:
+                status = session.run(command, log_path, prefix='['+str(pName)+'] ', sinks=sinks)
+                rec['exit_status'] = status
+            if status != 0:
+                print("[-] Command exited with status", status)
+            statuses.append(status)
     except Exception as e:
         print(e)
         raise(e)
-    return True
+    finally:
+        session.close()
+        if shipper:
+            shipper.close()
+    return all(status == 0 for status in statuses)
 
 # Terminates AWS EC2 Instance
 def terminate_instance(ec2_resource, instanceID):
     try:
-        instance = ec2_resource.Instance(instanceID)
-        instance.terminate()
+        with run_trace.span('terminate_instance', instance=instanceID):
+            instance = ec2_resource.Instance(instanceID)
+            instance.terminate()
         print("[x] Instance Terminated")
     except Exception as e:
         print("Can not terminate instance")
@@ -268,32 +342,44 @@ def main1():
     aws_ec2_rs = resource_aws(access_key, secret_key, region, 'ec2')
 
     # check if project name exists
-    exists = folder_exists(aws_s3_cl, opt.db, opt.project_name)
+    exists = folder_exists(aws_s3_cl, opt.db, opt.project_name, catalog.open_catalog(aws_conf), opt.refresh_catalog, bucket_sqs)
     
     if exists == True:
         print("[-] Failed to create new dir, project name ", str(opt.project_name), " already created, please use another name or delete project")
         exit
 
     # upload sequences file to to s3
-    upload_seqs_s3(opt.seqs, aws_s3_rs, opt.db, opt.project_name)
+    upload_seqs_s3(opt.seqs, aws_s3_rs, opt.db, opt.project_name, compress=opt.compress_seqs, bucket=bucket_sqs)
+
+    # small lists are streamed from here, no instance needed
+    if url_stream.use_direct(opt, aws_conf):
+        direct = url_stream.direct_settings(aws_conf)
+        aws_clients.set_pool_size(direct['concurrency'] * 2)
+        aws_s3_cl = client_aws(access_key, secret_key, region, 's3')
+        return url_stream.stream_fileseqs(aws_s3_cl, opt.seqs, bucket_sqs, opt.db, opt.project_name,
+                                          direct['concurrency'], direct['per_host'],
+                                          manifest=checksums.open_manifest(aws_conf, aws_s3_cl, opt.db, opt.project_name))
 
     # launch instance
-    instance_id = launch_instance_ami(aws_ec2_rs, ami_id_sqs, key_pair, sg_id, subnet_id, aws_ec2_cl, type)
+    pool = instance_pool.pool_settings(aws_conf)
+    use_pool = opt.pool or pool['enabled']
+    if use_pool:
+        instance_id = instance_pool.acquire_instance(aws_ec2_rs, aws_ec2_cl, 'seqs', ami_id_sqs, key_pair, sg_id, subnet_id, type, pool, launch_instance_ami)
+    else:
+        instance_id = launch_instance_ami(aws_ec2_rs, ami_id_sqs, key_pair, sg_id, subnet_id, aws_ec2_cl, type)
 
-    # CONNECT to instance
-    print("[*] Waiting for port 22")
-    time.sleep(25)
-    print("[*] .")
-    time.sleep(15)
-    print("[*] ..")
-    time.sleep(10)
-    print("[*]...")
+    # CONNECT to instance once sshd answers
+    ready_timeout, status_checks = ssh_ready.ssh_settings(aws_conf)
+    ssh_ready.wait_instance_ready(aws_ec2_cl, instance_id, ready_timeout, status_checks)
 
     # connect to instance and upload seqs into s3
-    execute_pipe(aws_ec2_cl, ssh_key_file, opt.project_name, opt.db, instance_id, bucket_sqs)
+    execute_pipe(aws_ec2_cl, ssh_key_file, opt.project_name, opt.db, instance_id, bucket_sqs, opt.compress_seqs, aws_conf)
 
-    # terminate instance
-    terminate_instance(aws_ec2_rs, instance_id)
+    # terminate instance, or stop it back into the pool
+    if use_pool:
+        instance_pool.release_instance(aws_ec2_rs, instance_id, 'seqs', pool)
+    else:
+        terminate_instance(aws_ec2_rs, instance_id)
 
 def main2():
     print("[*] Local Upload to S3")
@@ -309,20 +395,23 @@ def main2():
     access_key = aws_conf['aws']['credentials']['access_key']
     secret_key = aws_conf['aws']['credentials']['secret_key']
     region     = aws_conf['aws']['credentials']['region']
-    # create aws s3
+    # shared aws s3, one connection pool sized for all upload workers
+    workers, max_concurrency = upload_engine.transfer_settings(aws_conf, opt)
+    aws_clients.set_pool_size(max_concurrency)
     s3 = client_aws(access_key, secret_key, region, 's3')
-    # 
-    config = TransferConfig(max_concurrency=2)
-    # iterate over files in that directory
-    for filename in os.listdir(directory):
-        ff = os.path.join(directory, filename)
-        # checking if it is a file
-        if os.path.isfile(ff):
-            if ff.endswith('.fastq.gz'):
-                with open(ff, 'rb') as f:
-                    filepath = str(db)+"/"+str(pName)+"/backups/sample/"+str(filename)
-                    s3.upload_fileobj(f, bucket_name, filepath, Config=config)  
-                    print("[+] File, ", filename, " uploaded to S3")
+    # upload every .fastq.gz in that directory, plain .fastq gzipped on the way
+    # digests are computed while uploading and kept in a manifest next to the project
+    sums = checksums.open_manifest(aws_conf, s3, db, pName)
+    if opt.sync:
+        upload_sync.sync_directory(s3, directory, bucket_name, db, pName,
+                                   workers=workers, max_concurrency=max_concurrency,
+                                   checksum_manifest=sums)
+    else:
+        upload_engine.upload_directory(s3, directory, bucket_name, db, pName,
+                                       workers=workers, max_concurrency=max_concurrency,
+                                       uploader=checksums.checksum_uploader(sums) if sums else None)
+    if sums:
+        sums.save()
 
 
 ####################
@@ -331,13 +420,18 @@ def main2():
 
 def main():
     opt = get_arguments()
+    run_trace.start(opt.project_name)
+    transfer_metrics.start(load_config())
 
     isFile = os.path.isfile(opt.seqs)
 
-    if isFile:
-        main1()
-    else:
-        main2()
+    try:
+        if isFile:
+            main1()
+        else:
+            main2()
+    finally:
+        transfer_metrics.stop()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+import os
+import gzip
+import json
+import time
+import random
+import shutil
+import optparse
+import resource
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import boto3
+from botocore.config import Config
+import upload_engine
+
+###############
+## Constants ##
+###############
+
+KB = 1024
+MB = 1024 * KB
+GB = 1024 * MB
+
+BENCH_DIR = '../bench'
+BUCKET    = 'bench-triggersnextflow'
+
+# file count, file size, workers, concurrency budget, part size (None = adaptive)
+MATRICES = {
+    'quick': [
+        (10,    1 * MB,   4, 16, None),
+        (100,   64 * KB,  4, 16, None),
+        (100,   64 * KB,  16, 32, None),
+        (4,     128 * MB, 2, 8,  None),
+        (4,     128 * MB, 4, 32, None),
+        (4,     128 * MB, 4, 32, 32 * MB),
+    ],
+    'full': [
+        (10000, 4 * KB,   16, 32, None),
+        (1000,  256 * KB, 8,  32, None),
+        (100,   8 * MB,   4,  16, None),
+        (100,   8 * MB,   16, 64, None),
+        (20,    256 * MB, 4,  16, None),
+        (20,    256 * MB, 8,  64, None),
+        (2,     2 * GB,   2,  16, None),
+        (2,     2 * GB,   2,  32, 64 * MB),
+        (2,     2 * GB,   2,  64, 128 * MB),
+    ],
+}
+
+###############
+## Functions ##
+###############
+
+# get arguments
+def get_arguments():
+    # create parser object
+    parser = optparse.OptionParser()
+
+    # add object options
+    parser.add_option('-e', '--endpoint', dest='endpoint', default='http://127.0.0.1:5000', help='Local S3-compatible endpoint (moto_server, minio)')
+    parser.add_option('-m', '--matrix', dest='matrix', default='quick', help='Benchmark matrix: ' + ', '.join(MATRICES))
+    parser.add_option('-b', '--baseline', dest='baseline', help='Previous report (JSON) to compare against')
+    parser.add_option('-w', '--workdir', dest='workdir', help='Directory for the synthetic files (default: temp dir)')
+    parser.add_option('--start_moto', dest='start_moto', action='store_true', default=False, help='Start an in-process moto server on the endpoint port')
+
+    # get args
+    (options, arguments) = parser.parse_args()
+
+    if options.matrix not in MATRICES:
+        parser.error("[-] Unknown matrix, use --help for more info")
+
+    #return objects
+    return options
+
+# one gzip member of random FASTQ records
+def fastq_member(n_bytes, seed):
+    rnd = random.Random(seed)
+    lines = []
+    size = 0
+    i = 0
+    while size < n_bytes:
+        seq = ''.join(rnd.choices('ACGT', k=150))
+        qual = ''.join(rnd.choices('FFFF:,', k=150))
+        rec = '@bench:' + str(seed) + ':' + str(i) + '\n' + seq + '\n+\n' + qual + '\n'
+        lines.append(rec)
+        size += len(rec)
+        i += 1
+    return gzip.compress(''.join(lines).encode(), mtime=0)
+
+# write a synthetic .fastq.gz set, whole gzip members are repeated
+# until the target size is reached (concatenated members are valid gzip)
+def make_fastq_set(directory, n_files, file_size):
+    os.makedirs(directory, exist_ok=True)
+    member = fastq_member(min(file_size, 1 * MB), seed=file_size)
+    for i in range(n_files):
+        path = os.path.join(directory, 'S' + str(i // 2).zfill(5) + '_R' + str(i % 2 + 1) + '.fastq.gz')
+        with open(path, 'wb') as f:
+            written = 0
+            while written < file_size:
+                f.write(member)
+                written += len(member)
+
+# s3 client against the local endpoint
+def bench_client(endpoint, pool):
+    return boto3.client('s3', endpoint_url=endpoint, region_name='us-east-1',
+                        aws_access_key_id='testing', aws_secret_access_key='testing',
+                        config=Config(max_pool_connections=max(10, pool)))
+
+# run one case, in its own process so peak RSS is per case
+def run_case(endpoint, directory, n_files, file_size, workers, max_concurrency, part_size, prefix):
+    if part_size:
+        upload_engine.MIN_PART_SIZE = part_size
+        upload_engine.MAX_PART_SIZE = part_size
+    s3 = bench_client(endpoint, max_concurrency)
+    latencies = []
+
+    # time every file through the engine's own uploader
+    def uploader(s3, bucket, key, path, size, threads):
+        secs = upload_engine.upload_one(s3, bucket, key, path, size, threads)
+        latencies.append(secs)
+        return secs
+
+    start  = time.time()
+    result = upload_engine.upload_directory(s3, directory, BUCKET, 'bench', prefix,
+                                            workers=workers, max_concurrency=max_concurrency,
+                                            uploader=uploader)
+    elapsed = time.time() - start
+    latencies.sort()
+    return {
+        'files':       n_files,
+        'file_size':   file_size,
+        'workers':     workers,
+        'concurrency': max_concurrency,
+        'part_size':   part_size or 'adaptive',
+        'bytes':       result['bytes'],
+        'failed':      len(result['failed']),
+        'seconds':     round(elapsed, 3),
+        'mb_s':        round(result['bytes'] / MB / elapsed, 2) if elapsed else 0.0,
+        'p50_s':       round(percentile(latencies, 50), 4),
+        'p99_s':       round(percentile(latencies, 99), 4),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / KB, 1),
+    }
+
+# nearest-rank percentile of a sorted list
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    rank = max(0, min(len(values) - 1, int(round(pct / 100.0 * len(values))) - 1))
+    return values[rank]
+
+# key identifying a case across reports
+def case_key(r):
+    return (r['files'], r['file_size'], r['workers'], r['concurrency'], str(r['part_size']))
+
+# write JSON and markdown reports, compared with a baseline when given
+def write_report(results, matrix, baseline=None):
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    stamp = time.strftime('%Y%m%dT%H%M%S')
+    json_path = os.path.join(BENCH_DIR, 'upload_' + matrix + '_' + stamp + '.json')
+    md_path   = json_path[:-5] + '.md'
+    with open(json_path, 'w') as f:
+        json.dump(results, f, indent=1)
+
+    base = {}
+    if baseline:
+        with open(baseline) as f:
+            base = {case_key(r): r for r in json.load(f)}
+
+    rows = ['| files | size | workers | conc | part | MB/s | p50 s | p99 s | RSS MB | vs base |',
+            '|---:|---:|---:|---:|---:|---:|---:|---:|---:|---:|']
+    for r in results:
+        old = base.get(case_key(r))
+        delta = '-'
+        if old and old['mb_s']:
+            delta = '{:+.1f}%'.format((r['mb_s'] - old['mb_s']) / old['mb_s'] * 100)
+        rows.append('| {} | {} | {} | {} | {} | {} | {} | {} | {} | {} |'.format(
+            r['files'], human(r['file_size']), r['workers'], r['concurrency'],
+            r['part_size'] if r['part_size'] == 'adaptive' else human(r['part_size']),
+            r['mb_s'], r['p50_s'], r['p99_s'], r['peak_rss_mb'], delta))
+    with open(md_path, 'w') as f:
+        f.write('# Upload benchmark (' + matrix + ')\n\n' + '\n'.join(rows) + '\n')
+
+    print('\n'.join(rows))
+    print("[+] Report written to", json_path, "and", md_path)
+    return json_path
+
+# short size label
+def human(n):
+    for unit, size in (('GB', GB), ('MB', MB), ('KB', KB)):
+        if n >= size:
+            return str(round(n / size, 1)).rstrip('0').rstrip('.') + unit
+    return str(n) + 'B'
+
+def main():
+    opt = get_arguments()
+
+    server = None
+    if opt.start_moto:
+        from moto.server import ThreadedMotoServer
+        port = int(opt.endpoint.rsplit(':', 1)[1].split('/')[0])
+        server = ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+        server.start()
+        print("[+] moto server started on", opt.endpoint)
+
+    workdir = opt.workdir or tempfile.mkdtemp(prefix='bench_fastq_')
+    results = []
+    try:
+        bench_client(opt.endpoint, 10).create_bucket(Bucket=BUCKET)
+        ctx = multiprocessing.get_context('spawn')
+        for i, (n_files, file_size, workers, conc, part) in enumerate(MATRICES[opt.matrix]):
+            directory = os.path.join(workdir, str(n_files) + 'x' + str(file_size))
+            if not os.path.isdir(directory):
+                print("[*] Generating", n_files, "x", human(file_size))
+                make_fastq_set(directory, n_files, file_size)
+            print("[*] Case", i + 1, ":", n_files, "x", human(file_size), "workers", workers, "budget", conc)
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                results.append(pool.submit(run_case, opt.endpoint, directory, n_files, file_size,
+                                           workers, conc, part, 'case' + str(i)).result())
+    finally:
+        if not opt.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+        if server:
+            server.stop()
+
+    write_report(results, opt.matrix, opt.baseline)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+import os
+import time
+import sqlite3
+import optparse
+import aws_clients
+import aws_deploy
+import sizing
+
+###############
+## Constants ##
+###############
+
+CATALOG_PATH = '../catalog/catalog.db'
+
+# incremental refreshes only see keys sorting after the last one,
+# a full refresh every FULL_TTL seconds catches everything else
+FULL_TTL = 24 * 3600
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS objects (
+    key           TEXT PRIMARY KEY,
+    db            TEXT,
+    project       TEXT,
+    sample        TEXT,
+    size          INTEGER,
+    etag          TEXT,
+    last_modified TEXT,
+    seen_at       REAL
+);
+CREATE INDEX IF NOT EXISTS objects_project ON objects (db, project);
+CREATE TABLE IF NOT EXISTS cursors (
+    prefix       TEXT PRIMARY KEY,
+    last_key     TEXT,
+    refreshed_at REAL,
+    full_at      REAL
+);
+'''
+
+###############
+## Functions ##
+###############
+
+# local SQLite catalog of db -> project -> sample objects of the bucket
+class Catalog:
+    def __init__(self, s3, bucket, path=CATALOG_PATH):
+        self.s3     = s3
+        self.bucket = bucket
+        self.path   = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self.connect() as con:
+            con.executescript(SCHEMA)
+
+    # one connection per call, safe across threads
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    # refresh a prefix ('' for the whole bucket), incrementally unless forced or stale
+    def refresh(self, prefix='', force=False):
+        with self.connect() as con:
+            row = con.execute('SELECT last_key, full_at FROM cursors WHERE prefix = ?', (prefix,)).fetchone()
+        last_key, full_at = row if row else (None, None)
+        full = force or last_key is None or full_at is None or time.time() - full_at > FULL_TTL
+
+        started = time.time()
+        kwargs  = {'Bucket': self.bucket, 'Prefix': prefix}
+        if not full:
+            kwargs['StartAfter'] = last_key
+
+        n = 0
+        paginator = self.s3.get_paginator('list_objects_v2')
+        with self.connect() as con:
+            for page in paginator.paginate(**kwargs):
+                rows = [object_row(obj, started) for obj in page.get('Contents', [])]
+                con.executemany('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                if rows:
+                    last_key = rows[-1][0]
+                n += len(rows)
+            if full:
+                # objects not seen by a full listing were deleted
+                con.execute("DELETE FROM objects WHERE key LIKE ? ESCAPE '\\' AND seen_at < ?",
+                            (like_prefix(prefix), started))
+                full_at = started
+            con.execute('INSERT OR REPLACE INTO cursors VALUES (?, ?, ?, ?)',
+                        (prefix, last_key, started, full_at))
+        print("[+] Catalog", 'full' if full else 'incremental', "refresh of '" + prefix + "':", n, "objects")
+        return n
+
+    # project is known with at least one object, checks S3 again before saying no
+    def project_exists(self, db, pName, refresh=False):
+        prefix = str(db)+'/'+str(pName)+'/'
+        if refresh:
+            self.refresh(prefix, force=True)
+        if self.count(prefix):
+            return True
+        if not refresh:
+            self.refresh(prefix)
+        return self.count(prefix) > 0
+
+    def count(self, prefix):
+        with self.connect() as con:
+            return con.execute("SELECT COUNT(*) FROM objects WHERE key LIKE ? ESCAPE '\\'",
+                               (like_prefix(prefix),)).fetchone()[0]
+
+    # list dbs, projects of a db, or samples of a project
+    def listing(self, db=None, pName=None):
+        with self.connect() as con:
+            if db is None:
+                return con.execute('SELECT db, COUNT(DISTINCT project), COUNT(*), SUM(size) '
+                                   'FROM objects GROUP BY db ORDER BY db').fetchall()
+            if pName is None:
+                return con.execute('SELECT project, COUNT(DISTINCT sample), COUNT(*), SUM(size) '
+                                   'FROM objects WHERE db = ? GROUP BY project ORDER BY project',
+                                   (db,)).fetchall()
+            return con.execute('SELECT sample, COUNT(*), SUM(size) FROM objects '
+                               'WHERE db = ? AND project = ? AND sample IS NOT NULL '
+                               'GROUP BY sample ORDER BY sample', (db, pName)).fetchall()
+
+    # summary of a project: inputs, results, logs
+    def status(self, db, pName):
+        prefix = str(db)+'/'+str(pName)+'/'
+        with self.connect() as con:
+            def part(sub):
+                return con.execute('SELECT COUNT(*), COALESCE(SUM(size), 0), MAX(last_modified) '
+                                   "FROM objects WHERE key LIKE ? ESCAPE '\\'",
+                                   (like_prefix(prefix + sub),)).fetchone()
+            samples = con.execute('SELECT COUNT(DISTINCT sample) FROM objects WHERE db = ? AND project = ? '
+                                  'AND sample IS NOT NULL', (db, pName)).fetchone()[0]
+            return {
+                'samples': samples,
+                'inputs':  part('backups/sample/'),
+                'results': part('results/'),
+                'logs':    part('logs/'),
+                'fileseqs': part('fileseqs_')[0] > 0,
+            }
+
+# escape a prefix for LIKE
+def like_prefix(prefix):
+    return prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+# table row from a list_objects_v2 entry
+def object_row(obj, seen_at):
+    key   = obj['Key']
+    parts = key.split('/')
+    db      = parts[0] if len(parts) > 1 else None
+    project = parts[1] if len(parts) > 2 else None
+    sample  = None
+    if len(parts) > 4 and parts[2] == 'backups' and parts[3] == 'sample':
+        sample = sizing.sample_name(parts[-1])
+    return (key, db, project, sample, obj['Size'], obj['ETag'].strip('"'),
+            obj['LastModified'].isoformat() if hasattr(obj['LastModified'], 'isoformat') else str(obj['LastModified']),
+            seen_at)
+
+# catalog from the aws config, None when disabled
+def open_catalog(aws_conf):
+    settings = aws_conf['aws'].get('catalog', {})
+    if not settings.get('enabled', False):
+        return None
+    ak, sk, rg = aws_clients.credentials(aws_conf)
+    return Catalog(aws_clients.client('s3', ak, sk, rg),
+                   aws_conf['aws']['s3_bucket_seqs']['name'],
+                   settings.get('path', CATALOG_PATH))
+
+# get arguments
+def get_arguments():
+    # create parser object
+    parser = optparse.OptionParser(usage='%prog list [db [project]] | status db project | refresh [prefix]')
+
+    # add object options
+    parser.add_option('-r', '--refresh', dest='refresh', action='store_true', default=False, help='Force a full refresh from S3 first')
+
+    # get args
+    (options, arguments) = parser.parse_args()
+
+    # secure empty executions
+    if not arguments or arguments[0] not in ('list', 'status', 'refresh'):
+        parser.error("[-] Please Specify a command (list, status, refresh), use --help for more info")
+    elif arguments[0] == 'status' and len(arguments) != 3:
+        parser.error("[-] Please Specify db and project for status, use --help for more info")
+
+    #return objects
+    return options, arguments
+
+def main():
+    opt, args = get_arguments()
+    aws_conf = aws_deploy.load_config()
+    ak, sk, rg = aws_clients.credentials(aws_conf)
+    cat = Catalog(aws_clients.client('s3', ak, sk, rg),
+                  aws_conf['aws']['s3_bucket_seqs']['name'],
+                  aws_conf['aws'].get('catalog', {}).get('path', CATALOG_PATH))
+
+    command, rest = args[0], args[1:]
+    prefix = '/'.join(rest) + '/' if rest else ''
+    if command == 'refresh':
+        cat.refresh(rest[0] if rest else '', force=opt.refresh)
+        return
+    cat.refresh(prefix, force=opt.refresh)
+
+    if command == 'list':
+        rows = cat.listing(*rest[:2])
+        for row in rows:
+            size = row[-1] or 0
+            print("{:<30} {:>8} {:>10} {:>10} MB".format(str(row[0]), row[1], row[2] if len(row) > 3 else '', round(size / 1024 ** 2, 1)))
+    else:
+        st = cat.status(rest[0], rest[1])
+        print("[+] Project", rest[1], "(", rest[0], ")")
+        print(" - Samples:", st['samples'])
+        for name in ('inputs', 'results', 'logs'):
+            n, size, last = st[name]
+            print(" - " + name.capitalize() + ":", n, "objects,", round(size / 1024 ** 2, 1), "MB, last", last or '-')
+        print(" - FileSeqs:", 'yes' if st['fileseqs'] else 'no')
+
+if __name__ == "__main__":
+    main()
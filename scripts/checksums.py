@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import hashlib
+import optparse
+import threading
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+import aws_clients
+import aws_deploy
+import upload_engine
+import fastq_compress
+import transfer_metrics
+
+###############
+## Constants ##
+###############
+
+# manifest stored next to fileseqs_<project>.txt
+MANIFEST_PREFIX = 'checksums_'
+
+###############
+## Functions ##
+###############
+
+# MD5, SHA-256 and S3 ETag of a stream, fed once in order
+class Digest:
+    def __init__(self, part_size=None):
+        '''
+        part_size is the multipart chunk size, None for a single PUT.
+        '''
+        self.part_size = part_size
+        self.size      = 0
+        self.md5       = hashlib.md5()
+        self.sha256    = hashlib.sha256()
+        self.parts     = []
+        self.part      = hashlib.md5()
+        self.part_fill = 0
+
+    def update(self, data):
+        self.md5.update(data)
+        self.sha256.update(data)
+        self.size += len(data)
+        if not self.part_size:
+            return
+        view = memoryview(data)
+        while view:
+            take = min(len(view), self.part_size - self.part_fill)
+            self.part.update(view[:take])
+            self.part_fill += take
+            view = view[take:]
+            if self.part_fill == self.part_size:
+                self.parts.append(self.part.digest())
+                self.part      = hashlib.md5()
+                self.part_fill = 0
+
+    # ETag S3 gives the object: md5 for a PUT, md5 of the part md5s for a multipart upload
+    def etag(self):
+        if not self.part_size:
+            return self.md5.hexdigest()
+        parts = self.parts + ([self.part.digest()] if self.part_fill else [])
+        return hashlib.md5(b''.join(parts)).hexdigest() + '-' + str(len(parts))
+
+    def record(self):
+        return {'size': self.size, 'md5': self.md5.hexdigest(),
+                'sha256': self.sha256.hexdigest(), 'etag': self.etag()}
+
+# file wrapper hashing bytes the first time they are read,
+# re-reads after a seek (retries, body checksums) are not hashed twice
+class HashingReader:
+    def __init__(self, f, digest):
+        self.f      = f
+        self.digest = digest
+        self.hashed = 0
+
+    def read(self, n=-1):
+        pos  = self.f.tell()
+        data = self.f.read(n)
+        end  = pos + len(data)
+        if pos <= self.hashed < end:
+            self.digest.update(data[self.hashed - pos:])
+            self.hashed = end
+        return data
+
+    def seek(self, *args):
+        return self.f.seek(*args)
+
+    def tell(self):
+        return self.f.tell()
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+# feeds multipart bodies to a digest in part order, whatever order they finish in
+class PartFeed:
+    def __init__(self, digest, n_parts, fetch, skip=()):
+        '''
+        skip are parts uploaded by an earlier run, read back with fetch(number).
+        '''
+        self.digest  = digest
+        self.n_parts = n_parts
+        self.fetch   = fetch
+        self.skip    = set(skip)
+        self.next    = 1
+        self.pending = {}
+        self.lock    = threading.Lock()
+
+    def add(self, number, body):
+        with self.lock:
+            self.pending[number] = body
+            self.drain()
+
+    def drain(self):
+        while self.next <= self.n_parts:
+            if self.next in self.pending:
+                body = self.pending.pop(self.next)
+            elif self.next in self.skip:
+                body = self.fetch(self.next)
+            else:
+                break
+            self.digest.update(body)
+            self.next += 1
+
+    # True once every part went through the digest
+    def finish(self):
+        with self.lock:
+            self.drain()
+            return self.next > self.n_parts
+
+# per-project checksum manifest kept in S3
+class ChecksumManifest:
+    def __init__(self, s3, bucket, db, pName, attach=False):
+        self.s3     = s3
+        self.bucket = bucket
+        self.key    = manifest_key(db, pName)
+        self.attach = attach
+        self.lock   = threading.Lock()
+        self.files  = self.load()
+
+    # existing manifest, so files of earlier runs are kept
+    def load(self):
+        try:
+            body = self.s3.get_object(Bucket=self.bucket, Key=self.key)['Body'].read()
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            return {}
+        return json.loads(body).get('files', {})
+
+    def add(self, filename, key, record):
+        with self.lock:
+            self.files[filename] = dict(record, key=key)
+
+    def save(self):
+        with self.lock:
+            body = json.dumps({'files': self.files}, indent=1, sort_keys=True)
+        self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=body.encode(),
+                           ContentType='application/json')
+        print("[+] Checksum manifest saved to", self.key, "(", len(self.files), "files )")
+        for sha, names in duplicates(self.files).items():
+            print("[-] Identical content (sha256", sha[:12], "):", ", ".join(names))
+
+# s3 key of the checksum manifest of a project
+def manifest_key(db, pName):
+    return str(db)+"/"+str(pName)+"/"+MANIFEST_PREFIX+str(pName)+".json"
+
+# checksum manifest from the aws config, None when disabled,
+# metadata stays opt-in: attaching it copies every object once more
+def open_manifest(aws_conf, s3, db, pName):
+    settings = aws_conf['aws'].get('checksums', {})
+    if not settings.get('enabled', False):
+        return None
+    return ChecksumManifest(s3, aws_conf['aws']['s3_bucket_seqs']['name'], db, pName,
+                            attach=settings.get('metadata', False))
+
+# files sharing the same sha256
+def duplicates(files):
+    by_sha = {}
+    for filename, rec in files.items():
+        by_sha.setdefault(rec['sha256'], []).append(filename)
+    return {sha: sorted(names) for sha, names in by_sha.items() if len(names) > 1}
+
+# transfer config whose part boundaries match the digest, so a copy keeps the ETag
+def copy_config(digest, threads):
+    if not digest.part_size:
+        return TransferConfig(multipart_threshold=upload_engine.SINGLE_PART_LIMIT,
+                              max_concurrency=1, use_threads=False)
+    return TransferConfig(multipart_threshold=upload_engine.SINGLE_PART_LIMIT,
+                          multipart_chunksize=digest.part_size,
+                          max_concurrency=max(1, threads))
+
+# check an uploaded object against its digest, attach the digests and record it
+def seal(s3, bucket, key, digest, threads, manifest):
+    '''
+    Metadata can only be changed by copying the object onto itself,
+    the copy runs server-side and keeps the part layout, and so the ETag.
+    It still reads and writes the whole object again before the
+    pipeline can start, so it only runs with checksums.metadata set;
+    the manifest holds the digests either way.
+    '''
+    rec = digest.record()
+    if manifest.attach:
+        s3.copy({'Bucket': bucket, 'Key': key}, bucket, key,
+                ExtraArgs={'Metadata': {'md5': rec['md5'], 'sha256': rec['sha256']},
+                           'MetadataDirective': 'REPLACE'},
+                Config=copy_config(digest, threads))
+    head = s3.head_object(Bucket=bucket, Key=key)
+    etag = head['ETag'].strip('"')
+    if etag != rec['etag'] or head['ContentLength'] != rec['size']:
+        raise ValueError("checksum mismatch for " + key + ", S3 has " + etag + " expected " + rec['etag'])
+    manifest.add(os.path.basename(key), key, rec)
+
+# a compressed upload is always multipart, but the metadata copy of a small one is a
+# single PUT, its ETag then becomes the plain md5
+def sealed_layout(digest, manifest):
+    if manifest.attach and digest.size < upload_engine.SINGLE_PART_LIMIT:
+        digest.part_size = None
+    return digest
+
+# uploader for upload_engine.upload_directory hashing files while they are sent
+def checksum_uploader(manifest):
+    def uploader(s3, bucket, key, path, size, threads):
+        if upload_engine.is_plain(path):
+            # parts sized on the plain file, like upload_engine does
+            digest = Digest(upload_engine.part_size_for(size))
+            secs   = fastq_compress.upload_compressed(s3, bucket, key, path, size, threads,
+                                                      digest.part_size, digest)
+            seal(s3, bucket, key, sealed_layout(digest, manifest), threads, manifest)
+            return secs
+        config = upload_engine.transfer_config_for(size, threads)
+        part_size = config.multipart_chunksize if size >= upload_engine.SINGLE_PART_LIMIT else None
+        digest = Digest(part_size)
+        start  = time.time()
+        with open(path, 'rb') as f:
+            body = HashingReader(f, digest)
+            s3.upload_fileobj(body, bucket, key, Config=config,
+                              Callback=lambda n: transfer_metrics.progress(key, n))
+        if body.hashed != size:
+            raise ValueError("only " + str(body.hashed) + " of " + str(size) + " bytes hashed for " + key)
+        secs = time.time() - start
+        seal(s3, bucket, key, digest, threads, manifest)
+        return secs
+    return uploader
+
+# compare the objects of a project with its manifest, from listings only
+def verify_project(s3, bucket, db, pName):
+    manifest = ChecksumManifest(s3, bucket, db, pName)
+    prefix   = upload_engine.sample_key(db, pName, '')
+    remote   = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            remote[obj['Key']] = (obj['Size'], obj['ETag'].strip('"'))
+
+    bad = []
+    for filename, rec in sorted(manifest.files.items()):
+        obj = remote.pop(rec['key'], None)
+        if obj is None:
+            print("[-] Missing:", filename)
+            bad.append(filename)
+        elif obj != (rec['size'], rec['etag']):
+            print("[-] Changed:", filename, "S3 has", obj[1], "expected", rec['etag'])
+            bad.append(filename)
+    for key in sorted(remote):
+        print("[*] Not in manifest:", os.path.basename(key))
+    for sha, names in duplicates(manifest.files).items():
+        print("[-] Identical content (sha256", sha[:12], "):", ", ".join(names))
+    print("[+]", len(manifest.files) - len(bad), "of", len(manifest.files), "files match the manifest")
+    return not bad
+
+# get arguments
+def get_arguments():
+    # create parser object
+    parser = optparse.OptionParser()
+
+    # add object options
+    parser.add_option('-n', '--project_name', dest='project_name', help='Specify Project Name')
+    parser.add_option('-d', '--database', dest='db', help='Provide Database to use (16s - ITS)')
+
+    # get args
+    (options, arguments) = parser.parse_args()
+
+    # secure empty executions
+    if not options.project_name:
+        parser.error("[-] Please Specify a Project Name, use --help for more info")
+    elif not options.db:
+        parser.error("[-] Please Specify Database to use, use --help for more info")
+
+    #return objects
+    return options
+
+def main():
+    opt = get_arguments()
+    aws_conf = aws_deploy.load_config()
+    ak, sk, rg = aws_clients.credentials(aws_conf)
+    ok = verify_project(aws_clients.client('s3', ak, sk, rg),
+                        aws_conf['aws']['s3_bucket_seqs']['name'], opt.db, opt.project_name)
+    exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
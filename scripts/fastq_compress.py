@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+import os
+import zlib
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import run_trace
+import stream_upload
+import transfer_metrics
+
+###############
+## Constants ##
+###############
+
+MB = 1024 * 1024
+
+# plain input compressed per member, large enough to keep the gzip ratio
+BLOCK_SIZE = 1 * MB
+LEVEL      = 6
+
+# zlib releases the GIL, threads compress on every core
+COMPRESS_THREADS = os.cpu_count() or 1
+
+###############
+## Registry  ##
+###############
+
+# one compression pool for the process, shared by every file being uploaded
+lock = threading.Lock()
+pool = None
+
+###############
+## Functions ##
+###############
+
+def compress_pool():
+    global pool
+    with lock:
+        if pool is None:
+            pool = ThreadPoolExecutor(max_workers=COMPRESS_THREADS, thread_name_prefix='gzip')
+        return pool
+
+# one complete gzip member
+def gzip_member(data, level=LEVEL):
+    comp = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return comp.compress(data) + comp.flush()
+
+# compress a file in parallel blocks, (plain bytes, gzip member) in file order
+def gzip_blocks(f, block_size=BLOCK_SIZE, level=LEVEL):
+    '''
+    The members concatenated are a multi-member gzip file, read
+    unchanged by gzip, zlib and htslib. At most two blocks per
+    compression thread are held in memory.
+    '''
+    ahead  = 2 * COMPRESS_THREADS
+    window = deque()
+    sent   = False
+    for data in stream_upload.iter_chunks(f, block_size):
+        window.append((len(data), compress_pool().submit(gzip_member, data, level)))
+        if len(window) >= ahead:
+            n, fut = window.popleft()
+            sent = True
+            yield n, fut.result()
+    while window:
+        n, fut = window.popleft()
+        sent = True
+        yield n, fut.result()
+    if not sent:
+        # an empty file still becomes a valid gzip file
+        yield 0, gzip_member(b'', level)
+
+# gzip a plain file into a multipart upload, no temporary file
+def compress_upload(s3, bucket, key, path, part_size, digest=None):
+    '''
+    digest, when given, hashes the compressed bytes as sent.
+    Progress is reported in plain bytes, the size the file was
+    registered with. Returns the complete_multipart_upload response.
+    '''
+    def members(f):
+        for n, member in gzip_blocks(f):
+            if digest is not None:
+                digest.update(member)
+            transfer_metrics.progress(key, n)
+            yield member
+
+    with run_trace.span('compress_upload', key=key) as rec, open(path, 'rb') as f:
+        resp = stream_upload.multipart_from_chunks(s3, bucket, key, members(f), part_size)
+        rec['plain'] = os.path.getsize(path)
+    return resp
+
+# uploader for upload_engine.upload_directory, plain .fastq in, .fastq.gz key out
+def upload_compressed(s3, bucket, key, path, size, threads, part_size=stream_upload.PART_SIZE, digest=None):
+    start = time.time()
+    compress_upload(s3, bucket, key, path, part_size, digest)
+    return time.time() - start
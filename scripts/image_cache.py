@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+import os
+import re
+import json
+import time
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+import run_trace
+
+###############
+## Constants ##
+###############
+
+DEFAULT_IMAGE    = 'danova/nextflow-aws:22.04.3'
+DEFAULT_REGISTRY = 'https://registry-1.docker.io'
+IMAGE_CACHE      = '../catalog/images.json'
+HTTP_TIMEOUT     = 10
+KEEP_RUNS        = 50
+
+# manifest lists first, so the digest is the one docker records when pulling the tag
+MANIFEST_TYPES = ', '.join([
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.oci.image.manifest.v1+json',
+])
+
+BEARER_RE = re.compile(r'(\w+)="([^"]*)"')
+
+# serialises writes of the cache file
+lock = threading.Lock()
+
+###############
+## Functions ##
+###############
+
+# read image settings from the aws config, with defaults
+def image_settings(aws_conf):
+    pipeline = aws_conf['aws'].get('pipeline', {})
+    return {
+        'image':    pipeline.get('image', DEFAULT_IMAGE),
+        'registry': pipeline.get('registry', DEFAULT_REGISTRY),
+        'cache':    pipeline.get('image_cache', IMAGE_CACHE),
+    }
+
+# repository and tag of an image reference, without any registry host,
+# official Docker Hub images live under library/
+def parse_image(image):
+    name, _, tag = image.rpartition(':')
+    if not name or '/' in tag:
+        name, tag = image, 'latest'
+    first, _, rest = name.partition('/')
+    if rest and ('.' in first or ':' in first or first == 'localhost'):
+        return rest, tag
+    if '/' not in name:
+        name = 'library/' + name
+    return name, tag
+
+# image reference pinned to a digest, the tag is dropped
+def pinned(image, digest):
+    name, _, last = image.rpartition('/')
+    return (name + '/' if name else '') + last.split(':')[0] + '@' + digest
+
+# anonymous bearer token from a WWW-Authenticate challenge
+def registry_token(challenge):
+    fields = dict(BEARER_RE.findall(challenge))
+    query  = {k: v for k, v in fields.items() if k in ('service', 'scope')}
+    url    = fields['realm'] + '?' + urllib.parse.urlencode(query)
+    with urllib.request.urlopen(url, timeout=HTTP_TIMEOUT) as resp:
+        data = json.load(resp)
+    return data.get('token') or data.get('access_token')
+
+# digest the registry currently serves for repo:tag
+def resolve_digest(registry, repo, tag):
+    url     = registry.rstrip('/') + '/v2/' + repo + '/manifests/' + tag
+    headers = {'Accept': MANIFEST_TYPES}
+    for attempt in (1, 2):
+        req = urllib.request.Request(url, method='HEAD', headers=headers)
+        try:
+            with urllib.request.urlopen(req, timeout=HTTP_TIMEOUT) as resp:
+                return resp.headers['Docker-Content-Digest']
+        except urllib.error.HTTPError as e:
+            challenge = e.headers.get('WWW-Authenticate', '')
+            if e.code != 401 or attempt == 2 or not challenge.startswith('Bearer'):
+                raise
+            headers['Authorization'] = 'Bearer ' + registry_token(challenge)
+
+# local record of resolved digests and the runs that used them
+def load_cache(path):
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except Exception as e:
+        print("[-] Image cache unreadable, starting a new one")
+        print(e)
+        return {}
+
+def save_cache(path, cache):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=1)
+    os.replace(tmp, path)
+
+# image reference and docker pull policy for a run
+def image_for_run(aws_conf, pName, refresh=False):
+    '''
+    The tag is resolved to its current digest and run as image@digest
+    with --pull=missing: instances that already hold it (AMI, pool)
+    skip the registry, a new digest is pulled once.
+    refresh forces --pull=always on the tag.
+    '''
+    settings = image_settings(aws_conf)
+    image    = settings['image']
+    repo, tag = parse_image(image)
+
+    with lock:
+        cache = load_cache(settings['cache'])
+        entry = cache.setdefault(image, {'digest': None, 'runs': []})
+
+        digest = None
+        with run_trace.span('image_resolve', image=image) as rec:
+            try:
+                digest = resolve_digest(settings['registry'], repo, tag)
+            except Exception as e:
+                print("[-] Image digest can not be resolved, using the last known one")
+                print(e)
+            rec['digest'] = digest
+
+        if digest and digest != entry['digest']:
+            print("[+] Image", image, "now", digest, "(was", str(entry['digest']) + ")")
+            entry['digest'] = digest
+            entry['resolved_at'] = time.time()
+        digest = digest or entry['digest']
+
+        if refresh or not digest:
+            ref, pull = image, 'always'
+        else:
+            ref, pull = pinned(image, digest), 'missing'
+
+        entry['runs'] = (entry['runs'] + [{'project': pName, 'digest': digest, 'pull': pull,
+                                           'time': time.time()}])[-KEEP_RUNS:]
+        save_cache(settings['cache'], cache)
+
+    print("[+] Pipeline image:", ref, "(pull", pull + ")")
+    return ref, pull
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+import threading
+from datetime import datetime, timedelta, timezone
+import run_trace
+
+###############
+## Constants ##
+###############
+
+POOL_TAG    = 'nextflow-pool'
+CREATED_TAG = 'nextflow-pool-created'
+
+DEFAULT_SIZE         = 1
+DEFAULT_MAX_AGE_DAYS = 7
+
+# one claim at a time inside this process, other processes are told apart by
+# the state StartInstances reports the instance was in
+claim_lock = threading.Lock()
+
+###############
+## Functions ##
+###############
+
+# read pool settings from the aws config, with defaults
+def pool_settings(aws_conf):
+    pool = aws_conf['aws'].get('pool', {})
+    return {
+        'enabled':      pool.get('enabled', False),
+        'size':         pool.get('size', {}),
+        'max_age_days': pool.get('max_age_days', DEFAULT_MAX_AGE_DAYS),
+    }
+
+# tags that mark an instance as pool member of a role (seqs - pipe)
+def pool_tags(role):
+    return [
+        {'Key': POOL_TAG, 'Value': str(role)},
+        {'Key': CREATED_TAG, 'Value': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')},
+    ]
+
+# instances of the pool for a role in the given states
+def pool_members(ec2_resource, role, states):
+    return list(ec2_resource.instances.filter(Filters=[
+        {'Name': 'tag:' + POOL_TAG, 'Values': [str(role)]},
+        {'Name': 'instance-state-name', 'Values': list(states)},
+    ]))
+
+# creation time stored on the pool tag
+def created_at(instance):
+    for tag in instance.tags or []:
+        if tag['Key'] == CREATED_TAG:
+            return datetime.strptime(tag['Value'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+    return instance.launch_time
+
+# terminate stopped members that are too old or built from another AMI
+def evict_stale(ec2_resource, role, ami_id, max_age_days):
+    limit = datetime.now(timezone.utc) - timedelta(days=max_age_days)
+    kept  = []
+    for instance in pool_members(ec2_resource, role, ['stopped']):
+        if instance.image_id != ami_id or created_at(instance) < limit:
+            print("[x] Evicting stale pool instance", instance.id)
+            instance.terminate()
+        else:
+            kept.append(instance)
+    return kept
+
+# start a stopped pool instance, or launch a new tagged one
+def acquire_instance(ec2_resource, ec2_client, role, ami_id, key_pair_name, sec_group_id,
+                     subnet_id, type, settings, launch, watcher=None):
+    '''
+    launch is the launch_instance_ami function of the calling script,
+    it is only used when the pool has no usable member.
+    '''
+    started = None
+    with claim_lock:
+        candidates = evict_stale(ec2_resource, role, ami_id, settings['max_age_days'])
+        for instance in candidates:
+            # sizing may ask for another type than the pooled ones
+            if instance.instance_type != type:
+                continue
+            try:
+                with run_trace.span('start_instances', instance=instance.id) as rec:
+                    resp = ec2_client.start_instances(InstanceIds=[instance.id])
+                    previous = resp['StartingInstances'][0]['PreviousState']['Name']
+                    rec['previous_state'] = previous
+            except Exception as e:
+                print("[-] Pool instance", instance.id, "can not be started")
+                print(e)
+                continue
+            # starting an instance another process already started does not fail,
+            # only the call that found it stopped owns it
+            if previous != 'stopped':
+                print("[*] Pool instance", instance.id, "claimed by another run (was", previous + ")")
+                continue
+            started = instance
+            break
+
+    if started is None:
+        print("[*] Pool empty, launching from AMI")
+        return launch(ec2_resource, ami_id, key_pair_name, sec_group_id, subnet_id,
+                      ec2_client, type, tags=pool_tags(role), watcher=watcher)
+
+    print("[+] Reusing pool instance")
+    print(" - Instance ID: ", started.id)
+    print("[x] Wait until running")
+    with run_trace.span('wait_until_running', instance=started.id):
+        if watcher:
+            watcher.wait_running(started.id)
+        else:
+            started.wait_until_running()
+    print("[+] Instance started")
+    return started.id
+
+# stop the instance back into the pool, or terminate it when the pool is full
+def release_instance(ec2_resource, instance_id, role, settings):
+    size = settings['size'].get(role, DEFAULT_SIZE)
+    with claim_lock:
+        idle = [i for i in pool_members(ec2_resource, role, ['stopping', 'stopped'])
+                if i.id != instance_id]
+        instance = ec2_resource.Instance(instance_id)
+        if len(idle) < size:
+            with run_trace.span('stop_instance', instance=instance_id):
+                instance.stop()
+            print("[x] Instance Stopped, kept in pool")
+        else:
+            with run_trace.span('terminate_instance', instance=instance_id):
+                instance.terminate()
+            print("[x] Instance Terminated, pool full")
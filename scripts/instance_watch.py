@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+import threading
+import time
+import ssh_ready
+
+###############
+## Constants ##
+###############
+
+POLL_INTERVAL = 5
+DEFAULT_TIMEOUT = 600
+
+# ids per DescribeInstances filter, a filter (unlike InstanceIds)
+# does not fail the whole call on an id that is not visible yet
+MAX_IDS = 200
+
+###############
+## Functions ##
+###############
+
+# polls DescribeInstances for every watched instance in one call
+class InstanceWatcher:
+    '''
+    Shared by all concurrent runs of a process,
+    one poller thread serves every waiter.
+    '''
+    def __init__(self, ec2_client, interval=POLL_INTERVAL):
+        self.ec2      = ec2_client
+        self.interval = interval
+        self.cond     = threading.Condition()
+        self.watched  = set()
+        self.info     = {}
+        self.thread   = None
+
+    # start the poller thread on first use, once whatever the number of callers
+    def ensure_started(self):
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.poll_loop, daemon=True)
+                self.thread.start()
+
+    def poll_loop(self):
+        while True:
+            with self.cond:
+                ids = sorted(self.watched)
+            if ids:
+                try:
+                    self.poll(ids)
+                except Exception as e:
+                    print("[-] DescribeInstances failed")
+                    print(e)
+            time.sleep(self.interval)
+
+    # one batched describe for all watched ids
+    def poll(self, ids):
+        info = {}
+        for i in range(0, len(ids), MAX_IDS):
+            paginator = self.ec2.get_paginator('describe_instances')
+            for page in paginator.paginate(Filters=[{'Name': 'instance-id', 'Values': ids[i:i + MAX_IDS]}]):
+                for res in page['Reservations']:
+                    for ins in res['Instances']:
+                        info[ins['InstanceId']] = {
+                            'state': ins['State']['Name'],
+                            'ip':    ins.get('PublicIpAddress'),
+                        }
+        with self.cond:
+            self.info.update(info)
+            self.cond.notify_all()
+
+    def watch(self, instance_id):
+        with self.cond:
+            self.watched.add(str(instance_id))
+        self.ensure_started()
+
+    # released instances leave the batched describe
+    def unwatch(self, instance_id):
+        with self.cond:
+            self.watched.discard(str(instance_id))
+            self.info.pop(str(instance_id), None)
+
+    # block until predicate(info) holds for the instance
+    def wait_for(self, instance_id, predicate, timeout=DEFAULT_TIMEOUT, cancel=None):
+        instance_id = str(instance_id)
+        self.watch(instance_id)
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                info = self.info.get(instance_id)
+                if info and predicate(info):
+                    return info
+                if info and info['state'] in ('shutting-down', 'terminated'):
+                    raise RuntimeError("instance " + instance_id + " is " + info['state'])
+                if cancel is not None and cancel.is_set():
+                    raise ssh_ready.Cancelled("wait for " + instance_id + " cancelled")
+                left = deadline - time.time()
+                if left <= 0:
+                    raise TimeoutError("instance " + instance_id + " not ready in time")
+                # wake up every poll interval when the wait can be cancelled
+                self.cond.wait(left if cancel is None else min(left, self.interval))
+
+    # wait_until_running() replacement
+    def wait_running(self, instance_id, timeout=DEFAULT_TIMEOUT):
+        return self.wait_for(instance_id, lambda i: i['state'] == 'running', timeout)
+
+    # wait for a running instance with a public ip
+    def public_ip(self, instance_id, timeout=DEFAULT_TIMEOUT, cancel=None):
+        info = self.wait_for(instance_id, lambda i: i['state'] == 'running' and i['ip'], timeout, cancel)
+        return info['ip']
+
+    # current state table, instance id -> state
+    def states(self):
+        with self.cond:
+            return {k: v['state'] for k, v in self.info.items()}
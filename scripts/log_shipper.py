@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+import sys
+import gzip
+import json
+import time
+import optparse
+import threading
+import aws_clients
+import aws_deploy
+import run_trace
+
+###############
+## Constants ##
+###############
+
+DEFAULT_CHUNK_MB      = 8
+DEFAULT_FLUSH_SECONDS = 30
+# chunks kept in memory while S3 is unreachable, the local log still has them
+MAX_PENDING = 16
+
+###############
+## Functions ##
+###############
+
+# read log shipping settings from the aws config, with defaults
+def shipping_settings(aws_conf):
+    logs = aws_conf['aws'].get('logs', {})
+    return {
+        'ship':          logs.get('ship', True),
+        'chunk_bytes':   int(logs.get('chunk_mb', DEFAULT_CHUNK_MB) * 1024 ** 2),
+        'flush_seconds': logs.get('flush_seconds', DEFAULT_FLUSH_SECONDS),
+    }
+
+# s3 prefix of one shipped log
+def stream_prefix(db, pName, name):
+    return str(db)+"/"+str(pName)+"/logs/"+str(name)+"/"
+
+# utc timestamp put in front of every shipped line, sorts as text
+def stamp(t=None):
+    t = time.time() if t is None else t
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(t)) + '.%03dZ' % int(t % 1 * 1000)
+
+# batches remote output into gzip chunks under <db>/<project>/logs/<name>/
+class LogShipper:
+    '''
+    Every chunk is a gzip member on its own, the objects concatenated
+    form the whole log. index.json maps the uncompressed byte offset
+    and time span of each chunk to its key and is rewritten after
+    every chunk, so a log is readable up to the last flush even when
+    the instance or this process dies. Chunks dropped while S3 was
+    unreachable are listed under gaps with the same fields.
+    '''
+    def __init__(self, s3, bucket, db, pName, name, chunk_bytes=DEFAULT_CHUNK_MB * 1024 ** 2,
+                 flush_seconds=DEFAULT_FLUSH_SECONDS):
+        self.s3            = s3
+        self.bucket        = bucket
+        self.prefix        = stream_prefix(db, pName, name)
+        self.project       = pName
+        self.chunk_bytes   = chunk_bytes
+        self.flush_seconds = flush_seconds
+        self.lock          = threading.Lock()
+        self.wake          = threading.Event()
+        self.closed        = False
+        self.buffer        = []
+        self.buffered      = 0
+        self.lines         = 0
+        self.first         = None
+        self.last          = None
+        self.offset        = 0
+        self.pending       = []
+        self.index         = {'prefix': self.prefix, 'chunks': [], 'gaps': [], 'bytes': 0, 'complete': False}
+        self.thread        = threading.Thread(target=self.loop, name='log-shipper', daemon=True)
+        self.thread.start()
+        print("[+] Shipping logs to s3://" + bucket + "/" + self.prefix)
+
+    # sink for remote_exec.run_streamed
+    def write(self, stream, line):
+        now  = stamp()
+        data = (now + ' [' + stream + '] ' + line + '\n').encode('utf-8', 'replace')
+        with self.lock:
+            self.buffer.append(data)
+            self.buffered += len(data)
+            self.lines += 1
+            self.first = self.first or now
+            self.last  = now
+            full = self.buffered >= self.chunk_bytes
+        if full:
+            self.wake.set()
+
+    # close the buffered lines into a chunk waiting for upload
+    def cut(self):
+        with self.lock:
+            if not self.buffer:
+                return
+            data = b''.join(self.buffer)
+            chunk = {'key': self.prefix + '%016d.log.gz' % self.offset, 'offset': self.offset,
+                     'length': len(data), 'lines': self.lines, 'start': self.first, 'end': self.last}
+            self.offset += len(data)
+            self.buffer, self.buffered, self.lines, self.first = [], 0, 0, None
+        self.pending.append((chunk, gzip.compress(data, 6)))
+        if len(self.pending) > MAX_PENDING:
+            dropped, _ = self.pending.pop(0)
+            # the offsets of later chunks stay valid, readers see what is missing
+            self.index['gaps'].append(dropped)
+            print("[-] Log chunk at offset", dropped['offset'], "dropped, S3 unreachable")
+
+    # upload waiting chunks in order, then the index
+    def ship(self):
+        while self.pending:
+            chunk, body = self.pending[0]
+            try:
+                self.s3.put_object(Bucket=self.bucket, Key=chunk['key'], Body=body,
+                                   ContentType='text/plain', ContentEncoding='gzip')
+            except Exception as e:
+                print("[-] Log chunk upload failed, retrying at the next flush")
+                print(e)
+                return False
+            chunk['gz'] = len(body)
+            self.index['chunks'].append(chunk)
+            self.index['bytes'] = chunk['offset'] + chunk['length']
+            self.pending.pop(0)
+            self.save_index()
+        return True
+
+    def save_index(self):
+        try:
+            self.s3.put_object(Bucket=self.bucket, Key=self.prefix + 'index.json',
+                               Body=json.dumps(self.index, indent=1).encode(),
+                               ContentType='application/json')
+        except Exception as e:
+            print("[-] Log index upload failed")
+            print(e)
+
+    def loop(self):
+        while not self.closed:
+            self.wake.wait(self.flush_seconds)
+            self.wake.clear()
+            if self.closed:
+                break
+            self.cut()
+            self.ship()
+
+    # last chunk and a complete index
+    def close(self):
+        self.closed = True
+        self.wake.set()
+        self.thread.join()
+        with run_trace.span('log_ship', project=self.project, prefix=self.prefix) as rec:
+            self.cut()
+            self.index['complete'] = self.ship()
+            self.save_index()
+            rec['bytes'] = self.index['bytes']
+            rec['chunks'] = len(self.index['chunks'])
+        print("[+] Log shipped,", len(self.index['chunks']), "chunks,", self.index['bytes'], "bytes")
+
+# shipper for a remote log, None when shipping is disabled
+def open_shipper(aws_conf, db, pName, kind, label=None):
+    settings = shipping_settings(aws_conf)
+    if not settings['ship']:
+        return None
+    ak, sk, rg = aws_clients.credentials(aws_conf)
+    name = str(kind) + '_' + str(label or pName).replace('#', '_shard') + '_' + time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+    return LogShipper(aws_clients.client('s3', ak, sk, rg), aws_conf['aws']['s3_bucket_seqs']['name'],
+                      db, pName, name, settings['chunk_bytes'], settings['flush_seconds'])
+
+# shipped logs of a project, name -> index
+def list_streams(s3, bucket, db, pName):
+    prefix  = str(db)+"/"+str(pName)+"/logs/"
+    streams = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('/index.json'):
+                name = obj['Key'][len(prefix):-len('/index.json')]
+                streams[name] = json.loads(s3.get_object(Bucket=bucket, Key=obj['Key'])['Body'].read())
+    return streams
+
+# lines of a shipped log, by time range (utc, ISO prefix) or uncompressed byte range
+def fetch_range(s3, bucket, index, since=None, until=None, offset=None, length=None):
+    '''
+    Only the chunks overlapping the range are downloaded.
+    '''
+    end = None if length is None else (offset or 0) + length
+    out = []
+    for chunk in index['chunks']:
+        if since and chunk['end'] < since:
+            continue
+        if until and chunk['start'][:len(until)] > until:
+            continue
+        if offset is not None and chunk['offset'] + chunk['length'] <= offset:
+            continue
+        if end is not None and chunk['offset'] >= end:
+            continue
+        data = gzip.decompress(s3.get_object(Bucket=bucket, Key=chunk['key'])['Body'].read())
+        if offset is not None or end is not None:
+            lo = max(0, (offset or 0) - chunk['offset'])
+            hi = len(data) if end is None else min(len(data), end - chunk['offset'])
+            data = data[lo:hi]
+        if since or until:
+            lines = data.decode('utf-8', 'replace').splitlines(True)
+            data  = ''.join(l for l in lines
+                            if (not since or l[:24] >= since) and (not until or l[:len(until)] <= until)).encode()
+        out.append(data)
+    return b''.join(out)
+
+# get arguments
+def get_arguments():
+    # create parser object
+    parser = optparse.OptionParser(usage='%prog list -n project -d db | fetch -n project -d db -l log [--since t] [--until t] [--offset n --length n]')
+
+    # add object options
+    parser.add_option('-n', '--project_name', dest='project_name', help='Specify Project Name')
+    parser.add_option('-d', '--database', dest='db', help='Provide Database to use (16s - ITS)')
+    parser.add_option('-l', '--log', dest='log', help='Shipped log name, as shown by list')
+    parser.add_option('--since', dest='since', help='First time to fetch, UTC (e.g. 2024-05-01T10:30)')
+    parser.add_option('--until', dest='until', help='Last time to fetch, UTC, matched as a prefix')
+    parser.add_option('--offset', dest='offset', type='int', help='First byte to fetch')
+    parser.add_option('--length', dest='length', type='int', help='Bytes to fetch')
+    parser.add_option('-o', '--output', dest='output', help='Write to this file instead of the console')
+
+    # get args
+    (options, arguments) = parser.parse_args()
+
+    # secure empty executions
+    if not arguments or arguments[0] not in ('list', 'fetch'):
+        parser.error("[-] Please Specify a command (list, fetch), use --help for more info")
+    elif not options.project_name or not options.db:
+        parser.error("[-] Please Specify Project Name and Database, use --help for more info")
+    elif arguments[0] == 'fetch' and not options.log:
+        parser.error("[-] Please Specify the log to fetch, use --help for more info")
+
+    #return objects
+    return options, arguments
+
+def main():
+    opt, args = get_arguments()
+    aws_conf = aws_deploy.load_config()
+    ak, sk, rg = aws_clients.credentials(aws_conf)
+    s3     = aws_clients.client('s3', ak, sk, rg)
+    bucket = aws_conf['aws']['s3_bucket_seqs']['name']
+
+    if args[0] == 'list':
+        print("{:<60} {:>7} {:>5} {:>12}  {:<24} {:<24} {}".format('LOG', 'CHUNKS', 'GAPS', 'BYTES', 'START', 'END', 'COMPLETE'))
+        for name, index in sorted(list_streams(s3, bucket, opt.db, opt.project_name).items()):
+            chunks = index['chunks']
+            print("{:<60} {:>7} {:>5} {:>12}  {:<24} {:<24} {}".format(
+                name, len(chunks), len(index.get('gaps', [])), index['bytes'], chunks[0]['start'] if chunks else '-',
+                chunks[-1]['end'] if chunks else '-', 'yes' if index['complete'] else 'no'))
+        return
+
+    key   = stream_prefix(opt.db, opt.project_name, opt.log) + 'index.json'
+    index = json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+    data  = fetch_range(s3, bucket, index, opt.since, opt.until, opt.offset, opt.length)
+    if opt.output:
+        with open(opt.output, 'wb') as f:
+            f.write(data)
+        print("[+]", len(data), "bytes written to", opt.output)
+    else:
+        sys.stdout.write(data.decode('utf-8', 'replace'))
+
+if __name__ == "__main__":
+    main()
@@ -5,15 +5,35 @@ import optparse
 import boto3
 import paramiko
 import os
+import csv
+import copy
 import time
-from boto3.s3.transfer import TransferConfig
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, wait
+import aws_clients
+import upload_engine
+import upload_sync
+import ssh_ready
+import instance_pool
+import instance_watch
+import run_trace
+import sizing
+import catalog
+import url_stream
+import checksums
+import sharding
+import image_cache
+import transfer_metrics
+import run_history
+import results_fetch
 
 ###############
 ## Functions ##
 ###############
 
-# Get arguments
-def get_arguments():
+# maestro options, shared with the job service
+def make_parser():
     # create parser object
     parser = optparse.OptionParser()
 
@@ -22,19 +42,42 @@ def get_arguments():
     parser.add_option('-d', '--database', dest='db', help='Provide Database to use (16s - ITS)')
     parser.add_option('-s', '--sequences', dest = 'seqs', help = 'Provide File With URL Sequences or path to local directory')
     parser.add_option('-l', '--link', dest='link', help='Provide Gitlab Link. ( https://gitlab.com/dvilanova/16s_amazon )')
-    parser.add_option('-c', '--code', dest = 'code', help = 'Code 1: Upload Sequences - Code 2: Upload Sequences + Run Pipeline - Code 3: Run Pipeline')
+    parser.add_option('-c', '--code', dest = 'code', help = 'Code 1: Upload Sequences - Code 2: Upload Sequences + Run Pipeline - Code 3: Run Pipeline - Code 4: Fetch Results')
+    parser.add_option('--compress_seqs', dest='compress_seqs', action='store_true', default=False, help='Gzip the FileSeqs on the fly while uploading, stored as fileseqs_<project>.txt.gz and expanded on the instance (remote mode)')
+    parser.add_option('--workers', dest='workers', type='int', help='Files uploaded in parallel, default aws.transfer.workers (local mode)')
+    parser.add_option('--max_concurrency', dest='max_concurrency', type='int', help='Global upload concurrency budget shared by all files, default aws.transfer.max_concurrency (local mode)')
+    parser.add_option('--refresh_catalog', dest='refresh_catalog', action='store_true', default=False, help='Refresh the local project catalog from S3 before checking the project')
+    parser.add_option('--pool', dest='pool', action='store_true', default=False, help='Reuse stopped instances from the warm pool instead of launching from the AMI')
+    parser.add_option('--dry_run', dest='dry_run', action='store_true', default=False, help='Show the pipeline sizing decision and time estimate without uploading or launching')
+    parser.add_option('--pipelined', dest='pipelined', action='store_true', default=False, help='Code 2: boot the pipeline instance while the sequences upload')
+    parser.add_option('-b', '--batch', dest='batch', help='Project sheet (CSV with name,db,seqs,code[,link]) to run concurrently')
+    parser.add_option('--max_instances', dest='max_instances', type='int', default=4, help='Instances and local uploads in flight at once in batch mode')
+    parser.add_option('--sync', dest='sync', action='store_true', default=False, help='Skip files already uploaded and resume interrupted uploads (local mode)')
+    parser.add_option('--refresh_image', dest='refresh_image', action='store_true', default=False, help='Code 2/3: pull the pipeline image tag again instead of the cached digest')
+    parser.add_option('--resume', dest='resume', action='store_true', default=False, help='Code 2/3: restore the Nextflow work dir and cache from S3, run with -resume and save them back')
+    parser.add_option('--shards', dest='shards', type='int', default=1, help='Code 2/3: split the samples over N pipeline instances and merge the results')
+    parser.add_option('--fetch_dir', dest='fetch_dir', help='Code 4: local directory for results, default aws.fetch.dest')
+    parser.add_option('--direct', dest='direct', action='store_true', default=False, help='Stream the URLs straight into S3 from this machine, no EC2 instance (remote mode)')
+    return parser
+
+# get arguments
+def get_arguments():
+    parser = make_parser()
 
     # get args
     (options, arguments) = parser.parse_args()
 
-    # secure empty executions
-    if not options.project_name:
+    # secure empty executions, batch mode reads them from the sheet
+    if options.batch:
+        if not os.path.isfile(options.batch):
+            parser.error("[-] Project sheet not found, use --help for more info")
+    elif not options.project_name:
         parser.error("[-] Please Specify a Project Name, use --help for more info")
-    elif not options.db:
+    elif not options.db and options.code != '4':
         parser.error("[-] Please Specify Database to use, use --help for more info")
-    elif not options.seqs:
+    elif not options.seqs and options.code != '4':
         parser.error("[-] Please Introduce path to FILE with Sequences or path to DIR with local seqs, use --help for more info")
-    elif not options.link:
+    elif not options.link and options.code != '4':
         parser.error("[-] Please Specify Link to Gitlab, use --help for more info")
     elif not options.code:
         parser.error("[-] Please Specify Code to use, use --help for more info")
@@ -43,13 +86,15 @@ def get_arguments():
     return options
 
 # main function to upload seqs from file
-def main_uploads():
+def main_uploads(opt=None, watcher=None, aws_conf=None):
     print("[*] Remote upload to S3")
     # parse arguments
-    opt = get_arguments()
+    if opt is None:
+        opt = get_arguments()
 
     # load configuration file
-    aws_conf     = main_upload.load_config()
+    if aws_conf is None:
+        aws_conf = main_upload.load_config()
     ssh_key_file = "../keys/nextflow.pem"
 
     # fetch keys
@@ -77,41 +122,62 @@ def main_uploads():
     aws_ec2_rs = main_upload.resource_aws(access_key, secret_key, region, 'ec2')
 
     # check if project name exists
-    exists = main_upload.folder_exists(aws_s3_cl, opt.db, opt.project_name)
+    exists = main_upload.folder_exists(aws_s3_cl, opt.db, opt.project_name, catalog.open_catalog(aws_conf), opt.refresh_catalog, bucket_sqs)
     
     if exists == True:
         print("[-] Failed to create new dir, project name ", str(opt.project_name), " already created, please use another name or delete project")
         exit
 
     # upload sequences file to to s3
-    main_upload.upload_seqs_s3(opt.seqs, aws_s3_rs, opt.db, opt.project_name)
+    uploaded = main_upload.upload_seqs_s3(opt.seqs, aws_s3_rs, opt.db, opt.project_name, compress=opt.compress_seqs,
+                                          bucket=bucket_sqs)
+    if not uploaded:
+        return False
+
+    # small lists are streamed from here, no instance needed
+    if url_stream.use_direct(opt, aws_conf):
+        direct = url_stream.direct_settings(aws_conf)
+        aws_clients.set_pool_size(direct['concurrency'] * 2)
+        aws_s3_cl = main_upload.client_aws(access_key, secret_key, region, 's3')
+        return url_stream.stream_fileseqs(aws_s3_cl, opt.seqs, bucket_sqs, opt.db, opt.project_name,
+                                          direct['concurrency'], direct['per_host'],
+                                          manifest=checksums.open_manifest(aws_conf, aws_s3_cl, opt.db, opt.project_name))
 
     # launch instance
-    instance_id = main_upload.launch_instance_ami(aws_ec2_rs, ami_id_sqs, key_pair, sg_id, subnet_id, aws_ec2_cl, type)
+    pool = instance_pool.pool_settings(aws_conf)
+    use_pool = opt.pool or pool['enabled']
+    if use_pool:
+        instance_id = instance_pool.acquire_instance(aws_ec2_rs, aws_ec2_cl, 'seqs', ami_id_sqs, key_pair, sg_id, subnet_id, type, pool, main_upload.launch_instance_ami, watcher)
+    else:
+        instance_id = main_upload.launch_instance_ami(aws_ec2_rs, ami_id_sqs, key_pair, sg_id, subnet_id, aws_ec2_cl, type, watcher=watcher)
 
-    # CONNECT to instance
-    print("[*] Waiting for port 22")
-    time.sleep(25)
-    print("[*] .")
-    time.sleep(15)
-    print("[*] ..")
-    time.sleep(10)
-    print("[*]...")
+    # CONNECT to instance once sshd answers
+    ready_timeout, status_checks = ssh_ready.ssh_settings(aws_conf)
+    ssh_ready.wait_instance_ready(aws_ec2_cl, instance_id, ready_timeout, status_checks, watcher)
 
     # connect to instance and upload seqs into s3
-    main_upload.execute_pipe(aws_ec2_cl, ssh_key_file, opt.project_name, opt.db, instance_id, bucket_sqs)
+    done = main_upload.execute_pipe(aws_ec2_cl, ssh_key_file, opt.project_name, opt.db, instance_id, bucket_sqs,
+                                    opt.compress_seqs, aws_conf)
 
-    # terminate instance
-    main_upload.terminate_instance(aws_ec2_rs, instance_id)
+    # terminate instance, or stop it back into the pool
+    if use_pool:
+        instance_pool.release_instance(aws_ec2_rs, instance_id, 'seqs', pool)
+    else:
+        main_upload.terminate_instance(aws_ec2_rs, instance_id)
+    if watcher is not None:
+        watcher.unwatch(instance_id)
+    return done
 
 # main function to upload seqs from local
-def main_uploads2():
+def main_uploads2(opt=None, aws_conf=None):
     print("[*] Local Upload to S3")
-    opt = get_arguments()
+    if opt is None:
+        opt = get_arguments()
     # function upload sequences
     directory = opt.seqs
     # load configuration file
-    aws_conf = main_upload.load_config()
+    if aws_conf is None:
+        aws_conf = main_upload.load_config()
     # fetch params
     db = opt.db
     pName = opt.project_name
@@ -119,28 +185,53 @@ def main_uploads2():
     access_key = aws_conf['aws']['credentials']['access_key']
     secret_key = aws_conf['aws']['credentials']['secret_key']
     region     = aws_conf['aws']['credentials']['region']
-    # create aws s3
+    # shared aws s3, one connection pool sized for all upload workers
+    workers, max_concurrency = upload_engine.transfer_settings(aws_conf, opt)
+    aws_clients.set_pool_size(max_concurrency)
     s3 = main_upload.client_aws(access_key, secret_key, region, 's3')
-    # 
-    config = TransferConfig(max_concurrency=2)
-    # iterate over files in that directory
-    for filename in os.listdir(directory):
-        ff = os.path.join(directory, filename)
-        # checking if it is a file
-        if os.path.isfile(ff):
-            if ff.endswith('.fastq.gz'):
-                with open(ff, 'rb') as f:
-                    filepath = str(db)+"/"+str(pName)+"/backups/sample/"+str(filename)
-                    s3.upload_fileobj(f, bucket_name, filepath, Config=config)  
-                    print("[+] File, ", filename, " uploaded to S3")
+    # upload every .fastq.gz in that directory, plain .fastq gzipped on the way
+    # digests are computed while uploading and kept in a manifest next to the project
+    sums = checksums.open_manifest(aws_conf, s3, db, pName)
+    if opt.sync:
+        result = upload_sync.sync_directory(s3, directory, bucket_name, db, pName,
+                                            workers=workers, max_concurrency=max_concurrency,
+                                            checksum_manifest=sums)
+    else:
+        result = upload_engine.upload_directory(s3, directory, bucket_name, db, pName,
+                                                workers=workers, max_concurrency=max_concurrency,
+                                                uploader=checksums.checksum_uploader(sums) if sums else None)
+    if sums:
+        sums.save()
+    return not result['failed']
 
-# main function to execute nextflow
-def main_pipes():
-    # get arguments
-    opt = get_arguments()
+# instance type and container limits for the project, local input is used when available
+def plan_pipe(opt, aws_conf=None, uploaded=True):
+    '''
+    uploaded=False sizes a fileseqs project whose reads are not in S3 yet.
+    '''
+    if aws_conf is None:
+        aws_conf = main_pipe.load_config()
+    if not uploaded and os.path.isfile(opt.seqs or ''):
+        plan = run_history.plan_fileseqs(aws_conf, opt)
+        sizing.show_plan(opt.project_name, opt.db, plan)
+        return plan
+    access_key, secret_key, region = aws_clients.credentials(aws_conf)
+    s3_clt = aws_clients.client('s3', access_key, secret_key, region)
+    plan = sizing.plan_for_project(aws_conf, s3_clt, opt.db, opt.project_name, directory=opt.seqs)
+    sizing.show_plan(opt.project_name, opt.db, plan)
+    return plan
 
+# launch the pipeline instance and wait until sshd answers
+def provision_pipe(opt, watcher=None, cancel=None, plan=None, launched=None, aws_conf=None):
+    '''
+    Returns the run state used by run_pipe and release_pipe,
+    or None when cancel was set while the instance booted.
+    plan overrides the sizing of the whole project (shards),
+    launched(type) is called with the instance type started.
+    '''
     # load aws-config file
-    aws_conf = main_pipe.load_config()
+    if aws_conf is None:
+        aws_conf = main_pipe.load_config()
 
     access_key = aws_conf['aws']['credentials']['access_key']
     secret_key = aws_conf['aws']['credentials']['secret_key']
@@ -150,56 +241,339 @@ def main_pipes():
     key_pair   = aws_conf['aws']['keys']['key_pair_name']
     sg_id      = aws_conf['aws']['segurity_groups']['id']
     subnet_id  = aws_conf['aws']['subnets']['id']
-    ssh_key_file = "../keys/nextflow.pem"
-    
+
     # create resources & clients
         # ec2
     ec2_res = main_pipe.resource_ec2(access_key, secret_key,region)
     ec2_clt = main_pipe.client_ec2(access_key, secret_key,region)
 
+    # SIZE instance and container from the project input
+    if plan is None:
+        plan = plan_pipe(opt, aws_conf)
+    type = plan['type']
+
     # EXECUTE AMI LAUNCH
-    instance_id = main_pipe.launch_instance_ami(ec2_res, ami_ID, key_pair, sg_id, subnet_id,ec2_clt, type)
+    pool = instance_pool.pool_settings(aws_conf)
+    use_pool = opt.pool or pool['enabled']
+    if use_pool:
+        instance_id = instance_pool.acquire_instance(ec2_res, ec2_clt, 'pipe', ami_ID, key_pair, sg_id, subnet_id, type, pool, main_pipe.launch_instance_ami, watcher)
+    else:
+        instance_id = main_pipe.launch_instance_ami(ec2_res, ami_ID, key_pair, sg_id, subnet_id,ec2_clt, type, watcher=watcher)
+    if launched is not None:
+        launched(type)
+    run = {'ec2_res': ec2_res, 'ec2_clt': ec2_clt, 'instance_id': instance_id,
+           'use_pool': use_pool, 'pool': pool, 'plan': plan, 'watcher': watcher,
+           'resume': main_pipe.resume_enabled(opt, aws_conf), 'image': None, 'aws_conf': aws_conf}
 
-    
-    # CONNECT to instance
-    print("[*] Waiting for port 22")
-    time.sleep(25)
-    print("[*] .")
-    time.sleep(15)
-    print("[*] ..")
-    time.sleep(10)
-    print("[*]...")
-    main_pipe.execute_pipe(ec2_clt, ssh_key_file , opt.project_name, opt.link , opt.db, instance_id)
-    
-    # TERMINATE Instance
-    main_pipe.terminate_instance(ec2_res, instance_id)
+    # from here on the instance is released whatever goes wrong
+    try:
+        run['image'] = image_cache.image_for_run(aws_conf, opt.project_name, opt.refresh_image)
+        # CONNECT to instance once sshd answers
+        ready_timeout, status_checks = ssh_ready.ssh_settings(aws_conf)
+        ssh_ready.wait_instance_ready(ec2_clt, instance_id, ready_timeout, status_checks, watcher, cancel)
+    except ssh_ready.Cancelled:
+        release_pipe(run)
+        return None
+    except BaseException:
+        release_pipe(run)
+        raise
+    return run
 
-# main function to orchestrate pipe
-def main():
+# run nextflow on a provisioned instance
+def run_pipe(run, opt, shard=None):
+    ssh_key_file = "../keys/nextflow.pem"
+    return main_pipe.execute_pipe(run['ec2_clt'], ssh_key_file , opt.project_name, opt.link , opt.db, run['instance_id'],
+                                  run['plan']['memory'], run['plan']['cpus'], shard, run['resume'], run['image'],
+                                  run['aws_conf'])
+
+# TERMINATE Instance, or stop it back into the pool
+def release_pipe(run):
+    if run['use_pool']:
+        instance_pool.release_instance(run['ec2_res'], run['instance_id'], 'pipe', run['pool'])
+    else:
+        main_pipe.terminate_instance(run['ec2_res'], run['instance_id'])
+    if run['watcher'] is not None:
+        run['watcher'].unwatch(run['instance_id'])
+
+# main function to execute nextflow
+def main_pipes(opt=None, watcher=None, launched=None, aws_conf=None):
     # get arguments
-    opt = get_arguments()
-    code = int(opt.code)
+    if opt is None:
+        opt = get_arguments()
+
+    run = provision_pipe(opt, watcher, launched=launched, aws_conf=aws_conf)
+    try:
+        return run_pipe(run, opt)
+    finally:
+        release_pipe(run)
+
+# main function to execute nextflow over opt.shards instances
+def main_pipes_sharded(opt, watcher=None, slots=None, launched=None, aws_conf=None):
+    '''
+    Each shard runs on its own copy of a subset of the samples,
+    results are merged under results/ once every shard succeeded.
+    '''
+    if aws_conf is None:
+        aws_conf = main_pipe.load_config()
+    access_key, secret_key, region = aws_clients.credentials(aws_conf)
+    bucket = aws_conf['aws']['s3_bucket_seqs']['name']
+    s3_clt = aws_clients.client('s3', access_key, secret_key, region)
+
+    samples = sharding.list_samples(s3_clt, bucket, opt.db, opt.project_name)
+    groups  = sharding.split_samples(samples, min(opt.shards, len(samples)))
+    if len(groups) < 2:
+        print("[*] Not enough samples to shard, running a single pipeline")
+        with slots or contextlib.nullcontext():
+            return main_pipes(opt, watcher, launched, aws_conf)
+
+    print("[*] Sharding", len(samples), "samples over", len(groups), "instances")
+    shards = sharding.stage_inputs(s3_clt, bucket, opt.db, opt.project_name, samples, groups)
+
+    # provision, run and release one shard, each holding its own instance slot
+    def run_shard(shard):
+        plan = sizing.plan_for_input(aws_conf, opt.db, shard['bytes'], shard['samples'])
+        print("[+] Shard", shard['index'], ":", shard['samples'], "samples on", plan['type'])
+        with slots or contextlib.nullcontext():
+            with run_trace.span('shard', project=opt.project_name, shard=shard['index']):
+                run = None
+                try:
+                    run = provision_pipe(opt, watcher, plan=plan, launched=launched, aws_conf=aws_conf)
+                    return run_pipe(run, opt, shard)
+                finally:
+                    if run is not None:
+                        release_pipe(run)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=len(shards)) as pool:
+        for shard, fut in [(shard, pool.submit(run_trace.carry(run_shard), shard)) for shard in shards]:
+            try:
+                results.append(fut.result())
+            except Exception as e:
+                print("[-] Shard", shard['index'], "failed")
+                print(e)
+                results.append(False)
+
+    done = all(results)
+    if done:
+        sharding.merge_results(s3_clt, bucket, opt.project_name, shards)
+    else:
+        print("[-]", results.count(False), "shards failed, results left under the shard prefixes")
+    sharding.cleanup(s3_clt, bucket, shards, results=done)
+    return done
+
+# code 2 with the pipeline instance booting while the upload runs
+def run_pipelined(opt, watcher=None, slots=None, phase=None, launched=None, aws_conf=None):
+    '''
+    execute_pipe waits for the upload, the instance is released
+    as soon as the upload fails.
+    '''
     isFile = os.path.isfile(opt.seqs)
+    aws_conf = aws_conf or main_pipe.load_config()
+    slot   = slots or contextlib.nullcontext()
+    phase  = phase or (lambda name: None)
+    started  = threading.Event()
+    finished = threading.Event()
+    failed   = threading.Event()
+
+    def pipeline():
+        # take a slot only once the upload holds its own, so they can not deadlock
+        started.wait()
+        with slot:
+            # the upload has only started, the S3 prefix can not be listed yet
+            run = provision_pipe(opt, watcher, cancel=failed, plan=plan_pipe(opt, aws_conf, uploaded=False),
+                                 launched=launched, aws_conf=aws_conf)
+            if run is None:
+                return False
+            try:
+                finished.wait()
+                if failed.is_set():
+                    print("[-] Upload failed, releasing pipeline instance")
+                    return False
+                phase('pipeline')
+                return run_pipe(run, opt)
+            finally:
+                release_pipe(run)
+
+    uploaded = False
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        fut = pool.submit(run_trace.carry(pipeline))
+        try:
+            # a local upload holds a slot too, see execute_workflow
+            with slot:
+                started.set()
+                phase('upload')
+                uploaded = main_uploads(opt, watcher, aws_conf) if isFile else main_uploads2(opt, aws_conf)
+        except Exception as e:
+            print("[-] Upload failed")
+            print(e)
+            uploaded = False
+        finally:
+            started.set()
+            if not uploaded:
+                failed.set()
+            finished.set()
+        return fut.result() and uploaded
+
+# run the workflow selected by opt.code for one project, and keep it in the run history
+def run_workflow(opt, watcher=None, slots=None, phase=None, aws_conf=None):
+    '''
+    slots caps the instances and local uploads in flight across concurrent runs,
+    phase(name) is called when the run enters a new phase.
+    aws_conf is loaded once here and shared by every step of the run.
+    '''
+    if aws_conf is None:
+        aws_conf = main_pipe.load_config()
+    if opt.dry_run or int(opt.code) not in (1, 2, 3):
+        return execute_workflow(opt, watcher, slots, phase, aws_conf)
+    timer = run_history.PhaseTimer(phase)
+    ok = False
+    try:
+        # instance and ssh spans carry no project of their own
+        with run_trace.tagged(project=opt.project_name):
+            ok = execute_workflow(opt, watcher, slots, timer, aws_conf)
+        return ok
+    finally:
+        try:
+            run_history.record_workflow(opt, timer, ok, aws_conf)
+        except Exception as e:
+            print("[-] Run history not updated")
+            print(e)
+
+def execute_workflow(opt, watcher, slots, phase, aws_conf):
+    code = int(opt.code)
+    isFile = os.path.isfile(opt.seqs or '')
+    slot  = slots or contextlib.nullcontext()
+    phase = phase or (lambda name: None)
+    # the PhaseTimer of run_workflow keeps the instance types launched
+    launched = getattr(phase, 'launched', None)
     # execute
+    if code not in (1, 2, 3, 4):
+        print("[-] Specify 1, 2, 3 or 4 for Code Parameter")
+        return False
+    if opt.dry_run:
+        if code != 4:
+            run_history.plan_project(aws_conf, opt)
+        return True
+    if code == 4:
+        print("[x] Fetch Results Workflow")
+        phase('fetch')
+        return results_fetch.main_fetch(opt, aws_conf)
     if code == 1:
         print("[x] Upload Workflow")
-        if isFile:
-            main_uploads()
-        else:
-            main_uploads2()
     elif code == 2:
         print("[x] Upload + Run Workflow")
-        if isFile:
-            main_uploads()
-            main_pipes()
-        else:
-            main_uploads2()
-            main_pipes()
-    elif code == 3:
-        print("[x] Run Workflow")
-        main_pipes()
+        if opt.pipelined and opt.shards > 1:
+            print("[*] Sharded runs start once the upload is done, --pipelined ignored")
+        elif opt.pipelined:
+            return run_pipelined(opt, watcher, slots, phase, launched, aws_conf)
     else:
-        print("[-] Specify 1 or 2 for Code Parameter")
+        print("[x] Run Workflow")
+
+    done = True
+    if code in (1, 2):
+        # local uploads share the uplink of this machine, the slots bound them like instances
+        with slot:
+            phase('upload')
+            done = main_uploads(opt, watcher, aws_conf) if isFile else main_uploads2(opt, aws_conf)
+    if code in (2, 3):
+        if opt.shards > 1:
+            phase('pipeline')
+            return main_pipes_sharded(opt, watcher, slots, launched, aws_conf) and done
+        with slot:
+            phase('pipeline')
+            done = main_pipes(opt, watcher, launched, aws_conf) and done
+    return done
+
+# read project sheet (name, db, seqs, code[, link])
+def read_sheet(path, opt):
+    projects = []
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            p = copy.copy(opt)
+            p.project_name = row['name'].strip()
+            p.db   = row['db'].strip()
+            p.seqs = row['seqs'].strip()
+            p.code = row['code'].strip()
+            p.link = (row.get('link') or '').strip() or opt.link
+            if not p.link:
+                raise ValueError("no Gitlab link for project " + p.project_name)
+            if p.project_name in [q.project_name for q in projects]:
+                raise ValueError("project " + p.project_name + " listed twice")
+            projects.append(p)
+    return projects
+
+# print one line per project and the instance states
+def print_status_table(status, watcher):
+    now = time.time()
+    print("")
+    print("{:<25} {:<5} {:<10} {:>9}  {}".format('PROJECT', 'CODE', 'PHASE', 'ELAPSED', 'ERROR'))
+    for name, st in status.items():
+        if st['start'] is None:
+            elapsed = '-'
+        else:
+            elapsed = str(int((st['end'] or now) - st['start'])) + 's'
+        print("{:<25} {:<5} {:<10} {:>9}  {}".format(name, st['code'], st['phase'], elapsed, st['error']))
+    counts = {}
+    for state in watcher.states().values():
+        counts[state] = counts.get(state, 0) + 1
+    print(" - Instances:", ", ".join(str(v) + " " + k for k, v in sorted(counts.items())) or "none")
+    print("")
+
+# main function to run every project of a sheet concurrently
+def main_batch(opt, interval=30):
+    projects = read_sheet(opt.batch, opt)
+    print("[*] Batch of", len(projects), "projects, at most", opt.max_instances, "instances or local uploads in flight")
+
+    aws_conf   = main_upload.load_config()
+    access_key = aws_conf['aws']['credentials']['access_key']
+    secret_key = aws_conf['aws']['credentials']['secret_key']
+    region     = aws_conf['aws']['credentials']['region']
+
+    # one poller describes all instances of the batch
+    watcher = instance_watch.InstanceWatcher(main_upload.client_aws(access_key, secret_key, region, 'ec2'))
+    slots   = threading.BoundedSemaphore(max(1, opt.max_instances))
+    status  = {p.project_name: {'code': p.code, 'phase': 'queued', 'start': None, 'end': None, 'error': ''}
+               for p in projects}
+
+    def run(p):
+        st = status[p.project_name]
+        st['start'] = time.time()
+        def phase(name):
+            st['phase'] = name
+        try:
+            ok = run_workflow(p, watcher, slots, phase, aws_conf)
+            st['phase'] = 'done' if ok else 'failed'
+        except Exception as e:
+            st['phase'] = 'failed'
+            st['error'] = str(e)[:60]
+            print("[-] Project", p.project_name, "failed")
+            print(e)
+        st['end'] = time.time()
+
+    with ThreadPoolExecutor(max_workers=len(projects) or 1) as pool:
+        pending = [pool.submit(run_trace.carry(run), p) for p in projects]
+        while pending:
+            _, pending = wait(pending, timeout=interval)
+            print_status_table(status, watcher)
+
+    return all(st['phase'] == 'done' for st in status.values())
+
+# main function to orchestrate pipe
+def main():
+    # get arguments
+    opt = get_arguments()
+    run_trace.start(opt.project_name or 'batch')
+    # size shared connection pools before the first client is created
+    aws_conf = main_upload.load_config()
+    aws_clients.set_pool_size(upload_engine.transfer_settings(aws_conf, opt)[1])
+    transfer_metrics.start(aws_conf)
+    try:
+        if opt.batch:
+            main_batch(opt)
+        else:
+            run_workflow(opt, aws_conf=aws_conf)
+    finally:
+        transfer_metrics.stop()
 
 
 ####################
@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import sqlite3
+import optparse
+import threading
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import aws_clients
+import aws_deploy
+import instance_watch
+import maestro
+import run_trace
+import transfer_metrics
+import upload_engine
+
+###############
+## Constants ##
+###############
+
+JOBS_PATH       = '../catalog/jobs.db'
+DEFAULT_PORT    = 8750
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_INSTANCES = 4
+# idle workers look for new jobs at least this often
+POLL_SECONDS    = 5
+
+STATES   = ('queued', 'running', 'done', 'failed', 'cancelled')
+REQUIRED = ('project_name', 'db', 'seqs', 'code', 'link')
+# code 4 only fetches the results of a project
+REQUIRED_FETCH = ('project_name', 'code')
+# maestro options a job can not set
+EXCLUDED = ('batch', 'max_instances')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+    project_name TEXT,
+    db           TEXT,
+    seqs         TEXT,
+    code         TEXT,
+    link         TEXT,
+    options      TEXT,
+    state        TEXT,
+    phase        TEXT,
+    attempts     INTEGER DEFAULT 0,
+    error        TEXT,
+    submitted_at REAL,
+    started_at   REAL,
+    finished_at  REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+'''
+
+###############
+## Functions ##
+###############
+
+# read service settings from the aws config, with defaults
+def service_settings(aws_conf):
+    service = aws_conf['aws'].get('service', {})
+    return {
+        'path':          service.get('path', JOBS_PATH),
+        'port':          service.get('port', DEFAULT_PORT),
+        'workers':       service.get('workers', DEFAULT_WORKERS),
+        'max_instances': service.get('max_instances', DEFAULT_MAX_INSTANCES),
+    }
+
+# persistent job queue, every state change is written before it takes effect
+class JobQueue:
+    def __init__(self, path=JOBS_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self.connect() as con:
+            con.executescript(SCHEMA)
+
+    def connect(self):
+        con = sqlite3.connect(self.path, timeout=30)
+        con.row_factory = sqlite3.Row
+        return con
+
+    def submit(self, job):
+        with self.connect() as con:
+            cur = con.execute('INSERT INTO jobs (project_name, db, seqs, code, link, options, state, submitted_at) '
+                              'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                              [job.get(k) for k in REQUIRED] + [json.dumps(job.get('options', {})), 'queued', time.time()])
+            return cur.lastrowid
+
+    def get(self, job_id):
+        with self.connect() as con:
+            row = con.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return job_dict(row) if row else None
+
+    def listing(self, state=None, limit=100):
+        with self.connect() as con:
+            if state:
+                rows = con.execute('SELECT * FROM jobs WHERE state = ? ORDER BY id DESC LIMIT ?', (state, limit))
+            else:
+                rows = con.execute('SELECT * FROM jobs ORDER BY id DESC LIMIT ?', (limit,))
+            return [job_dict(r) for r in rows]
+
+    # oldest queued job, now running
+    def claim(self):
+        with self.lock, self.connect() as con:
+            row = con.execute("SELECT * FROM jobs WHERE state = 'queued' ORDER BY id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            con.execute("UPDATE jobs SET state = 'running', phase = 'starting', attempts = attempts + 1, "
+                        "error = NULL, started_at = ?, finished_at = NULL WHERE id = ?", (time.time(), row['id']))
+        return self.get(row['id'])
+
+    def set_phase(self, job_id, phase):
+        with self.connect() as con:
+            con.execute('UPDATE jobs SET phase = ? WHERE id = ?', (phase, job_id))
+
+    def finish(self, job_id, state, error=None):
+        with self.connect() as con:
+            con.execute('UPDATE jobs SET state = ?, error = ?, finished_at = ? WHERE id = ?',
+                        (state, error, time.time(), job_id))
+
+    # only queued jobs, a running workflow is not interrupted
+    def cancel(self, job_id):
+        with self.lock, self.connect() as con:
+            cur = con.execute("UPDATE jobs SET state = 'cancelled', finished_at = ? WHERE id = ? AND state = 'queued'",
+                              (time.time(), job_id))
+            return cur.rowcount == 1
+
+    # jobs left running by a stopped service go back to the queue
+    def requeue_interrupted(self):
+        with self.connect() as con:
+            cur = con.execute("UPDATE jobs SET state = 'queued', phase = 'interrupted' WHERE state = 'running'")
+            return cur.rowcount
+
+def job_dict(row):
+    job = dict(row)
+    job['options'] = json.loads(job['options'] or '{}')
+    return job
+
+# maestro options of a job, parser defaults for everything it does not set
+def job_options(job):
+    opt = maestro.make_parser().get_default_values()
+    for key, value in job['options'].items():
+        setattr(opt, key, value)
+    for key in REQUIRED:
+        setattr(opt, key, job[key])
+    return opt
+
+# fields a job of this code must set
+def required(job):
+    return REQUIRED_FETCH if str(job.get('code')) == '4' else REQUIRED
+
+# reject jobs the workflow would fail on
+def validate(job):
+    missing = [k for k in required(job) if not job.get(k)]
+    if missing:
+        return "missing " + ", ".join(missing)
+    if str(job['code']) not in ('1', '2', '3', '4'):
+        return "code must be 1, 2, 3 or 4"
+    known = vars(maestro.make_parser().get_default_values())
+    unknown = [k for k in job.get('options', {}) if k not in known or k in REQUIRED or k in EXCLUDED]
+    if unknown:
+        return "unknown options " + ", ".join(sorted(unknown))
+    wrong = option_errors(job.get('options', {}))
+    if wrong:
+        return "wrong option types " + ", ".join(wrong)
+    return None
+
+# options whose value is not of the type make_parser declares, as dest (type)
+def option_errors(options):
+    wrong = []
+    for option in maestro.make_parser().option_list:
+        if option.dest not in options:
+            continue
+        value = options[option.dest]
+        if option.action in ('store_true', 'store_false'):
+            kind, ok = 'bool', isinstance(value, bool)
+        elif option.type == 'int':
+            # JSON true and false are ints to python
+            kind, ok = 'int', isinstance(value, int) and not isinstance(value, bool)
+        else:
+            kind, ok = 'string', isinstance(value, str)
+        if not ok:
+            wrong.append(option.dest + ' (' + kind + ')')
+    return sorted(wrong)
+
+# runs queued jobs with warm clients, one workflow per worker thread
+class MaestroService:
+    def __init__(self, aws_conf, queue, workers, max_instances):
+        self.queue   = queue
+        self.workers = max(1, workers)
+        self.wake    = threading.Event()
+        self.stop    = threading.Event()
+        self.threads = []
+
+        access_key, secret_key, region = aws_clients.credentials(aws_conf)
+        # size shared connection pools before the first client is created
+        aws_clients.set_pool_size(upload_engine.transfer_settings(aws_conf, None)[1] * self.workers)
+        aws_clients.client('s3', access_key, secret_key, region)
+        # one poller describes the instances of every job
+        self.watcher = instance_watch.InstanceWatcher(aws_clients.client('ec2', access_key, secret_key, region))
+        self.slots   = threading.BoundedSemaphore(max(1, max_instances))
+
+    def start(self):
+        n = self.queue.requeue_interrupted()
+        if n:
+            print("[*]", n, "interrupted jobs queued again")
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.loop, name='job-worker-' + str(i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        print("[+] Job service running,", self.workers, "workers")
+
+    def notify(self):
+        self.wake.set()
+
+    def loop(self):
+        while not self.stop.is_set():
+            job = self.queue.claim()
+            if job is None:
+                self.wake.wait(POLL_SECONDS)
+                self.wake.clear()
+                continue
+            self.run_job(job)
+
+    # every job traces to a file of its own, spans of the service itself stay in the service trace
+    def run_job(self, job):
+        print("[+] Job", job['id'], "started (", job['project_name'], ", code", job['code'], ")")
+        trace = run_trace.RunTrace('job' + str(job['id']) + '_' + str(job['project_name']))
+        print("[+] Tracing job", job['id'], "to", trace.path)
+        try:
+            with run_trace.use(trace):
+                # read once, every step of the job sees the same config
+                aws_conf = aws_deploy.load_config()
+                ok = maestro.run_workflow(job_options(job), self.watcher, self.slots,
+                                          lambda name: self.queue.set_phase(job['id'], name), aws_conf)
+            self.queue.finish(job['id'], 'done' if ok else 'failed')
+        except Exception as e:
+            print("[-] Job", job['id'], "failed")
+            print(e)
+            self.queue.finish(job['id'], 'failed', str(e)[:500])
+        print("[+] Job", job['id'], "finished:", self.queue.get(job['id'])['state'])
+
+    # running jobs finish first, queued ones wait for the next start
+    def shutdown(self):
+        self.stop.set()
+        self.wake.set()
+        print("[*] Waiting for running jobs, interrupt again to abandon them")
+        for thread in self.threads:
+            thread.join()
+
+# http handler of the job api
+def handler_for(service):
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, code, data):
+            body = json.dumps(data).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def job_id(self):
+            try:
+                return int(self.path.strip('/').split('/')[1])
+            except (IndexError, ValueError):
+                return None
+
+        def do_GET(self):
+            path, _, query = self.path.partition('?')
+            parts = path.strip('/').split('/')
+            if parts == ['jobs']:
+                state = dict(q.split('=', 1) for q in query.split('&') if '=' in q).get('state')
+                self.reply(200, service.queue.listing(state))
+            elif len(parts) == 2 and parts[0] == 'jobs' and self.job_id() is not None:
+                job = service.queue.get(self.job_id())
+                if job:
+                    self.reply(200, job)
+                else:
+                    self.reply(404, {'error': 'no such job'})
+            else:
+                self.reply(404, {'error': 'not found'})
+
+        def do_POST(self):
+            parts = self.path.strip('/').split('/')
+            if parts == ['jobs']:
+                try:
+                    job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                except ValueError:
+                    self.reply(400, {'error': 'body is not JSON'})
+                    return
+                error = validate(job)
+                if error:
+                    self.reply(400, {'error': error})
+                    return
+                job_id = service.queue.submit(job)
+                service.notify()
+                self.reply(201, {'id': job_id, 'state': 'queued'})
+            elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'cancel' and self.job_id() is not None:
+                if service.queue.cancel(self.job_id()):
+                    self.reply(200, {'id': self.job_id(), 'state': 'cancelled'})
+                else:
+                    self.reply(409, {'error': 'only queued jobs can be cancelled'})
+            else:
+                self.reply(404, {'error': 'not found'})
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+# run the service until interrupted
+def serve(aws_conf, port=None, workers=None):
+    settings = service_settings(aws_conf)
+    port     = port or settings['port']
+    run_trace.start('service')
+    transfer_metrics.start(aws_conf)
+    service = MaestroService(aws_conf, JobQueue(settings['path']), workers or settings['workers'],
+                             settings['max_instances'])
+    server  = ThreadingHTTPServer(('127.0.0.1', int(port)), handler_for(service))
+    service.start()
+    print("[+] Job API on http://127.0.0.1:" + str(port) + "/jobs")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+        transfer_metrics.stop()
+
+###############
+##  Client   ##
+###############
+
+# call the job api, returns (status, data)
+def api(port, method, path, data=None):
+    body = json.dumps(data).encode() if data is not None else None
+    req  = urllib.request.Request('http://127.0.0.1:' + str(port) + path, data=body, method=method,
+                                  headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            return resp.status, json.load(resp)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+def print_jobs(jobs):
+    now = time.time()
+    print("{:<5} {:<25} {:<4} {:<5} {:<10} {:<10} {:>9}  {}".format(
+        'ID', 'PROJECT', 'DB', 'CODE', 'STATE', 'PHASE', 'ELAPSED', 'ERROR'))
+    for job in jobs:
+        if job['started_at'] is None:
+            elapsed = '-'
+        else:
+            elapsed = str(int((job['finished_at'] or now) - job['started_at'])) + 's'
+        print("{:<5} {:<25} {:<4} {:<5} {:<10} {:<10} {:>9}  {}".format(
+            job['id'], job['project_name'], job['db'], job['code'], job['state'], job['phase'] or '-',
+            elapsed, (job['error'] or '')[:60]))
+
+# extra maestro options given as key=value, values parsed as JSON when possible
+def parse_options(pairs):
+    options = {}
+    for pair in pairs or []:
+        key, _, value = pair.partition('=')
+        try:
+            options[key] = json.loads(value) if value else True
+        except ValueError:
+            options[key] = value
+    return options
+
+# get arguments
+def get_arguments():
+    # create parser object
+    parser = optparse.OptionParser(usage='%prog serve | submit -n project -d db -s seqs -c code -l link [-o key=value] | status [id] | cancel id')
+
+    # add object options
+    parser.add_option('-n', '--project_name', dest='project_name', help='Specify Project Name')
+    parser.add_option('-d', '--database', dest='db', help='Provide Database to use (16s - ITS)')
+    parser.add_option('-s', '--sequences', dest='seqs', help='Provide File With URL Sequences or path to local directory')
+    parser.add_option('-l', '--link', dest='link', help='Provide Gitlab Link. ( https://gitlab.com/dvilanova/16s_amazon )')
+    parser.add_option('-c', '--code', dest='code', help='Code 1: Upload Sequences - Code 2: Upload Sequences + Run Pipeline - Code 3: Run Pipeline - Code 4: Fetch Results')
+    parser.add_option('-o', '--option', dest='options', action='append', help='Extra maestro option as dest=value (e.g. shards=2, sync=true), repeatable')
+    parser.add_option('-p', '--port', dest='port', type='int', help='Job API port, default aws.service.port')
+    parser.add_option('-w', '--workers', dest='workers', type='int', help='Jobs run at once (serve), default aws.service.workers')
+    parser.add_option('--state', dest='state', help='Only list jobs in this state (status)')
+
+    # get args
+    (options, arguments) = parser.parse_args()
+
+    # secure empty executions
+    if not arguments or arguments[0] not in ('serve', 'submit', 'status', 'cancel'):
+        parser.error("[-] Please Specify a command (serve, submit, status, cancel), use --help for more info")
+    elif arguments[0] == 'submit' and not all(getattr(options, k) for k in required(vars(options))):
+        parser.error("[-] Please Specify Project Name, Database, Sequences, Code and Link (code 4: Project Name), use --help for more info")
+    elif arguments[0] == 'cancel' and len(arguments) != 2:
+        parser.error("[-] Please Specify the job id to cancel, use --help for more info")
+    elif options.state and options.state not in STATES:
+        parser.error("[-] Unknown job state, use --help for more info")
+
+    #return objects
+    return options, arguments
+
+def main():
+    opt, args = get_arguments()
+    aws_conf = aws_deploy.load_config()
+    port     = opt.port or service_settings(aws_conf)['port']
+    command  = args[0]
+
+    if command == 'serve':
+        serve(aws_conf, port, opt.workers)
+        return
+
+    if command == 'submit':
+        job = {k: getattr(opt, k) for k in REQUIRED}
+        # the service resolves paths from its own directory
+        if job['seqs'] and os.path.exists(job['seqs']):
+            job['seqs'] = os.path.abspath(job['seqs'])
+        job['options'] = parse_options(opt.options)
+        status, data = api(port, 'POST', '/jobs', job)
+    elif command == 'cancel':
+        status, data = api(port, 'POST', '/jobs/' + args[1] + '/cancel')
+    elif len(args) > 1:
+        status, data = api(port, 'GET', '/jobs/' + args[1])
+    else:
+        status, data = api(port, 'GET', '/jobs' + ('?state=' + opt.state if opt.state else ''))
+
+    if status >= 400:
+        print("[-]", data.get('error'))
+    elif command == 'status':
+        print_jobs(data if isinstance(data, list) else [data])
+    else:
+        print("[+] Job", data['id'], data['state'])
+
+if __name__ == "__main__":
+    main()
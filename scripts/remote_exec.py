@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import codecs
+import logging
+from logging.handlers import RotatingFileHandler
+
+###############
+## Constants ##
+###############
+
+LOG_DIR = '../logs'
+
+RECV_SIZE   = 32 * 1024
+MAX_LINE    = 64 * 1024
+LOG_BYTES   = 10 * 1024 * 1024
+LOG_BACKUPS = 5
+IDLE_WAIT   = 0.05
+
+###############
+## Functions ##
+###############
+
+# local log file for the remote output of a project
+def log_path_for(kind, pName):
+    return os.path.join(LOG_DIR, str(kind) + '_' + str(pName) + '.log')
+
+# rotating file logger, one per log path
+def get_logger(path, max_bytes=LOG_BYTES, backups=LOG_BACKUPS):
+    logger = logging.getLogger('remote_exec.' + os.path.abspath(path))
+    if not logger.handlers:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+# splits a byte stream into lines, never holding more than max_line bytes
+class LineSplitter:
+    def __init__(self, emit, max_line=MAX_LINE):
+        self.emit     = emit
+        self.max_line = max_line
+        self.decoder  = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.partial  = ''
+
+    def feed(self, data):
+        text  = self.partial + self.decoder.decode(data)
+        lines = text.split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.emit(line.rstrip('\r'))
+        # a very long line without newline is flushed in pieces
+        while len(self.partial) >= self.max_line:
+            self.emit(self.partial[:self.max_line])
+            self.partial = self.partial[self.max_line:]
+
+    def close(self):
+        rest = self.partial + self.decoder.decode(b'', final=True)
+        if rest:
+            self.emit(rest)
+        self.partial = ''
+
+# run a command and stream stdout/stderr line by line as they arrive
+def run_streamed(client, command, log_path=None, prefix='', sinks=()):
+    '''
+    client is a connected paramiko.SSHClient.
+    Lines go to the console, to the rotating log file and to
+    every sink(stream, line).
+    Returns the remote exit status.
+    '''
+    logger = get_logger(log_path) if log_path else None
+
+    def emitter(stream, console):
+        def emit(line):
+            console.write(prefix + line + '\n')
+            console.flush()
+            if logger:
+                logger.info('[' + stream + '] ' + line)
+            for sink in sinks:
+                sink(stream, line)
+        return emit
+
+    out = LineSplitter(emitter('stdout', sys.stdout))
+    err = LineSplitter(emitter('stderr', sys.stderr))
+
+    chan = client.get_transport().open_session()
+    chan.exec_command(command)
+
+    # read both channels as data arrives, until the command exits and both are drained
+    while True:
+        busy = False
+        if chan.recv_ready():
+            out.feed(chan.recv(RECV_SIZE))
+            busy = True
+        if chan.recv_stderr_ready():
+            err.feed(chan.recv_stderr(RECV_SIZE))
+            busy = True
+        if not busy:
+            if chan.exit_status_ready() and not chan.recv_ready() and not chan.recv_stderr_ready():
+                break
+            time.sleep(IDLE_WAIT)
+
+    out.close()
+    err.close()
+    status = chan.recv_exit_status()
+    chan.close()
+    if logger:
+        logger.info('[exit] ' + str(status) + ' ' + command)
+    for sink in sinks:
+        sink('exit', str(status) + ' ' + command)
+    return status
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import optparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import aws_clients
+import aws_deploy
+import run_trace
+import sharding
+
+###############
+## Constants ##
+###############
+
+MB = 1024 ** 2
+
+DEFAULT_DEST         = '../results'
+DEFAULT_WORKERS      = 8
+# objects above the threshold are fetched as parallel ranged GETs
+DEFAULT_THRESHOLD_MB = 64
+DEFAULT_RANGE_MB     = 16
+RANGE_WORKERS        = 4
+READ_SIZE            = 1 * MB
+
+CACHE_FILE = '.fetch_cache.json'
+
+###############
+## Functions ##
+###############
+
+# read fetch settings from the aws config, with defaults
+def fetch_settings(aws_conf):
+    fetch = aws_conf['aws'].get('fetch', {})
+    return {
+        # the pipeline writes its results next to the sequences
+        'bucket':    fetch.get('bucket', aws_conf['aws']['s3_bucket_seqs']['name']),
+        'dest':      fetch.get('dest', DEFAULT_DEST),
+        'workers':   fetch.get('workers', DEFAULT_WORKERS),
+        'threshold': int(fetch.get('threshold_mb', DEFAULT_THRESHOLD_MB) * MB),
+        'range':     int(fetch.get('range_mb', DEFAULT_RANGE_MB) * MB),
+    }
+
+# s3 prefix the pipeline writes the results of a project to
+def results_prefix(pName):
+    return sharding.RESULTS_DB+"/"+str(pName)+"/results/"
+
+# relative path -> (key, size, etag) of every result object
+def list_results(s3, bucket, pName):
+    prefix  = results_prefix(pName)
+    objects = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            rel = obj['Key'][len(prefix):]
+            if rel and not rel.endswith('/'):
+                objects[rel] = (obj['Key'], obj['Size'], obj['ETag'].strip('"'))
+    return objects
+
+# local path of a result, None when the key would land outside dest
+def local_path(dest, rel):
+    root = os.path.abspath(dest)
+    path = os.path.normpath(os.path.join(root, rel))
+    if os.path.isabs(rel) or path == root or os.path.commonpath([root, path]) != root:
+        return None
+    return path
+
+# size and etag of every file fetched before, by relative path
+def load_cache(dest):
+    path = os.path.join(dest, CACHE_FILE)
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except Exception as e:
+        print("[-] Fetch cache unreadable, every file is checked again")
+        print(e)
+        return {}
+
+def save_cache(dest, cache):
+    path = os.path.join(dest, CACHE_FILE)
+    tmp  = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=1)
+    os.replace(tmp, path)
+
+# a cached file counts only while the local copy still has its size
+def is_current(cache, dest, rel, size, etag):
+    entry = cache.get(rel)
+    if not entry or entry['size'] != size or entry['etag'] != etag:
+        return False
+    local = local_path(dest, rel)
+    return os.path.isfile(local) and os.path.getsize(local) == size
+
+# single GET streamed to a file
+def get_whole(s3, bucket, key, etag, tmp):
+    body = s3.get_object(Bucket=bucket, Key=key, IfMatch=etag)['Body']
+    with open(tmp, 'wb') as f:
+        for chunk in iter(lambda: body.read(READ_SIZE), b''):
+            f.write(chunk)
+
+# parallel ranged GETs written in place, IfMatch keeps all ranges on one version
+def get_ranges(s3, bucket, key, size, etag, tmp, range_size):
+    with open(tmp, 'wb') as f:
+        f.truncate(size)
+
+    def part(start):
+        end  = min(start + range_size, size) - 1
+        body = s3.get_object(Bucket=bucket, Key=key, IfMatch=etag,
+                             Range='bytes=' + str(start) + '-' + str(end))['Body']
+        with open(tmp, 'r+b') as f:
+            f.seek(start)
+            for chunk in iter(lambda: body.read(READ_SIZE), b''):
+                f.write(chunk)
+
+    with ThreadPoolExecutor(max_workers=RANGE_WORKERS) as pool:
+        list(pool.map(part, range(0, size, range_size)))
+
+# download one object next to its final path, then move it in place
+def download(s3, bucket, key, size, etag, path, threshold, range_size):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.part'
+    try:
+        if size > threshold:
+            get_ranges(s3, bucket, key, size, etag, tmp, range_size)
+        else:
+            get_whole(s3, bucket, key, etag, tmp)
+        if os.path.getsize(tmp) != size:
+            raise IOError("short download of " + key + ": " + str(os.path.getsize(tmp)) + " of " + str(size) + " bytes")
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+# fetch new and changed results of a project into dest/<project>/
+def fetch_results(s3, bucket, pName, dest, workers=DEFAULT_WORKERS,
+                  threshold=DEFAULT_THRESHOLD_MB * MB, range_size=DEFAULT_RANGE_MB * MB):
+    '''
+    Files whose size and ETag match the cache are skipped, so a
+    fetch repeated while the pipeline runs moves only new outputs.
+    Returns (fetched, skipped, failed).
+    '''
+    dest  = os.path.join(dest, str(pName))
+    os.makedirs(dest, exist_ok=True)
+    cache = load_cache(dest)
+    lock  = threading.Lock()
+
+    with run_trace.span('fetch_list', project=pName) as rec:
+        objects = list_results(s3, bucket, pName)
+        rec['objects'] = len(objects)
+    # keys with .. or a leading / must not write outside dest
+    unsafe = sorted(rel for rel in objects if local_path(dest, rel) is None)
+    for rel in unsafe:
+        print("[-] Result key outside", dest + ", not fetched:", objects.pop(rel)[0])
+    todo = {rel: obj for rel, obj in objects.items() if not is_current(cache, dest, rel, obj[1], obj[2])}
+    print("[+]", len(objects), "result objects,", len(todo), "to fetch (",
+          round(sum(o[1] for o in todo.values()) / MB, 1), "MB )")
+
+    failed = []
+    def fetch(item):
+        rel, (key, size, etag) = item
+        try:
+            download(s3, bucket, key, size, etag, local_path(dest, rel), threshold, range_size)
+        except Exception as e:
+            print("[-] Can not fetch", key)
+            print(e)
+            with lock:
+                failed.append(rel)
+            return
+        with lock:
+            cache[rel] = {'size': size, 'etag': etag, 'fetched_at': time.time()}
+
+    with run_trace.span('fetch_results', project=pName, objects=len(todo),
+                        bytes=sum(o[1] for o in todo.values())):
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                list(pool.map(fetch, sorted(todo.items())))
+        finally:
+            save_cache(dest, cache)
+
+    fetched = len(todo) - len(failed)
+    failed  = len(failed) + len(unsafe)
+    print("[+] Fetched", fetched, "files into", dest + ",", len(objects) - len(todo), "up to date,", failed, "failed")
+    return fetched, len(objects) - len(todo), failed
+
+# fetch with the aws config, again every interval seconds when watching
+def main_fetch(opt, aws_conf=None, interval=None, workers=None):
+    if aws_conf is None:
+        aws_conf = aws_deploy.load_config()
+    settings = fetch_settings(aws_conf)
+    ak, sk, rg = aws_clients.credentials(aws_conf)
+    workers = workers or settings['workers']
+    # ranged GETs of several files at once share the pool
+    aws_clients.set_pool_size(workers * RANGE_WORKERS)
+    s3   = aws_clients.client('s3', ak, sk, rg)
+    dest = getattr(opt, 'fetch_dir', None) or settings['dest']
+
+    while True:
+        fetched, skipped, failed = fetch_results(s3, settings['bucket'], opt.project_name, dest, workers,
+                                                 settings['threshold'], settings['range'])
+        if not interval:
+            return failed == 0
+        print("[*] Next fetch in", interval, "s, interrupt to stop")
+        time.sleep(interval)
+
+# get arguments
+def get_arguments():
+    # create parser object
+    parser = optparse.OptionParser()
+
+    # add object options
+    parser.add_option('-n', '--project_name', dest='project_name', help='Specify Project Name')
+    parser.add_option('-o', '--fetch_dir', dest='fetch_dir', help='Local directory for results, default aws.fetch.dest (files go to <dir>/<project>/)')
+    parser.add_option('--workers', dest='workers', type='int', help='Files downloaded in parallel, default aws.fetch.workers')
+    parser.add_option('--watch', dest='watch', type='int', help='Fetch again every N seconds until interrupted, to follow a running pipeline')
+
+    # get args
+    (options, arguments) = parser.parse_args()
+
+    # secure empty executions
+    if not options.project_name:
+        parser.error("[-] Please Specify a Project Name, use --help for more info")
+
+    #return objects
+    return options
+
+def main():
+    opt = get_arguments()
+    run_trace.start(opt.project_name)
+    try:
+        main_fetch(opt, interval=opt.watch, workers=opt.workers)
+    except KeyboardInterrupt:
+        print("[*] Fetch stopped")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+import os
+import time
+import sqlite3
+import optparse
+import statistics
+from collections import Counter
+from datetime import datetime
+import aws_clients
+import aws_deploy
+import run_trace
+import sizing
+import url_stream
+
+###############
+## Constants ##
+###############
+
+HISTORY_PATH = '../catalog/history.db'
+
+# a run taking this many times the prediction is flagged as slow
+SLOW_FACTOR = 1.5
+
+# recent runs used by the estimators
+RECENT_RUNS = 50
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id           TEXT PRIMARY KEY,
+    project          TEXT,
+    db               TEXT,
+    code             INTEGER,
+    mode             TEXT,
+    started_at       REAL,
+    finished_at      REAL,
+    ok               INTEGER,
+    input_bytes      INTEGER,
+    samples          INTEGER,
+    instance_type    TEXT,
+    shards           INTEGER,
+    upload_seconds   REAL,
+    upload_mb_s      REAL,
+    pipeline_seconds REAL,
+    total_seconds    REAL
+);
+CREATE INDEX IF NOT EXISTS runs_project ON runs (project);
+CREATE TABLE IF NOT EXISTS phases (
+    run_id  TEXT,
+    span    TEXT,
+    count   INTEGER,
+    seconds REAL,
+    PRIMARY KEY (run_id, span)
+);
+'''
+
+###############
+## Functions ##
+###############
+
+# wraps a phase(name) callback and times each phase until the next one starts
+class PhaseTimer:
+    def __init__(self, phase=None):
+        self.phase     = phase or (lambda name: None)
+        self.current   = None
+        self.since     = None
+        self.durations = {}
+        self.started   = time.time()
+        self.instances = []
+
+    def __call__(self, name):
+        self.close()
+        self.current, self.since = name, time.time()
+        self.phase(name)
+
+    # instance type a pipeline was launched on, once per shard
+    def launched(self, type):
+        self.instances.append(type)
+
+    def close(self):
+        if self.current is not None:
+            self.durations[self.current] = self.durations.get(self.current, 0.0) + time.time() - self.since
+            self.current = None
+
+# local SQLite history of finished runs
+class RunHistory:
+    def __init__(self, path=HISTORY_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self.connect() as con:
+            con.executescript(SCHEMA)
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def add(self, run, phases):
+        cols = sorted(run)
+        with self.connect() as con:
+            con.execute('INSERT OR REPLACE INTO runs (' + ', '.join(cols) + ') VALUES (' +
+                        ', '.join('?' * len(cols)) + ')', [run[c] for c in cols])
+            con.executemany('INSERT OR REPLACE INTO phases VALUES (?, ?, ?, ?)',
+                            [(run['run_id'], span, n, secs) for span, (n, secs) in phases.items()])
+
+    def runs(self, where='1', args=(), limit=RECENT_RUNS):
+        with self.connect() as con:
+            con.row_factory = sqlite3.Row
+            return [dict(r) for r in con.execute('SELECT * FROM runs WHERE ' + where +
+                                                 ' ORDER BY started_at DESC LIMIT ?',
+                                                 tuple(args) + (limit,))]
+
+    # upload throughput (MB/s) of recent successful runs of a mode
+    def upload_rate(self, mode):
+        rates = [r['upload_mb_s'] for r in self.runs('ok = 1 AND mode = ? AND upload_mb_s > 0', (mode,))]
+        return statistics.median(rates) if rates else None
+
+    # pipeline seconds = a + b * samples, fitted on the closest history available
+    def pipeline_model(self, db, instance_type, exclude=None):
+        for where, args in (('db = ? AND instance_type = ?', (db, instance_type)),
+                            ('db = ?', (db,)),
+                            ('1', ())):
+            rows = [r for r in self.runs('ok = 1 AND pipeline_seconds > 0 AND samples > 0 AND ' + where, args)
+                    if r['run_id'] != exclude]
+            if rows:
+                return fit([r['samples'] for r in rows], [r['pipeline_seconds'] for r in rows])
+        return None
+
+    # bytes per sample, to size fileseqs projects before download
+    def bytes_per_sample(self, db):
+        rows = self.runs('ok = 1 AND samples > 0 AND input_bytes > 0 AND db = ?', (db,))
+        return statistics.median(r['input_bytes'] / r['samples'] for r in rows) if rows else None
+
+# least squares line, a constant rate per sample when x does not vary
+def fit(xs, ys):
+    n = len(xs)
+    mx, my = sum(xs) / n, sum(ys) / n
+    var = sum((x - mx) ** 2 for x in xs)
+    if n < 3 or var == 0:
+        return 0.0, sum(ys) / sum(xs)
+    b = sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / var
+    a = my - b * mx
+    if b <= 0 or a < 0:
+        return 0.0, sum(ys) / sum(xs)
+    return a, b
+
+# upload and pipeline estimates for an input, None where history is missing
+def estimate(history, db, mode, input_bytes, samples, instance_type, shards=1, exclude=None):
+    rate   = history.upload_rate(mode)
+    model  = history.pipeline_model(db, instance_type, exclude)
+    shards = max(1, shards or 1)
+    upload   = input_bytes / (rate * 1024 ** 2) if rate and input_bytes else None
+    # shards run side by side, the largest one sets the wall-clock
+    pipeline = model[0] + model[1] * -(-samples // shards) if model and samples else None
+    return {'upload_seconds': upload, 'pipeline_seconds': pipeline, 'upload_mb_s': rate}
+
+# run history from the aws config
+def open_history(aws_conf):
+    return RunHistory(aws_conf['aws'].get('history', {}).get('path', HISTORY_PATH))
+
+# how the sequences reach S3
+def upload_mode(opt, aws_conf):
+    if os.path.isdir(opt.seqs or ''):
+        return 'local'
+    return 'direct' if url_stream.use_direct(opt, aws_conf) else 'remote'
+
+# input size of a project, local directory first
+def project_input(aws_conf, opt):
+    if os.path.isdir(opt.seqs or ''):
+        return sizing.local_input(opt.seqs)
+    ak, sk, rg = aws_clients.credentials(aws_conf)
+    return sizing.s3_input(aws_clients.client('s3', ak, sk, rg),
+                           aws_conf['aws']['s3_bucket_seqs']['name'], opt.db, opt.project_name)
+
+# sizing of a fileseqs project before its reads reach S3
+def plan_fileseqs(aws_conf, opt, history=None):
+    '''
+    One line per read file, sized from the bytes per sample of past
+    runs of the db, the configured ec2_type.pipe without history.
+    '''
+    history = history or open_history(aws_conf)
+    samples = -(-len(url_stream.read_fileseqs(opt.seqs)) // 2)
+    per     = history.bytes_per_sample(opt.db)
+    if not per:
+        return sizing.default_plan(aws_conf, None, samples)
+    return sizing.plan_for_input(aws_conf, opt.db, int(samples * per), samples)
+
+# span count and seconds of the current trace for a project, since a time
+def trace_phases(pName, since=0):
+    phases = {}
+    trace  = run_trace.current()
+    if trace is None:
+        return phases
+    for rec in list(trace.spans):
+        # a long-lived trace (job service) can hold earlier runs of the project
+        if rec.get('project') == pName and datetime.fromisoformat(rec['start']).timestamp() >= since:
+            n, secs = phases.get(rec['span'], (0, 0.0))
+            phases[rec['span']] = (n + 1, secs + rec['duration'])
+    return phases
+
+# bytes and seconds of the upload spans of a project since a time,
+# the download command in remote mode, its bytes are only known from S3
+def upload_span(pName, since, mode):
+    trace = run_trace.current()
+    if trace is None:
+        return None, None
+    size, secs = 0, 0.0
+    for rec in list(trace.spans):
+        if rec.get('project') != pName or datetime.fromisoformat(rec['start']).timestamp() < since:
+            continue
+        if mode == 'remote' and rec['span'] == 'remote_command' and rec.get('download'):
+            secs += rec['duration']
+        elif mode != 'remote' and rec['span'] == 'upload' and rec.get('bytes'):
+            size += rec['bytes']
+            secs += rec['duration']
+    return size or None, secs or None
+
+# store a finished workflow and flag it when much slower than the history predicts
+def record_workflow(opt, timer, ok, aws_conf=None):
+    timer.close()
+    if aws_conf is None:
+        aws_conf = aws_deploy.load_config()
+    history  = open_history(aws_conf)
+    code     = int(opt.code)
+    mode     = upload_mode(opt, aws_conf) if code in (1, 2) else None
+    # a failed run is kept without sizes, S3 is only listed for runs the models learn from
+    total, samples = project_input(aws_conf, opt) if ok else (None, None)
+    # the type most shards ran on, the models are fitted per type
+    launched = Counter(timer.instances).most_common(1)
+    upload   = timer.durations.get('upload')
+    pipeline = timer.durations.get('pipeline')
+    # the upload phase of a remote run includes the instance boot
+    sent, secs = upload_span(opt.project_name, timer.started, mode) if mode else (None, None)
+    sent, secs = sent or total, secs or upload
+    shards   = getattr(opt, 'shards', 1) or 1
+    stamp    = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(timer.started))
+
+    run = {
+        'run_id':           str(opt.project_name) + ':' + stamp,
+        'project':          opt.project_name,
+        'db':               opt.db,
+        'code':             code,
+        'mode':             mode,
+        'started_at':       timer.started,
+        'finished_at':      time.time(),
+        'ok':               int(bool(ok)),
+        'input_bytes':      total,
+        'samples':          samples,
+        'instance_type':    launched[0][0] if launched else None,
+        'shards':           shards,
+        'upload_seconds':   secs,
+        'upload_mb_s':      sent / 1024 ** 2 / secs if secs and sent else None,
+        'pipeline_seconds': pipeline,
+        'total_seconds':    time.time() - timer.started,
+    }
+    history.add(run, trace_phases(opt.project_name, timer.started))
+    print("[+] Run recorded in", history.path)
+    if ok:
+        for name, expected in slowness(history, run).items():
+            print("[-] Slow", name, ":", round(run[name + '_seconds']), "s, expected about", round(expected), "s")
+    return run
+
+# phases of a run slower than SLOW_FACTOR times the prediction from the other runs
+def slowness(history, run):
+    if run['code'] in (1, 2) and run['upload_seconds']:
+        rates = [r['upload_mb_s'] for r in history.runs('ok = 1 AND mode = ? AND upload_mb_s > 0 AND run_id != ?',
+                                                       (run['mode'], run['run_id']))]
+        rate = statistics.median(rates) if rates else None
+    else:
+        rate = None
+    model = history.pipeline_model(run['db'], run['instance_type'], exclude=run['run_id'])
+    slow = {}
+    if rate and run['input_bytes']:
+        expected = run['input_bytes'] / (rate * 1024 ** 2)
+        if run['upload_seconds'] > SLOW_FACTOR * expected:
+            slow['upload'] = expected
+    if model and run['pipeline_seconds'] and run['samples']:
+        expected = model[0] + model[1] * -(-run['samples'] // max(1, run['shards'] or 1))
+        if run['pipeline_seconds'] > SLOW_FACTOR * expected:
+            slow['pipeline'] = expected
+    return slow
+
+# print the estimate for a project, the upload only when there is one
+def show_estimate(pName, est, upload=True):
+    def fmt(secs):
+        return '-' if secs is None else str(int(secs // 60)) + 'm ' + str(int(secs % 60)) + 's'
+    print("[+] Estimate for", pName)
+    if upload:
+        print(" - Upload:", fmt(est['upload_seconds']),
+              '' if est['upload_mb_s'] is None else '(' + str(round(est['upload_mb_s'], 1)) + ' MB/s)')
+    print(" - Pipeline:", fmt(est['pipeline_seconds']))
+    if (upload and est['upload_seconds'] is None) or est['pipeline_seconds'] is None:
+        print(" - Not enough history for a full estimate")
+
+# estimate a new project from its input
+def plan_project(aws_conf, opt):
+    history = open_history(aws_conf)
+    upload  = int(getattr(opt, 'code', 2)) in (1, 2)
+    mode    = upload_mode(opt, aws_conf) if upload else None
+    if upload and os.path.isfile(opt.seqs or ''):
+        plan = plan_fileseqs(aws_conf, opt, history)
+        total, samples = plan['bytes'] or 0, plan['samples']
+    else:
+        total, samples = project_input(aws_conf, opt)
+        plan = sizing.plan_for_input(aws_conf, opt.db, total, samples)
+    sizing.show_plan(opt.project_name, opt.db, plan)
+    est = estimate(history, opt.db, mode, total, samples, plan['type'], getattr(opt, 'shards', 1))
+    show_estimate(opt.project_name, est, upload)
+    return est
+
+# finished runs flagged as slow
+def slow_runs(history):
+    flagged = []
+    for run in history.runs('ok = 1'):
+        slow = slowness(history, run)
+        if slow:
+            flagged.append((run, slow))
+    return flagged
+
+# get arguments
+def get_arguments():
+    # create parser object
+    parser = optparse.OptionParser(usage='%prog plan -n project -d db [-s seqs] | list | slow')
+
+    # add object options
+    parser.add_option('-n', '--project_name', dest='project_name', help='Specify Project Name')
+    parser.add_option('-d', '--database', dest='db', help='Provide Database to use (16s - ITS)')
+    parser.add_option('-c', '--code', dest='code', default='2', help='Workflow to estimate, 1 upload, 2 upload + run, 3 run (default: 2)')
+    parser.add_option('-s', '--sequences', dest='seqs', help='File With URL Sequences or local directory (default: project already in S3)')
+    parser.add_option('--shards', dest='shards', type='int', default=1, help='Pipeline instances the project would be split over')
+    parser.add_option('--direct', dest='direct', action='store_true', default=False, help='Estimate the upload as streamed from this machine')
+
+    # get args
+    (options, arguments) = parser.parse_args()
+
+    # secure empty executions
+    if not arguments or arguments[0] not in ('plan', 'list', 'slow'):
+        parser.error("[-] Please Specify a command (plan, list, slow), use --help for more info")
+    elif arguments[0] == 'plan' and not (options.project_name and options.db):
+        parser.error("[-] Please Specify Project Name and Database for plan, use --help for more info")
+
+    #return objects
+    return options, arguments
+
+def main():
+    opt, args = get_arguments()
+    aws_conf = aws_deploy.load_config()
+    if args[0] == 'plan':
+        plan_project(aws_conf, opt)
+        return
+
+    history = open_history(aws_conf)
+    if args[0] == 'list':
+        print("{:<25} {:<4} {:<5} {:<6} {:>8} {:>10} {:>9} {:>10}".format(
+            'PROJECT', 'DB', 'CODE', 'OK', 'SAMPLES', 'INPUT MB', 'UP MB/s', 'PIPE MIN'))
+        for r in history.runs():
+            print("{:<25} {:<4} {:<5} {:<6} {:>8} {:>10} {:>9} {:>10}".format(
+                r['project'], r['db'], r['code'], 'yes' if r['ok'] else 'no', r['samples'] or '-',
+                round((r['input_bytes'] or 0) / 1024 ** 2, 1), round(r['upload_mb_s'] or 0, 1),
+                round((r['pipeline_seconds'] or 0) / 60, 1)))
+    else:
+        for run, slow in slow_runs(history):
+            for name, expected in slow.items():
+                print("[-]", run['run_id'], name, round(run[name + '_seconds']), "s, expected about", round(expected), "s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+###############
+## Constants ##
+###############
+
+TRACE_DIR = '../traces'
+# spans kept in memory per trace, the file keeps all of them
+MAX_SPANS = 10000
+
+###############
+## Functions ##
+###############
+
+# JSON-lines trace of one run, one record per span
+class RunTrace:
+    def __init__(self, name, trace_dir=TRACE_DIR):
+        stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        self.run_id = str(name) + '_' + stamp
+        self.path   = os.path.join(trace_dir, self.run_id + '.jsonl')
+        self.lock   = threading.Lock()
+        self.spans  = deque(maxlen=MAX_SPANS)
+        os.makedirs(trace_dir, exist_ok=True)
+
+    def write(self, record):
+        record['run'] = self.run_id
+        with self.lock:
+            self.spans.append(record)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+# active trace of the process, spans are dropped while none is started
+active = None
+# trace of the current job, set with use(), wins over the process trace
+local = contextvars.ContextVar('run_trace', default=None)
+# attributes added to every span of the context, e.g. the project of a workflow
+tags  = contextvars.ContextVar('run_trace_tags', default={})
+
+# start tracing a run
+def start(name, trace_dir=TRACE_DIR):
+    global active
+    active = RunTrace(name, trace_dir)
+    print("[+] Tracing run to", active.path)
+    return active
+
+# trace spans are written to
+def current():
+    return local.get() or active
+
+# send the spans of this thread to a trace of their own, e.g. one per job
+@contextmanager
+def use(trace):
+    token = local.set(trace)
+    try:
+        yield trace
+    finally:
+        local.reset(token)
+
+# add attributes to the spans of this thread, those of the span itself win
+@contextmanager
+def tagged(**attrs):
+    token = tags.set(dict(tags.get(), **attrs))
+    try:
+        yield
+    finally:
+        tags.reset(token)
+
+# func running under the trace and tags of the caller, for pool and thread targets
+def carry(func):
+    trace, attrs = local.get(), tags.get()
+    if trace is None and not attrs:
+        return func
+    def run(*args, **kwargs):
+        with use(trace), tagged(**attrs):
+            return func(*args, **kwargs)
+    return run
+
+# time a phase, attributes set on the yielded dict end up in the record
+@contextmanager
+def span(name, **attrs):
+    record = dict(tags.get(), **attrs)
+    trace  = current()
+    started = time.time()
+    t0 = time.monotonic()
+    status = 'ok'
+    try:
+        yield record
+    except BaseException as e:
+        status = 'error'
+        record['error'] = str(e)[:200]
+        raise
+    finally:
+        if trace is not None:
+            record.update({
+                'span':     name,
+                'start':    datetime.fromtimestamp(started, timezone.utc).isoformat(),
+                'duration': round(time.monotonic() - t0, 3),
+                'status':   status,
+                'thread':   threading.current_thread().name,
+            })
+            trace.write(record)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+import io
+import os
+import csv
+from concurrent.futures import ThreadPoolExecutor
+import run_trace
+import sizing
+import upload_engine
+
+###############
+## Constants ##
+###############
+
+# pipe_command writes results under 16s/ whatever the database
+RESULTS_DB = '16s'
+
+# parallel server-side copies when staging and merging
+COPY_WORKERS = 16
+
+# outputs several shards produce are merged when tabular (MultiQC tables,
+# feature/ASV tables, pipeline_info traces) and small enough to load
+TABLE_SUFFIXES  = ('.tsv', '.csv', '.txt')
+MERGE_MAX_BYTES = 256 * 1024 ** 2
+
+###############
+## Functions ##
+###############
+
+# sample name -> [(key, size)] under <db>/<project>/backups/sample/
+def list_samples(s3, bucket, db, pName):
+    prefix  = upload_engine.sample_key(db, pName, '')
+    samples = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            name = obj['Key'][len(prefix):]
+            if '/' in name or not name.endswith(('.fastq.gz', '.fastq')):
+                continue
+            samples.setdefault(sizing.sample_name(name), []).append((obj['Key'], obj['Size']))
+    return samples
+
+# split samples into n groups of similar size, both reads of a sample stay together
+def split_samples(samples, n):
+    groups = [{'samples': [], 'bytes': 0} for _ in range(max(1, n))]
+    # largest first, each into the lightest group
+    for name in sorted(samples, key=lambda s: (-sum(f[1] for f in samples[s]), s)):
+        group = min(groups, key=lambda g: g['bytes'])
+        group['samples'].append(name)
+        group['bytes'] += sum(f[1] for f in samples[name])
+    return [g for g in groups if g['samples']]
+
+# s3 prefixes used by one shard
+def shard_prefixes(db, pName, index):
+    base = str(db)+"/"+str(pName)+"/shards/"+str(index)+"/"
+    return {
+        'index':   index,
+        'input':   base+"sample/",
+        'results': RESULTS_DB+"/"+str(pName)+"/shards/"+str(index)+"/results/",
+        'workdir': "/nextflow_workdir/"+str(pName)+"_shard"+str(index),
+    }
+
+# copy many objects server-side, (source key, destination key) pairs
+def copy_keys(s3, bucket, pairs):
+    def copy(pair):
+        s3.copy({'Bucket': bucket, 'Key': pair[0]}, bucket, pair[1])
+    with ThreadPoolExecutor(max_workers=COPY_WORKERS) as pool:
+        list(pool.map(copy, pairs))
+
+# delete everything under a prefix
+def delete_prefix(s3, bucket, prefix):
+    paginator = s3.get_paginator('list_objects_v2')
+    n = 0
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        keys = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+        if keys:
+            s3.delete_objects(Bucket=bucket, Delete={'Objects': keys, 'Quiet': True})
+            n += len(keys)
+    return n
+
+# copy the samples of every group into its shard input prefix
+def stage_inputs(s3, bucket, db, pName, samples, groups):
+    '''
+    Returns the shard descriptions, one per group, in group order.
+    '''
+    shards = []
+    pairs  = []
+    for index, group in enumerate(groups):
+        shard = shard_prefixes(db, pName, index)
+        shard.update(samples=len(group['samples']), bytes=group['bytes'])
+        delete_prefix(s3, bucket, shard['input'])
+        for name in group['samples']:
+            for key, size in samples[name]:
+                pairs.append((key, shard['input'] + os.path.basename(key)))
+        shards.append(shard)
+    with run_trace.span('shard_stage', project=pName, shards=len(shards), objects=len(pairs)):
+        copy_keys(s3, bucket, pairs)
+    print("[+] Staged", len(pairs), "objects into", len(shards), "shards")
+    return shards
+
+# (comment lines, header, rows) of a delimited table, None when it is not one
+def read_table(data, delimiter):
+    try:
+        lines = data.decode('utf-8').splitlines()
+    except UnicodeDecodeError:
+        return None
+    # biom-style tables open with comments, the header may start with # too
+    n = 0
+    while n < len(lines) and lines[n].startswith('#') and delimiter not in lines[n]:
+        n += 1
+    if n == len(lines) or delimiter not in lines[n]:
+        return None
+    rows = list(csv.reader(lines[n:], delimiter=delimiter))
+    width = len(rows[0])
+    if any(len(row) != width for row in rows[1:] if row):
+        return None
+    return lines[:n], rows[0], [row for row in rows[1:] if row]
+
+def is_number(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+# one table from the tables of several shards, None when they do not line up
+def merge_tables(tables):
+    '''
+    Same header: per-sample tables, rows are appended.
+    Same first column: per-feature tables, the sample columns of
+    every shard are joined on it, absent counts are 0.
+    '''
+    comments, header, rows = tables[0]
+    if all(t[1] == header for t in tables):
+        return comments, header, [row for t in tables for row in t[2]]
+    if any(t[1][0] != header[0] for t in tables):
+        return None
+
+    columns = [header[0]]
+    for t in tables:
+        columns += [c for c in t[1][1:] if c not in columns]
+    numeric = all(is_number(v) for t in tables for row in t[2] for v in row[1:] if v)
+    fill    = '0' if numeric else ''
+    joined  = {}
+    for t in tables:
+        for row in t[2]:
+            values = joined.setdefault(row[0], {})
+            for name, value in zip(t[1][1:], row[1:]):
+                if not values.get(name):
+                    values[name] = value
+    return comments, columns, [[key] + [values.get(c, fill) for c in columns[1:]]
+                               for key, values in joined.items()]
+
+# merged body of an output written by several shards, None when it can not be merged
+def merge_output(s3, bucket, rel, keys):
+    if not rel.endswith(TABLE_SUFFIXES):
+        return None
+    sizes = [s3.head_object(Bucket=bucket, Key=key)['ContentLength'] for key in keys]
+    if sum(sizes) > MERGE_MAX_BYTES:
+        return None
+    delimiter = ',' if rel.endswith('.csv') else '\t'
+    tables = [read_table(s3.get_object(Bucket=bucket, Key=key)['Body'].read(), delimiter) for key in keys]
+    if any(t is None for t in tables):
+        return None
+    merged = merge_tables(tables)
+    if merged is None:
+        return None
+    comments, header, rows = merged
+    out = io.StringIO()
+    for line in comments:
+        out.write(line + '\n')
+    csv.writer(out, delimiter=delimiter, lineterminator='\n').writerows([header] + rows)
+    return out.getvalue().encode('utf-8')
+
+# merge the shard outputs under results/
+def merge_results(s3, bucket, pName, shards):
+    '''
+    Outputs of a single shard are copied, tables produced by several
+    shards are merged. Any other output produced by several shards
+    (HTML reports, plots) is kept under results/shard<N>/ and listed.
+    '''
+    final = RESULTS_DB+"/"+str(pName)+"/results/"
+    owners = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for shard in shards:
+        for page in paginator.paginate(Bucket=bucket, Prefix=shard['results']):
+            for obj in page.get('Contents', []):
+                rel = obj['Key'][len(shard['results']):]
+                owners.setdefault(rel, []).append((shard['index'], obj['Key']))
+
+    pairs  = []
+    merged = []
+    kept   = []
+    with run_trace.span('shard_merge', project=pName) as rec:
+        for rel, keys in sorted(owners.items()):
+            if len(keys) == 1:
+                pairs.append((keys[0][1], final + rel))
+                continue
+            body = merge_output(s3, bucket, rel, [key for index, key in keys])
+            if body is not None:
+                s3.put_object(Bucket=bucket, Key=final + rel, Body=body)
+                merged.append(rel)
+                continue
+            kept.append(rel)
+            for index, key in keys:
+                pairs.append((key, final + 'shard' + str(index) + '/' + rel))
+        copy_keys(s3, bucket, pairs)
+        rec.update(objects=len(pairs) + len(merged), merged=len(merged), kept=len(kept))
+    print("[+] Merged", len(pairs) + len(merged), "result objects into", final + ",", len(merged), "tables joined across shards")
+    if kept:
+        print("[-]", len(kept), "outputs of several shards can not be merged, kept under", final + "shard<N>/:")
+        for rel in kept:
+            print(" -", rel)
+    return len(pairs) + len(merged)
+
+# remove staged inputs, and shard results once merged
+def cleanup(s3, bucket, shards, results=False):
+    for shard in shards:
+        delete_prefix(s3, bucket, shard['input'])
+        if results:
+            delete_prefix(s3, bucket, shard['results'])
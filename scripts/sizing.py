@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+import os
+import re
+
+###############
+## Constants ##
+###############
+
+GB = 1024 ** 3
+
+# used when aws.sizing is missing from the config
+DEFAULT_TABLE = [
+    {'type': 'c5.2xlarge',  'vcpus': 8,  'memory_gb': 16,  'max_gb': 5,    'max_samples': 24},
+    {'type': 'c5.4xlarge',  'vcpus': 16, 'memory_gb': 32,  'max_gb': 20,   'max_samples': 96},
+    {'type': 'c5.9xlarge',  'vcpus': 36, 'memory_gb': 72,  'max_gb': 80,   'max_samples': 384},
+    {'type': 'r5.12xlarge', 'vcpus': 48, 'memory_gb': 384, 'max_gb': None, 'max_samples': None},
+]
+
+# memory left to the OS and docker daemon
+DEFAULT_RESERVE_GB = 2
+
+# ITS runs need more memory per input byte than 16s
+DEFAULT_DB_FACTOR = {'16s': 1.0, 'ITS': 1.5}
+
+# plain .fastq is uploaded gzipped, sized at about this share of its bytes
+# so a local directory and its uploaded copy land on the same row
+GZIP_RATIO = 0.3
+
+# sample name from a paired read file
+PAIR_RE = re.compile(r'^(.*)_R[12]\.fastq(\.gz)?$')
+
+###############
+## Functions ##
+###############
+
+# read sizing settings from the aws config, with defaults
+def sizing_settings(aws_conf):
+    sizing = aws_conf['aws'].get('sizing', {})
+    return {
+        'enabled':    sizing.get('enabled', False),
+        'table':      sizing.get('table', DEFAULT_TABLE),
+        'reserve_gb': sizing.get('reserve_gb', DEFAULT_RESERVE_GB),
+        'db_factor':  sizing.get('db_factor', DEFAULT_DB_FACTOR),
+    }
+
+# sample name of a read file
+def sample_name(filename):
+    m = PAIR_RE.match(filename)
+    return m.group(1) if m else filename
+
+# total size and sample count of a local sequence directory, as stored once uploaded
+def local_input(directory):
+    total, samples = 0, set()
+    names = set(os.listdir(directory))
+    for filename in names:
+        ff = os.path.join(directory, filename)
+        if not os.path.isfile(ff):
+            continue
+        if filename.endswith('.fastq.gz'):
+            total += os.path.getsize(ff)
+        elif filename.endswith('.fastq') and filename + '.gz' not in names:
+            total += int(os.path.getsize(ff) * GZIP_RATIO)
+        else:
+            continue
+        samples.add(sample_name(filename))
+    return total, len(samples)
+
+# total size and sample count under <db>/<project>/backups/sample/
+def s3_input(s3, bucket, db, pName):
+    prefix = str(db)+'/'+str(pName)+'/backups/sample/'
+    total, samples = 0, set()
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            total += obj['Size']
+            samples.add(sample_name(obj['Key'][len(prefix):]))
+    return total, len(samples)
+
+# first table row that fits the input, the largest one otherwise
+def choose_row(table, total_bytes, samples, factor=1.0):
+    need_gb = total_bytes * factor / GB
+    for row in table:
+        fits_gb = row.get('max_gb') is None or need_gb <= row['max_gb']
+        fits_n  = row.get('max_samples') is None or samples <= row['max_samples']
+        if fits_gb and fits_n:
+            return row
+    return table[-1]
+
+# instance type, docker memory and nextflow cpus for a project
+def plan_for_project(aws_conf, s3, db, pName, directory=None):
+    '''
+    With sizing disabled the configured ec2_type.pipe and
+    the historical 70g container limit are kept.
+    '''
+    settings = sizing_settings(aws_conf)
+    if not settings['enabled']:
+        return default_plan(aws_conf)
+
+    if directory and os.path.isdir(directory):
+        total, samples = local_input(directory)
+    else:
+        total, samples = s3_input(s3, aws_conf['aws']['s3_bucket_seqs']['name'], db, pName)
+    return plan_for_input(aws_conf, db, total, samples)
+
+# instance type, docker memory and nextflow cpus for a known input size
+def plan_for_input(aws_conf, db, total, samples):
+    settings = sizing_settings(aws_conf)
+    if not settings['enabled']:
+        return default_plan(aws_conf, total, samples)
+
+    row = choose_row(settings['table'], total, samples, settings['db_factor'].get(str(db), 1.0))
+    return row_plan(settings, row, total, samples)
+
+# configured ec2_type.pipe, for runs whose input size is unknown
+def default_plan(aws_conf, total=None, samples=None):
+    '''
+    Docker memory and cpus come from the table row of that type,
+    the historical 70g container limit otherwise.
+    '''
+    settings = sizing_settings(aws_conf)
+    type = aws_conf['aws']['ec2_type']['pipe']
+    rows = [row for row in settings['table'] if row['type'] == type] if settings['enabled'] else []
+    if rows:
+        return row_plan(settings, rows[0], total, samples)
+    return {'type': type, 'memory': '70g', 'cpus': None, 'bytes': total, 'samples': samples}
+
+# plan for a table row, docker memory leaves reserve_gb to the host
+def row_plan(settings, row, total, samples):
+    memory = max(1, int(row['memory_gb'] - settings['reserve_gb']))
+    return {'type': row['type'], 'memory': str(memory) + 'g', 'cpus': row['vcpus'],
+            'bytes': total, 'samples': samples}
+
+# print the sizing decision
+def show_plan(pName, db, plan):
+    print("[+] Sizing for", pName, "(", db, ")")
+    if plan['bytes'] is not None:
+        print(" - Input:", round(plan['bytes'] / GB, 2), "GB,", plan['samples'], "samples")
+    print(" - Instance type:", plan['type'])
+    print(" - Docker memory:", plan['memory'])
+    print(" - Nextflow cpus:", plan['cpus'] or 'pipeline default')
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+import socket
+import time
+from botocore.exceptions import WaiterError
+import run_trace
+
+###############
+## Constants ##
+###############
+
+DEFAULT_DEADLINE = 300
+FIRST_DELAY      = 1.0
+MAX_DELAY        = 10.0
+PROBE_TIMEOUT    = 5.0
+
+###############
+## Functions ##
+###############
+
+# raised when the caller stopped waiting, e.g. the upload of a pipelined run failed
+class Cancelled(Exception):
+    pass
+
+def check_cancel(cancel, what):
+    if cancel is not None and cancel.is_set():
+        raise Cancelled("wait for " + str(what) + " cancelled")
+
+# sleep that wakes up as soon as cancel is set
+def pause(delay, cancel=None):
+    if cancel is None:
+        time.sleep(delay)
+    else:
+        cancel.wait(delay)
+
+# read ssh settings from the aws config, with defaults
+def ssh_settings(aws_conf):
+    ssh = aws_conf['aws'].get('ssh', {})
+    return ssh.get('ready_timeout', DEFAULT_DEADLINE), ssh.get('status_checks', False)
+
+# wait until the instance has a public ip
+def public_ip(ec2, instance_id, deadline, cancel=None):
+    delay = FIRST_DELAY
+    while True:
+        check_cancel(cancel, instance_id)
+        resp = ec2.describe_instances(InstanceIds=[str(instance_id)])
+        for res in resp['Reservations']:
+            for ins in res['Instances']:
+                if ins.get('PublicIpAddress'):
+                    return ins['PublicIpAddress']
+        if time.time() + delay > deadline:
+            raise TimeoutError("instance " + str(instance_id) + " has no public ip")
+        pause(delay, cancel)
+        delay = min(delay * 2, MAX_DELAY)
+
+# one probe: tcp connect and read the ssh banner
+def probe_ssh(host, port=22, timeout=PROBE_TIMEOUT):
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            sock.settimeout(timeout)
+            banner = sock.recv(256)
+        return banner.startswith(b'SSH-')
+    except OSError:
+        return False
+
+# poll port 22 with exponential backoff until sshd answers or deadline passes
+def wait_for_ssh(host, port=22, deadline=None, timeout=DEFAULT_DEADLINE, cancel=None):
+    if deadline is None:
+        deadline = time.time() + timeout
+    delay = FIRST_DELAY
+    while not probe_ssh(host, port):
+        check_cancel(cancel, host)
+        if time.time() + delay > deadline:
+            raise TimeoutError("sshd on " + str(host) + " not ready before deadline")
+        pause(delay, cancel)
+        delay = min(delay * 2, MAX_DELAY)
+    return True
+
+# wait until an instance accepts ssh connections
+def wait_instance_ready(ec2, instance_id, timeout=DEFAULT_DEADLINE, status_checks=False, watcher=None,
+                        cancel=None):
+    '''
+    ec2 is a boto3 client.
+    With status_checks the EC2 instance_status_ok waiter runs first.
+    With a watcher the public ip comes from its batched polling.
+    Every wait raises Cancelled soon after cancel is set.
+    '''
+    with run_trace.span('ssh_ready', instance=instance_id):
+        start    = time.time()
+        deadline = start + timeout
+        print("[*] Waiting for port 22")
+
+        if status_checks:
+            print("[*] Waiting for EC2 status checks")
+            waiter = ec2.get_waiter('instance_status_ok')
+            # one attempt at a time, so cancel is checked between them
+            while True:
+                check_cancel(cancel, instance_id)
+                try:
+                    waiter.wait(InstanceIds=[str(instance_id)], WaiterConfig={'Delay': 10, 'MaxAttempts': 1})
+                    break
+                except WaiterError:
+                    if time.time() + 10 > deadline:
+                        raise TimeoutError("instance " + str(instance_id) + " status checks not ok before deadline")
+                    pause(10, cancel)
+
+        if watcher:
+            host = watcher.public_ip(instance_id, max(1, deadline - time.time()), cancel)
+        else:
+            host = public_ip(ec2, instance_id, deadline, cancel)
+        wait_for_ssh(host, 22, deadline=deadline, cancel=cancel)
+        print("[+] SSH ready on", host, "after", round(time.time() - start, 1), "s")
+        return host
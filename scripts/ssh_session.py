@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+import os
+import time
+import socket
+import threading
+import paramiko
+import remote_exec
+import run_trace
+import ssh_ready
+
+###############
+## Constants ##
+###############
+
+DEFAULT_USER      = 'ec2-user'
+DEFAULT_ATTEMPTS  = 5
+DEFAULT_KEEPALIVE = 30
+CONNECT_TIMEOUT   = 15
+
+# background commands, {pName} is replaced by the project name
+MONITORS = {
+    'disk':   'df -h / /nextflow_workdir 2>/dev/null | tail -n +2',
+    'memory': 'free -m | sed -n 2p',
+}
+UPLOAD_MONITORS = {
+    'progress': 'tail -n 1 execution_{pName}.log',
+}
+PIPE_MONITORS = {
+    'containers': "docker stats --no-stream --format '{{{{.Name}}}} {{{{.CPUPerc}}}} {{{{.MemUsage}}}}'",
+}
+
+###############
+## Key cache ##
+###############
+
+# parsed keys, by path and modification time
+key_lock = threading.Lock()
+keys     = {}
+
+###############
+## Functions ##
+###############
+
+# read ssh session settings from the aws config, with defaults
+def session_settings(aws_conf):
+    ssh = aws_conf['aws'].get('ssh', {})
+    return {
+        'attempts':         ssh.get('connect_attempts', DEFAULT_ATTEMPTS),
+        'keepalive':        ssh.get('keepalive', DEFAULT_KEEPALIVE),
+        'monitor_interval': ssh.get('monitor_interval', 0),
+    }
+
+# parse a pem file once per process
+def load_key(path):
+    stamp = (os.path.abspath(path), os.path.getmtime(path))
+    with key_lock:
+        if stamp not in keys:
+            keys[stamp] = paramiko.RSAKey.from_private_key_file(path)
+        return keys[stamp]
+
+# one ssh connection to a host, commands each run on their own channel
+class SSHSession:
+    def __init__(self, host, key_file, username=DEFAULT_USER, attempts=DEFAULT_ATTEMPTS,
+                 keepalive=DEFAULT_KEEPALIVE):
+        self.host      = host
+        self.key       = load_key(key_file)
+        self.username  = username
+        self.attempts  = max(1, attempts)
+        self.keepalive = keepalive
+        self.client    = None
+        self.closed    = False
+        self.lock      = threading.Lock()
+        self.monitors  = []
+
+    # connect with bounded exponential backoff
+    def connect(self):
+        delay = ssh_ready.FIRST_DELAY
+        with run_trace.span('ssh_connect', host=self.host) as rec:
+            for attempt in range(1, self.attempts + 1):
+                client = paramiko.SSHClient()
+                client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                try:
+                    client.connect(hostname=self.host, username=self.username, pkey=self.key,
+                                   allow_agent=False, look_for_keys=False, timeout=CONNECT_TIMEOUT)
+                    break
+                except (paramiko.SSHException, socket.error) as e:
+                    client.close()
+                    if attempt == self.attempts:
+                        raise
+                    print("[-] SSH connect failed (", e, "), retrying in", delay, "s")
+                    time.sleep(delay)
+                    delay = min(delay * 2, ssh_ready.MAX_DELAY)
+            rec['attempts'] = attempt
+        if self.keepalive:
+            client.get_transport().set_keepalive(self.keepalive)
+        self.client = client
+        return self
+
+    # connected client, reconnects when the transport dropped
+    def ensure(self):
+        with self.lock:
+            if self.closed:
+                raise paramiko.SSHException("session to " + str(self.host) + " is closed")
+            transport = self.client.get_transport() if self.client else None
+            if transport is None or not transport.is_active():
+                self.connect()
+            return self.client
+
+    # run one command on a new channel, returns its exit status
+    def run(self, command, log_path=None, prefix='', sinks=()):
+        return remote_exec.run_streamed(self.ensure(), command, log_path, prefix, sinks)
+
+    # repeat a command every interval seconds until the session closes
+    def start_monitor(self, name, command, interval, log_path=None, prefix='', sinks=()):
+        stop = threading.Event()
+
+        def loop():
+            while not stop.is_set():
+                try:
+                    self.run(command, log_path, prefix + '(' + name + ') ', sinks)
+                except Exception as e:
+                    print("[-] Monitor", name, "failed:", e)
+                stop.wait(interval)
+
+        thread = threading.Thread(target=run_trace.carry(loop), name='monitor-' + name, daemon=True)
+        thread.start()
+        self.monitors.append((stop, thread))
+        return stop
+
+    # start the built-in monitors, plus extra {name: command}
+    def start_monitors(self, pName, interval, log_path=None, prefix='', extra=None, sinks=()):
+        if not interval:
+            return
+        commands = dict(MONITORS, **(extra or {}))
+        for name, command in commands.items():
+            self.start_monitor(name, command.format(pName=pName), interval, log_path, prefix, sinks)
+
+    def stop_monitors(self):
+        for stop, thread in self.monitors:
+            stop.set()
+        for stop, thread in self.monitors:
+            thread.join(timeout=5)
+        self.monitors = []
+
+    def close(self):
+        self.closed = True
+        self.stop_monitors()
+        if self.client:
+            self.client.close()
+            self.client = None
+
+    def __enter__(self):
+        self.ensure()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
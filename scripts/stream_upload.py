@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+import zlib
+
+###############
+## Constants ##
+###############
+
+MB = 1024 * 1024
+
+# files above this size go through multipart
+MULTIPART_THRESHOLD = 16 * MB
+
+# bytes held in memory per part (S3 minimum is 5MB)
+PART_SIZE = 8 * MB
+
+# bytes read from disk at a time
+READ_BLOCK = 1 * MB
+
+###############
+## Functions ##
+###############
+
+# read an open file block by block
+def iter_chunks(f, block=READ_BLOCK):
+    while True:
+        data = f.read(block)
+        if not data:
+            return
+        yield data
+
+# gzip-compress a stream of chunks on the fly
+def gzip_chunks(chunks, level=6):
+    comp = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for data in chunks:
+        out = comp.compress(data)
+        if out:
+            yield out
+    yield comp.flush()
+
+# group chunks into parts of at least part_size bytes
+def iter_parts(chunks, part_size=PART_SIZE):
+    buf  = bytearray()
+    for data in chunks:
+        buf += data
+        while len(buf) >= part_size:
+            yield bytes(buf[:part_size])
+            del buf[:part_size]
+    if buf:
+        yield bytes(buf)
+
+# upload a stream of chunks as a multipart upload, one part in memory at a time
+def multipart_from_chunks(s3, bucket, key, chunks, part_size=PART_SIZE, callback=None, **extra):
+    '''
+    s3 is a boto3 client.
+    callback(n) is called with the size of every part sent.
+    Returns the complete_multipart_upload response.
+    '''
+    upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, **extra)['UploadId']
+    parts = []
+    try:
+        for number, body in enumerate(iter_parts(chunks, part_size), start=1):
+            resp = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+                                  PartNumber=number, Body=body)
+            parts.append({'PartNumber': number, 'ETag': resp['ETag']})
+            if callback:
+                callback(len(body))
+        if not parts:
+            # empty stream, S3 still needs one part
+            resp = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+                                  PartNumber=1, Body=b'')
+            parts.append({'PartNumber': 1, 'ETag': resp['ETag']})
+        return s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                            MultipartUpload={'Parts': parts})
+    except Exception:
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
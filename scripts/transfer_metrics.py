@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+import os
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+###############
+## Constants ##
+###############
+
+PREFIX           = 'aws_connect_'
+DEFAULT_INTERVAL = 5
+# a file without progress for this long counts as stalled
+STALL_SECONDS    = 60
+
+###############
+## Functions ##
+###############
+
+# byte counters of the transfers of one process
+class Metrics:
+    def __init__(self):
+        self.lock    = threading.Lock()
+        self.files   = {}
+        self.retries = {}
+        self.errors  = {}
+        self.started = time.time()
+
+    # register a file before its first byte
+    def expect(self, key, size):
+        now = time.time()
+        with self.lock:
+            self.files[key] = {'project': project_of(key), 'bytes': 0, 'total': size, 'sent': 0,
+                               'rolled_back': 0, 'start': now, 'last': now, 'state': 'active'}
+
+    # s3transfer reports a retried part as negative progress, bytes is
+    # the net amount while sent and rolled_back only ever grow
+    def progress(self, key, n):
+        with self.lock:
+            f = self.files.get(key)
+            if f is None:
+                f = self.files[key] = {'project': project_of(key), 'bytes': 0, 'total': 0, 'sent': 0,
+                                       'rolled_back': 0, 'start': time.time(), 'state': 'active'}
+            if n >= 0:
+                f['sent'] += n
+            else:
+                f['rolled_back'] -= n
+            f['bytes'] = max(0, f['bytes'] + n)
+            f['last'] = time.time()
+
+    def finish(self, key, ok=True):
+        with self.lock:
+            f = self.files.get(key)
+            if f is not None:
+                f['state'] = 'done' if ok else 'failed'
+                f['end'] = time.time()
+
+    # botocore after-call: retries the call needed, and error responses
+    # (5xx, throttling, 403) that were still failing after the retries
+    def on_call(self, event_name, parsed=None, http_response=None, **kwargs):
+        parsed   = parsed or {}
+        attempts = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        status   = getattr(http_response, 'status_code', 0) or 0
+        op = event_name.split('.')[-1]
+        with self.lock:
+            if attempts:
+                self.retries[op] = self.retries.get(op, 0) + attempts
+            if 'Error' in parsed or status >= 400:
+                self.errors[op] = self.errors.get(op, 0) + 1
+
+    # botocore after-call-error: calls that failed on the transport
+    def on_error(self, event_name, **kwargs):
+        op = event_name.split('.')[-1]
+        with self.lock:
+            self.errors[op] = self.errors.get(op, 0) + 1
+
+    # Prometheus text exposition of the current state
+    def render(self):
+        now = time.time()
+        with self.lock:
+            files   = {k: dict(v) for k, v in self.files.items()}
+            retries = dict(self.retries)
+            errors  = dict(self.errors)
+
+        projects = {}
+        for key, f in files.items():
+            p = projects.setdefault(f['project'], {'bytes': 0, 'total': 0, 'sent': 0, 'rolled_back': 0,
+                                                   'start': f['start'], 'last': 0, 'done': 0, 'failed': 0,
+                                                   'active': 0, 'stalled': 0})
+            p['bytes'] += f['bytes']
+            p['total'] += f['total']
+            p['sent']  += f['sent']
+            p['rolled_back'] += f['rolled_back']
+            p['start']  = min(p['start'], f['start'])
+            p['last']   = max(p['last'], f.get('last', 0))
+            p[f['state']] += 1
+            if f['state'] == 'active' and now - f.get('last', f['start']) > STALL_SECONDS:
+                p['stalled'] += 1
+
+        out = []
+        def metric(name, kind, help, samples):
+            out.append('# HELP ' + PREFIX + name + ' ' + help)
+            out.append('# TYPE ' + PREFIX + name + ' ' + kind)
+            for labels, value in samples:
+                out.append(PREFIX + name + labels_text(labels) + ' ' + format_value(value))
+
+        metric('transfer_bytes_total', 'counter', 'Bytes sent to S3, retried parts included.',
+               [({'project': p}, v['sent']) for p, v in projects.items()])
+        metric('transfer_rollback_bytes_total', 'counter', 'Bytes sent again after a part was retried.',
+               [({'project': p}, v['rolled_back']) for p, v in projects.items()])
+        metric('transfer_net_bytes', 'gauge', 'Bytes sent to S3 that were kept.',
+               [({'project': p}, v['bytes']) for p, v in projects.items()])
+        metric('transfer_expected_bytes', 'gauge', 'Bytes of all registered files.',
+               [({'project': p}, v['total']) for p, v in projects.items()])
+        # once nothing is in flight the rate stops at the last byte instead of decaying
+        metric('transfer_rate_bytes_per_second', 'gauge', 'Average rate since the first file started.',
+               [({'project': p}, rate(v['bytes'], v['start'], now if v['active'] else v['last']))
+                for p, v in projects.items()])
+        metric('transfer_eta_seconds', 'gauge', 'Estimated seconds left at the average rate.',
+               [({'project': p}, eta(v['bytes'], v['total'], v['start'], now)) for p, v in projects.items()])
+        metric('transfer_last_progress_timestamp_seconds', 'gauge', 'Unix time of the last byte sent.',
+               [({'project': p}, v['last']) for p, v in projects.items()])
+        metric('transfer_files', 'gauge', 'Files by state.',
+               [({'project': p, 'state': s}, v[s]) for p, v in projects.items()
+                for s in ('active', 'done', 'failed', 'stalled')])
+
+        # per file series only while the file is in flight, to bound cardinality
+        active = [(k, f) for k, f in files.items() if f['state'] == 'active']
+        metric('transfer_file_bytes', 'gauge', 'Bytes sent of a file in flight.',
+               [({'project': f['project'], 'file': os.path.basename(k)}, f['bytes']) for k, f in active])
+        metric('transfer_file_rate_bytes_per_second', 'gauge', 'Rate of a file in flight.',
+               [({'project': f['project'], 'file': os.path.basename(k)}, rate(f['bytes'], f['start'], now))
+                for k, f in active])
+        metric('transfer_file_eta_seconds', 'gauge', 'Estimated seconds left for a file in flight.',
+               [({'project': f['project'], 'file': os.path.basename(k)}, eta(f['bytes'], f['total'], f['start'], now))
+                for k, f in active])
+
+        metric('aws_retries_total', 'counter', 'Retried AWS calls, by operation.',
+               [({'operation': op}, n) for op, n in retries.items()])
+        metric('aws_errors_total', 'counter', 'AWS calls failed after retries (error responses and transport errors), by operation.',
+               [({'operation': op}, n) for op, n in errors.items()])
+        return '\n'.join(out) + '\n'
+
+# periodic textfile writer and optional http endpoint
+class Exporter:
+    def __init__(self, metrics, textfile=None, port=None, interval=DEFAULT_INTERVAL):
+        self.metrics  = metrics
+        self.textfile = textfile
+        self.interval = interval
+        self.stop_evt = threading.Event()
+        self.server   = None
+        if port:
+            self.server = ThreadingHTTPServer(('127.0.0.1', int(port)), handler_for(metrics))
+            threading.Thread(target=self.server.serve_forever, name='metrics-http', daemon=True).start()
+            print("[+] Transfer metrics served on http://127.0.0.1:" + str(port) + "/metrics")
+        if textfile:
+            threading.Thread(target=self.loop, name='metrics-textfile', daemon=True).start()
+            print("[+] Transfer metrics written to", textfile)
+
+    def loop(self):
+        while not self.stop_evt.wait(self.interval):
+            self.write()
+
+    # atomic, the node exporter must never read a half written file
+    def write(self):
+        if not self.textfile:
+            return
+        os.makedirs(os.path.dirname(self.textfile) or '.', exist_ok=True)
+        tmp = self.textfile + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.metrics.render())
+        os.replace(tmp, self.textfile)
+
+    def stop(self):
+        self.stop_evt.set()
+        self.write()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+# http handler serving /metrics
+def handler_for(metrics):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+# project label of an s3 key (<db>/<project>/...)
+def project_of(key):
+    parts = str(key).split('/')
+    return parts[1] if len(parts) > 2 else parts[0]
+
+def rate(n, start, now):
+    return n / (now - start) if now > start else 0.0
+
+def eta(n, total, start, now):
+    r = rate(n, start, now)
+    if total <= n:
+        return 0.0
+    return (total - n) / r if r else -1
+
+def labels_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"') + '"'
+                          for k, v in labels.items()) + '}'
+
+def format_value(value):
+    return str(round(value, 3)) if isinstance(value, float) else str(value)
+
+###############
+## Registry  ##
+###############
+
+# metrics of the process, calls below do nothing until start()
+active   = None
+exporter = None
+
+# read metrics settings from the aws config, with defaults
+def metrics_settings(aws_conf):
+    metrics = aws_conf['aws'].get('metrics', {})
+    return metrics.get('textfile'), metrics.get('port'), metrics.get('interval', DEFAULT_INTERVAL)
+
+# start collecting and exporting, nothing happens when neither textfile nor port is set
+def start(aws_conf):
+    global active, exporter
+    textfile, port, interval = metrics_settings(aws_conf)
+    if not textfile and not port:
+        return None
+    active   = Metrics()
+    exporter = Exporter(active, textfile, port, interval)
+    return active
+
+# last export, then stop the exporter
+def stop():
+    global exporter
+    if exporter:
+        exporter.stop()
+        exporter = None
+
+def expect(key, size):
+    if active is not None:
+        active.expect(key, size)
+
+def progress(key, n):
+    if active is not None:
+        active.progress(key, n)
+
+def finish(key, ok=True):
+    if active is not None:
+        active.finish(key, ok)
+
+# count retries and errors of a botocore client
+def instrument(client):
+    def on_call(**kwargs):
+        if active is not None:
+            active.on_call(**kwargs)
+    def on_error(**kwargs):
+        if active is not None:
+            active.on_error(**kwargs)
+    client.meta.events.register('after-call', on_call)
+    client.meta.events.register('after-call-error', on_error)
+    return client
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from boto3.s3.transfer import TransferConfig
+import run_trace
+import transfer_metrics
+import fastq_compress
+
+###############
+## Constants ##
+###############
+
+MB = 1024 * 1024
+
+# files below this size are sent with a single PUT
+SINGLE_PART_LIMIT = 64 * MB
+
+# part size bounds (S3 allows 5MB..5GB parts and at most 10,000 parts)
+MIN_PART_SIZE = 8 * MB
+MAX_PART_SIZE = 512 * MB
+TARGET_PARTS  = 1000
+
+# default global budget
+DEFAULT_WORKERS         = 4
+DEFAULT_MAX_CONCURRENCY = 16
+
+###############
+## Functions ##
+###############
+
+# worker count and concurrency budget: CLI first, then aws.transfer config, then defaults
+def transfer_settings(aws_conf, opt=None):
+    transfer = aws_conf['aws'].get('transfer', {})
+    workers  = getattr(opt, 'workers', None) or transfer.get('workers', DEFAULT_WORKERS)
+    max_concurrency = (getattr(opt, 'max_concurrency', None)
+                       or transfer.get('max_concurrency', DEFAULT_MAX_CONCURRENCY))
+    return workers, max_concurrency
+
+# choose part size for a file so the part count stays reasonable
+def part_size_for(size):
+    part = MIN_PART_SIZE
+    while size / part > TARGET_PARTS and part < MAX_PART_SIZE:
+        part *= 2
+    return part
+
+# build a TransferConfig adapted to file size and its share of the budget
+def transfer_config_for(size, threads):
+    if size < SINGLE_PART_LIMIT:
+        # one request, no point in extra threads
+        return TransferConfig(multipart_threshold=SINGLE_PART_LIMIT,
+                              max_concurrency=1,
+                              use_threads=False)
+
+    part  = part_size_for(size)
+    parts = -(-size // part)
+    return TransferConfig(multipart_threshold=SINGLE_PART_LIMIT,
+                          multipart_chunksize=part,
+                          max_concurrency=max(1, min(threads, parts)))
+
+# split the global concurrency budget between the file workers
+def split_budget(n_files, workers, max_concurrency):
+    workers = max(1, min(workers, n_files))
+    threads = max(1, max_concurrency // workers)
+    return workers, threads
+
+# list local sequence files to upload
+def list_fastq(directory, suffixes=('.fastq.gz',)):
+    files = []
+    for filename in os.listdir(directory):
+        ff = os.path.join(directory, filename)
+        # checking if it is a file
+        if os.path.isfile(ff) and ff.endswith(suffixes):
+            files.append((filename, ff, os.path.getsize(ff)))
+    # biggest files first so the pool drains evenly
+    files.sort(key=lambda f: f[2], reverse=True)
+    return files
+
+# sequence files of a directory, plain .fastq listed under the .fastq.gz name they are uploaded as
+def list_sequences(directory):
+    files = list_fastq(directory)
+    names = set(f[0] for f in files)
+    for filename, path, size in list_fastq(directory, ('.fastq',)):
+        if filename + '.gz' in names:
+            print("[*] File, ", filename, " skipped, ", filename + ".gz", " already in the directory")
+            continue
+        files.append((filename + '.gz', path, size))
+    files.sort(key=lambda f: f[2], reverse=True)
+    return files
+
+# plain fastq, gzipped while it is uploaded
+def is_plain(path):
+    return path.endswith('.fastq')
+
+# s3 key for an uploaded sample file
+def sample_key(db, pName, filename):
+    return str(db)+"/"+str(pName)+"/backups/sample/"+str(filename)
+
+# upload a single file with its own TransferConfig
+def upload_one(s3, bucket, key, path, size, threads):
+    if is_plain(path):
+        return fastq_compress.upload_compressed(s3, bucket, key, path, size, threads, part_size_for(size))
+    config = transfer_config_for(size, threads)
+    start  = time.time()
+    with open(path, 'rb') as f:
+        s3.upload_fileobj(f, bucket, key, Config=config,
+                          Callback=lambda n: transfer_metrics.progress(key, n))
+    return time.time() - start
+
+# upload every sequence file in a directory through a bounded worker pool
+def upload_directory(s3, directory, bucket, db, pName,
+                     workers=DEFAULT_WORKERS, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                     uploader=None, files=None):
+    '''
+    s3 must be a single client shared by every worker,
+    its connection pool should fit max_concurrency.
+    '''
+    if files is None:
+        files = list_sequences(directory)
+    if not files:
+        print("[-] No .fastq.gz or .fastq files found in ", str(directory))
+        return {'files': 0, 'bytes': 0, 'seconds': 0.0, 'failed': []}
+
+    workers, threads = split_budget(len(files), workers, max_concurrency)
+    uploader = uploader or upload_one
+    total = sum(f[2] for f in files)
+    print("[*] Uploading", len(files), "files,", round(total / MB, 1), "MB with",
+          workers, "workers x", threads, "threads")
+
+    done   = []
+    failed = []
+    start  = time.time()
+
+    with run_trace.span('upload', project=pName, files=len(files)) as rec, \
+         ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for filename, path, size in files:
+            key = sample_key(db, pName, filename)
+            transfer_metrics.expect(key, size)
+            fut = pool.submit(run_trace.carry(uploader), s3, bucket, key, path, size, threads)
+            futures[fut] = (filename, size, key)
+
+        for fut in as_completed(futures):
+            filename, size, key = futures[fut]
+            try:
+                secs = fut.result()
+            except Exception as e:
+                print("[-] File, ", filename, " can not be uploaded")
+                print(e)
+                failed.append(filename)
+                transfer_metrics.finish(key, ok=False)
+                continue
+            transfer_metrics.finish(key)
+            done.append(size)
+            rate = size / MB / secs if secs else 0.0
+            print("[+] File, ", filename, " uploaded to S3 (", round(rate, 1), "MB/s )")
+        rec['bytes']  = sum(done)
+        rec['failed'] = len(failed)
+
+    elapsed = time.time() - start
+    sent    = sum(done)
+    report_throughput(len(done), sent, elapsed)
+    if failed:
+        print("[-]", len(failed), "files failed:", ", ".join(failed))
+
+    return {'files': len(done), 'bytes': sent, 'seconds': elapsed, 'failed': failed}
+
+# print aggregate throughput of an upload
+def report_throughput(n_files, n_bytes, seconds):
+    rate = n_bytes / MB / seconds if seconds else 0.0
+    print("[+] Uploaded", n_files, "files,", round(n_bytes / MB, 1), "MB in",
+          round(seconds, 1), "s (", round(rate, 1), "MB/s )")
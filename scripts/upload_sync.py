@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+import upload_engine
+import checksums
+import fastq_compress
+import transfer_metrics
+
+###############
+## Constants ##
+###############
+
+MANIFEST_NAME = '.upload_manifest.json'
+
+###############
+## Functions ##
+###############
+
+# local manifest of uploaded files, one per source directory
+class UploadManifest:
+    def __init__(self, directory, bucket, prefix):
+        self.path   = os.path.join(directory, MANIFEST_NAME)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.lock   = threading.Lock()
+        self.files  = {}
+        self.load()
+
+    # read manifest from disk, ignore it if it belongs to another destination
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except Exception as e:
+            print("[-] Upload manifest unreadable, starting a new one")
+            print(e)
+            return
+        if data.get('bucket') == self.bucket and data.get('prefix') == self.prefix:
+            self.files = data.get('files', {})
+
+    # write manifest atomically
+    def save(self):
+        with self.lock:
+            data = {'bucket': self.bucket, 'prefix': self.prefix, 'files': self.files}
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(data, f, indent=1)
+            os.replace(tmp, self.path)
+
+    def get(self, filename):
+        with self.lock:
+            return self.files.get(filename)
+
+    def update(self, filename, **fields):
+        with self.lock:
+            self.files.setdefault(filename, {}).update(fields)
+        self.save()
+
+    # record a finished part of a multipart upload
+    def add_part(self, filename, number, etag):
+        with self.lock:
+            self.files[filename].setdefault('parts', {})[str(number)] = etag
+        self.save()
+
+# list destination prefix once
+def list_remote(s3, bucket, prefix):
+    remote = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            remote[obj['Key']] = {'size': obj['Size'], 'etag': obj['ETag'].strip('"')}
+    return remote
+
+# stat a local file into the fields kept by the manifest
+def local_stat(path):
+    st = os.stat(path)
+    return st.st_size, int(st.st_mtime)
+
+# decide if a local file is already complete at the destination,
+# a gzipped plain file differs in size from its object so only the manifest can tell
+def is_complete(entry, size, mtime, remote, compressed=False):
+    if remote is None or (remote['size'] != size and not compressed):
+        return False
+    if entry is None:
+        # uploaded before the manifest existed, trust the size
+        return not compressed
+    return (entry.get('size') == size and entry.get('mtime') == mtime
+            and entry.get('etag') == remote['etag'] and not entry.get('upload_id'))
+
+# fetch parts already stored for an interrupted multipart upload
+def list_done_parts(s3, bucket, key, upload_id):
+    parts = {}
+    paginator = s3.get_paginator('list_parts')
+    for page in paginator.paginate(Bucket=bucket, Key=key, UploadId=upload_id):
+        for part in page.get('Parts', []):
+            parts[part['PartNumber']] = part['ETag'].strip('"')
+    return parts
+
+# read one part of a file from disk
+def read_part(path, offset, length):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+# upload a file as a multipart upload that can be resumed from the manifest,
+# hashing it on the way when given a digest
+def resumable_upload(s3, bucket, key, path, size, threads, manifest, digest=None):
+    filename = os.path.basename(path)
+    _, mtime = local_stat(path)
+    start = time.time()
+
+    if size < upload_engine.SINGLE_PART_LIMIT:
+        with open(path, 'rb') as f:
+            body = checksums.HashingReader(f, digest) if digest is not None else f
+            resp = s3.put_object(Bucket=bucket, Key=key, Body=body)
+        transfer_metrics.progress(key, size)
+        if digest is not None and body.hashed != size:
+            raise ValueError("only " + str(body.hashed) + " of " + str(size) + " bytes hashed for " + key)
+        manifest.update(filename, key=key, size=size, mtime=mtime,
+                        etag=resp['ETag'].strip('"'), upload_id=None, parts={})
+        return time.time() - start
+
+    entry = manifest.get(filename) or {}
+    done  = {}
+    upload_id = entry.get('upload_id')
+    if upload_id and (entry.get('size') != size or entry.get('mtime') != mtime):
+        # local file changed since the interrupted attempt
+        print("[-] File, ", filename, " changed locally, restarting upload")
+        try:
+            s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        except ClientError:
+            pass
+        upload_id = None
+
+    if upload_id:
+        try:
+            done = list_done_parts(s3, bucket, key, upload_id)
+            part_size = entry['part_size']
+            print("[*] Resuming ", filename, ":", len(done), "parts already uploaded")
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchUpload':
+                raise
+            upload_id = None
+
+    if not upload_id:
+        part_size = upload_engine.part_size_for(size)
+        upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        manifest.update(filename, key=key, size=size, mtime=mtime, etag=None,
+                        upload_id=upload_id, part_size=part_size, parts={})
+
+    n_parts = -(-size // part_size)
+
+    # read one part from disk
+    def part_body(number):
+        offset = (number - 1) * part_size
+        return read_part(path, offset, min(part_size, size - offset))
+
+    # parts sent by an earlier run are read back once for the whole-file digests
+    feed = None
+    if digest is not None:
+        digest.part_size = part_size
+        feed = checksums.PartFeed(digest, n_parts, part_body, skip=done)
+
+    # send one missing part
+    def send(number):
+        body = part_body(number)
+        if feed is not None:
+            feed.add(number, body)
+        resp = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+                              PartNumber=number, Body=body)
+        etag = resp['ETag'].strip('"')
+        manifest.add_part(filename, number, etag)
+        transfer_metrics.progress(key, len(body))
+        return number, etag
+
+    missing = [n for n in range(1, n_parts + 1) if n not in done]
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        for number, etag in pool.map(send, missing):
+            done[number] = etag
+    if feed is not None and not feed.finish():
+        raise ValueError("parts missing from the digest of " + key)
+
+    resp = s3.complete_multipart_upload(
+        Bucket=bucket, Key=key, UploadId=upload_id,
+        MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': '"' + done[n] + '"'}
+                                   for n in sorted(done)]})
+    manifest.update(filename, etag=resp['ETag'].strip('"'), upload_id=None, parts={})
+    return time.time() - start
+
+# gzip a plain file into its object, compression is not resumable so it starts over
+def compressed_upload(s3, bucket, key, path, size, threads, manifest, checksum_manifest=None):
+    filename = os.path.basename(key)
+    _, mtime = local_stat(path)
+    start  = time.time()
+    digest = checksums.Digest(upload_engine.part_size_for(size)) if checksum_manifest else None
+    resp   = fastq_compress.compress_upload(s3, bucket, key, path, upload_engine.part_size_for(size), digest)
+    etag   = resp['ETag'].strip('"')
+    if digest is not None:
+        checksums.seal(s3, bucket, key, checksums.sealed_layout(digest, checksum_manifest), threads, checksum_manifest)
+        # the metadata copy may have changed the ETag
+        etag = digest.etag()
+    manifest.update(filename, key=key, size=size, mtime=mtime, etag=etag, upload_id=None, parts={})
+    return time.time() - start
+
+# upload only what is missing or incomplete at the destination
+def sync_directory(s3, directory, bucket, db, pName,
+                   workers=upload_engine.DEFAULT_WORKERS,
+                   max_concurrency=upload_engine.DEFAULT_MAX_CONCURRENCY,
+                   checksum_manifest=None):
+    prefix   = upload_engine.sample_key(db, pName, '')
+    manifest = UploadManifest(directory, bucket, prefix)
+    remote   = list_remote(s3, bucket, prefix)
+    print("[+] Destination listed,", len(remote), "objects under", prefix)
+
+    pending = []
+    skipped = 0
+    for filename, path, size in upload_engine.list_sequences(directory):
+        key = upload_engine.sample_key(db, pName, filename)
+        size, mtime = local_stat(path)
+        entry = manifest.get(filename)
+        if is_complete(entry, size, mtime, remote.get(key), upload_engine.is_plain(path)):
+            if entry is None:
+                manifest.update(filename, key=key, size=size, mtime=mtime,
+                                etag=remote[key]['etag'], upload_id=None, parts={})
+            skipped += 1
+            continue
+        pending.append((filename, path, size))
+
+    print("[+]", skipped, "files already complete,", len(pending), "to upload")
+    if not pending:
+        return {'files': 0, 'bytes': 0, 'seconds': 0.0, 'failed': []}
+
+    # bind the manifest into the engine's uploader signature
+    def uploader(s3, bucket, key, path, size, threads):
+        if upload_engine.is_plain(path):
+            return compressed_upload(s3, bucket, key, path, size, threads, manifest, checksum_manifest)
+        if checksum_manifest is None:
+            return resumable_upload(s3, bucket, key, path, size, threads, manifest)
+        digest = checksums.Digest()
+        secs = resumable_upload(s3, bucket, key, path, size, threads, manifest, digest)
+        checksums.seal(s3, bucket, key, digest, threads, checksum_manifest)
+        return secs
+
+    return upload_engine.upload_directory(s3, directory, bucket, db, pName,
+                                          workers=workers, max_concurrency=max_concurrency,
+                                          uploader=uploader, files=pending)
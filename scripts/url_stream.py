@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+import os
+import time
+import asyncio
+import hashlib
+import functools
+import urllib.request
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+import run_trace
+import stream_upload
+import transfer_metrics
+
+###############
+## Constants ##
+###############
+
+READ_BLOCK = 1024 * 1024
+HTTP_TIMEOUT = 60
+
+DEFAULT_CONCURRENCY = 16
+DEFAULT_PER_HOST    = 4
+DEFAULT_MAX_URLS    = 50
+
+###############
+## Functions ##
+###############
+
+# read direct mode settings from the aws config, with defaults
+def direct_settings(aws_conf):
+    direct = aws_conf['aws'].get('direct', {})
+    return {
+        'auto':        direct.get('auto', False),
+        'max_urls':    direct.get('max_urls', DEFAULT_MAX_URLS),
+        'concurrency': direct.get('concurrency', DEFAULT_CONCURRENCY),
+        'per_host':    direct.get('per_host', DEFAULT_PER_HOST),
+    }
+
+# read (url, expected md5 or None) pairs from a fileseqs file
+def read_fileseqs(path):
+    entries = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            entries.append((fields[0], fields[1].lower() if len(fields) > 1 else None))
+    return entries
+
+# decide if a fileseqs file is streamed from this process instead of an EC2 instance
+def use_direct(opt, aws_conf):
+    if opt.direct:
+        return True
+    settings = direct_settings(aws_conf)
+    return settings['auto'] and len(read_fileseqs(opt.seqs)) <= settings['max_urls']
+
+# s3 key of a downloaded sequence
+def url_key(db, pName, url):
+    name = os.path.basename(urlparse(url).path)
+    return str(db)+"/"+str(pName)+"/backups/sample/"+name
+
+# keys more than one url would be stored under, key -> urls
+def duplicate_keys(entries, db, pName):
+    urls = {}
+    for url, expected in entries:
+        urls.setdefault(url_key(db, pName, url), []).append(url)
+    return {key: found for key, found in urls.items() if len(found) > 1}
+
+# stream one url into a multipart upload, downloading part n+1 while part n uploads
+async def stream_one(run, s3, bucket, key, url, expected_md5, part_size):
+    md5, sha = hashlib.md5(), hashlib.sha256()
+    total  = 0
+    parts  = []
+    number = 0
+    buf    = bytearray()
+    pending = None
+    start  = time.time()
+    resp   = None
+    upload_id = None
+
+    # send one part, returns its entry for complete_multipart_upload
+    def send(n, body):
+        resp = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=n, Body=body)
+        transfer_metrics.progress(key, len(body))
+        return {'PartNumber': n, 'ETag': resp['ETag']}
+
+    try:
+        resp = await run(urllib.request.urlopen, url, timeout=HTTP_TIMEOUT)
+        length = resp.headers.get('Content-Length')
+        transfer_metrics.expect(key, int(length or 0))
+        upload_id = (await run(s3.create_multipart_upload, Bucket=bucket, Key=key,
+                               Metadata={'source-url': url[:1024]}))['UploadId']
+
+        while True:
+            data = await run(resp.read, READ_BLOCK)
+            if data:
+                md5.update(data)
+                sha.update(data)
+                buf += data
+                total += len(data)
+            if len(buf) >= part_size or (not data and (buf or number == 0)):
+                number += 1
+                body = bytes(buf)
+                buf.clear()
+                if pending is not None:
+                    parts.append(await pending)
+                pending = asyncio.ensure_future(run(send, number, body))
+            if not data:
+                break
+        if pending is not None:
+            parts.append(await pending)
+
+        # verify before the object becomes visible
+        if length is not None and int(length) != total:
+            raise ValueError("truncated download, " + str(total) + " of " + length + " bytes")
+        if expected_md5 and md5.hexdigest() != expected_md5:
+            raise ValueError("md5 mismatch, expected " + expected_md5 + " got " + md5.hexdigest())
+
+        done = await run(s3.complete_multipart_upload, Bucket=bucket, Key=key, UploadId=upload_id,
+                         MultipartUpload={'Parts': parts})
+    except BaseException:
+        if pending is not None and not pending.done():
+            await asyncio.wait([pending])
+        if upload_id is not None:
+            await run(s3.abort_multipart_upload, Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+    finally:
+        if resp is not None:
+            resp.close()
+
+    return {'bytes': total, 'md5': md5.hexdigest(), 'sha256': sha.hexdigest(),
+            'etag': done['ETag'].strip('"'), 'seconds': time.time() - start}
+
+# download every url of a fileseqs file straight into S3
+async def stream_all(s3, entries, bucket, db, pName, concurrency, per_host, part_size):
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=concurrency * 2)
+
+    def run(func, *args, **kwargs):
+        return loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+    global_sem = asyncio.Semaphore(concurrency)
+    host_sems  = {}
+
+    async def one(url, expected):
+        host = urlparse(url).netloc
+        sem  = host_sems.setdefault(host, asyncio.Semaphore(per_host))
+        key  = url_key(db, pName, url)
+        async with global_sem, sem:
+            try:
+                res = await stream_one(run, s3, bucket, key, url, expected, part_size)
+                print("[+] File, ", os.path.basename(key), " streamed to S3 (", res['bytes'], "bytes, md5", res['md5'], ")")
+                res.update({'url': url, 'key': key, 'ok': True})
+            except Exception as e:
+                print("[-] File, ", url, " can not be streamed")
+                print(e)
+                res = {'url': url, 'key': key, 'ok': False, 'error': str(e)}
+            transfer_metrics.finish(key, res['ok'])
+            return res
+
+    try:
+        return await asyncio.gather(*(one(url, expected) for url, expected in entries))
+    finally:
+        executor.shutdown(wait=False)
+
+# main entry: stream a fileseqs file without any EC2 instance
+def stream_fileseqs(s3, path, bucket, db, pName, concurrency=DEFAULT_CONCURRENCY,
+                    per_host=DEFAULT_PER_HOST, part_size=stream_upload.PART_SIZE, manifest=None):
+    '''
+    s3 is a boto3 client, its connection pool should fit concurrency.
+    Memory stays around two parts per concurrent download.
+    Digests of streamed files are added to the checksum manifest when given.
+    '''
+    entries = read_fileseqs(path)
+    # objects are keyed by basename, a second url would silently replace the first
+    clashes = duplicate_keys(entries, db, pName)
+    if clashes:
+        print("[-] Several URLs share a file name, nothing streamed:")
+        for key, urls in sorted(clashes.items()):
+            print(" -", os.path.basename(key) + ":", ", ".join(urls))
+        return False
+    print("[*] Streaming", len(entries), "URLs to S3,", concurrency, "at once,", per_host, "per host")
+    start   = time.time()
+    with run_trace.span('upload', project=pName, files=len(entries)) as rec:
+        results = asyncio.run(stream_all(s3, entries, bucket, db, pName, concurrency, per_host, part_size))
+        ok = [r for r in results if r['ok']]
+        rec['bytes']  = sum(r['bytes'] for r in ok)
+        rec['failed'] = len(results) - len(ok)
+    elapsed = time.time() - start
+
+    if manifest is not None:
+        for r in ok:
+            manifest.add(os.path.basename(r['key']), r['key'],
+                         {'size': r['bytes'], 'md5': r['md5'], 'sha256': r['sha256'], 'etag': r['etag']})
+        manifest.save()
+    total = sum(r['bytes'] for r in ok)
+    print("[+] Streamed", len(ok), "of", len(results), "files,", round(total / 1024 ** 2, 1), "MB in",
+          round(elapsed, 1), "s (", round(total / 1024 ** 2 / elapsed, 1) if elapsed else 0.0, "MB/s )")
+    return len(ok) == len(results)
@@ -0,0 +1,51 @@
+import os
+import sys
+
+import boto3
+import pytest
+from moto import mock_aws
+
+# the scripts import each other by module name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+
+# bucket the s3 fixture creates, override in a module for another name
+@pytest.fixture
+def bucket():
+    return 'seqs'
+
+
+# moto in place of AWS, with fake credentials
+@pytest.fixture
+def aws(monkeypatch):
+    for var in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SECURITY_TOKEN', 'AWS_SESSION_TOKEN'):
+        monkeypatch.setenv(var, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        yield
+
+
+# moto s3 client with the bucket created
+@pytest.fixture
+def s3(aws, bucket):
+    client = boto3.client('s3', region_name='us-east-1')
+    client.create_bucket(Bucket=bucket)
+    return client
+
+
+# moto ec2 client
+@pytest.fixture
+def ec2(aws):
+    return boto3.client('ec2', region_name='us-east-1')
+
+
+# aws config of the scripts, pointing at the bucket and a history under tmp_path
+@pytest.fixture
+def aws_conf(bucket, tmp_path):
+    return {'aws': {
+        'credentials': {'access_key': 'testing', 'secret_key': 'testing', 'region': 'us-east-1'},
+        's3_bucket_seqs': {'name': bucket},
+        'ec2_type': {'seqs': 't2.micro', 'pipe': 'c5.9xlarge'},
+        'sizing': {'enabled': True},
+        'history': {'path': str(tmp_path / 'history.db')},
+    }}
@@ -0,0 +1,25 @@
+import shlex
+
+import boto3
+
+import aws_upload_seqs
+
+BUCKET = 'seqs'
+
+
+def test_compressed_fileseqs_is_expanded_for_the_instance(s3, tmp_path):
+    urls = ''.join('https://example.org/run/s%d_R1.fastq.gz\n' % i for i in range(5000))
+    path = tmp_path / 'fileseqs.txt'
+    path.write_text(urls)
+
+    assert aws_upload_seqs.upload_seqs_s3(str(path), boto3.resource('s3', region_name='us-east-1'),
+                                          '16s', 'p1', compress=True, bucket=BUCKET)
+    assert s3.head_object(Bucket=BUCKET, Key=aws_upload_seqs.fileseqs_key('16s', 'p1', True))
+
+    # the instance runs the command with its own boto3, here it runs in-process against moto
+    command = shlex.split(aws_upload_seqs.inflate_command(BUCKET, '16s', 'p1'))
+    assert command[:2] == ['python3', '-c']
+    exec(command[2], {})
+
+    body = s3.get_object(Bucket=BUCKET, Key=aws_upload_seqs.fileseqs_key('16s', 'p1'))['Body'].read()
+    assert body.decode() == urls
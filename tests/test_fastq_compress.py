@@ -0,0 +1,33 @@
+import gzip
+import io
+import os
+
+import fastq_compress
+
+BUCKET = 'seqs'
+
+
+def fastq(n):
+    return b''.join(b'@r%d\nACGTACGTAC\n+\nIIIIIIIIII\n' % i for i in range(n))
+
+
+def test_gzip_blocks_round_trip():
+    data   = fastq(5000)
+    blocks = list(fastq_compress.gzip_blocks(io.BytesIO(data), block_size=16 * 1024))
+    assert len(blocks) > 1
+    assert sum(n for n, member in blocks) == len(data)
+    assert gzip.decompress(b''.join(member for n, member in blocks)) == data
+
+
+def test_gzip_blocks_empty_file():
+    blocks = list(fastq_compress.gzip_blocks(io.BytesIO(b'')))
+    assert [n for n, member in blocks] == [0]
+    assert gzip.decompress(blocks[0][1]) == b''
+
+
+def test_compress_upload_round_trip(s3, tmp_path):
+    data = fastq(2000)
+    path = tmp_path / 's1_R1.fastq'
+    path.write_bytes(data)
+    fastq_compress.compress_upload(s3, BUCKET, 's1_R1.fastq.gz', str(path), 5 * 1024 * 1024)
+    assert gzip.decompress(s3.get_object(Bucket=BUCKET, Key='s1_R1.fastq.gz')['Body'].read()) == data
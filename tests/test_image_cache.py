@@ -0,0 +1,137 @@
+import json
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import image_cache
+
+IMAGE = 'danova/nextflow-aws:22.04.3'
+TOKEN = 'secret-token'
+
+
+# registry serving one digest per repo:tag behind an anonymous bearer token
+class Registry:
+    def __init__(self):
+        self.digests = {}
+        self.tokens  = []
+        self.heads   = []
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path != '/token':
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                registry.tokens.append(parse_qs(url.query))
+                body = json.dumps({'token': TOKEN}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_HEAD(self):
+                registry.heads.append((self.path, self.headers.get('Accept')))
+                if self.headers.get('Authorization') != 'Bearer ' + TOKEN:
+                    self.send_response(401)
+                    self.send_header('WWW-Authenticate', 'Bearer realm="' + registry.url + '/token",'
+                                     'service="registry.test",scope="repository:danova/nextflow-aws:pull"')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                digest = registry.digests.get(self.path)
+                if digest is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Docker-Content-Digest', digest)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        self.httpd  = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url    = 'http://127.0.0.1:' + str(self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def serve(self, repo, tag, digest):
+        self.digests['/v2/' + repo + '/manifests/' + tag] = digest
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def registry():
+    reg = Registry()
+    yield reg
+    reg.stop()
+
+
+def conf(registry_url, tmp_path):
+    return {'aws': {'pipeline': {'image': IMAGE, 'registry': registry_url,
+                                 'image_cache': str(tmp_path / 'images.json')}}}
+
+
+def test_resolve_digest_token_flow(registry):
+    registry.serve('danova/nextflow-aws', '22.04.3', 'sha256:aaa')
+    assert image_cache.resolve_digest(registry.url, 'danova/nextflow-aws', '22.04.3') == 'sha256:aaa'
+    # first HEAD is challenged, the second carries the token
+    assert len(registry.heads) == 2
+    assert registry.tokens == [{'service': ['registry.test'], 'scope': ['repository:danova/nextflow-aws:pull']}]
+    assert 'manifest.list.v2+json' in registry.heads[0][1]
+
+
+def test_resolve_digest_unknown_tag(registry):
+    with pytest.raises(image_cache.urllib.error.HTTPError):
+        image_cache.resolve_digest(registry.url, 'danova/nextflow-aws', 'missing')
+
+
+def test_image_for_run_pins_digest(registry, tmp_path):
+    registry.serve('danova/nextflow-aws', '22.04.3', 'sha256:aaa')
+    aws_conf = conf(registry.url, tmp_path)
+    assert image_cache.image_for_run(aws_conf, 'p1') == ('danova/nextflow-aws@sha256:aaa', 'missing')
+    cache = json.loads((tmp_path / 'images.json').read_text())
+    assert cache[IMAGE]['digest'] == 'sha256:aaa'
+    assert cache[IMAGE]['runs'][-1]['project'] == 'p1'
+
+
+def test_digest_change_pulls_new_image(registry, tmp_path):
+    aws_conf = conf(registry.url, tmp_path)
+    registry.serve('danova/nextflow-aws', '22.04.3', 'sha256:aaa')
+    image_cache.image_for_run(aws_conf, 'p1')
+    # the tag moved, instances holding the old digest must pull the new one
+    registry.serve('danova/nextflow-aws', '22.04.3', 'sha256:bbb')
+    ref, pull = image_cache.image_for_run(aws_conf, 'p2')
+    assert ref == 'danova/nextflow-aws@sha256:bbb'
+    assert pull == 'missing'
+    cache = json.loads((tmp_path / 'images.json').read_text())
+    assert [r['digest'] for r in cache[IMAGE]['runs']] == ['sha256:aaa', 'sha256:bbb']
+
+
+def test_unreachable_registry_uses_last_digest(registry, tmp_path):
+    aws_conf = conf(registry.url, tmp_path)
+    registry.serve('danova/nextflow-aws', '22.04.3', 'sha256:aaa')
+    image_cache.image_for_run(aws_conf, 'p1')
+    registry.stop()
+    assert image_cache.image_for_run(aws_conf, 'p2') == ('danova/nextflow-aws@sha256:aaa', 'missing')
+
+
+def test_unreachable_registry_without_cache_pulls_tag(tmp_path):
+    reg = Registry()
+    reg.stop()
+    assert image_cache.image_for_run(conf(reg.url, tmp_path), 'p1') == (IMAGE, 'always')
+
+
+def test_refresh_pulls_tag(registry, tmp_path):
+    registry.serve('danova/nextflow-aws', '22.04.3', 'sha256:aaa')
+    assert image_cache.image_for_run(conf(registry.url, tmp_path), 'p1', refresh=True) == (IMAGE, 'always')
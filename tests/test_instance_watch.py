@@ -0,0 +1,38 @@
+import threading
+
+import instance_watch
+
+
+def launch(ec2):
+    image = ec2.describe_images(Owners=['amazon'])['Images'][0]['ImageId']
+    return ec2.run_instances(ImageId=image, MinCount=1, MaxCount=1)['Instances'][0]['InstanceId']
+
+
+def test_one_poller_for_concurrent_callers(ec2, monkeypatch):
+    watcher = instance_watch.InstanceWatcher(ec2, interval=0.05)
+    started = []
+    real = threading.Thread.start
+
+    def start(self):
+        if self._target == watcher.poll_loop:
+            started.append(self)
+        return real(self)
+
+    monkeypatch.setattr(threading.Thread, 'start', start)
+    go = threading.Barrier(8)
+    threads = [threading.Thread(target=lambda: (go.wait(), watcher.ensure_started())) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(started) == 1
+
+
+def test_released_instances_leave_the_poll(ec2):
+    watcher = instance_watch.InstanceWatcher(ec2, interval=0.05)
+    first, second = launch(ec2), launch(ec2)
+    assert watcher.wait_running(first, timeout=5)['state'] == 'running'
+    watcher.watch(second)
+    watcher.unwatch(first)
+    assert watcher.watched == {second}
+    assert first not in watcher.states()
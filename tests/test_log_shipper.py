@@ -0,0 +1,64 @@
+import gzip
+import json
+
+
+import log_shipper
+
+BUCKET = 'seqs'
+
+
+# s3 client that can be taken offline
+class Flaky:
+    def __init__(self, s3):
+        self.s3   = s3
+        self.down = False
+
+    def put_object(self, **kwargs):
+        if self.down:
+            raise IOError('S3 unreachable')
+        return self.s3.put_object(**kwargs)
+
+
+def index_of(s3, shipper):
+    return json.loads(s3.get_object(Bucket=BUCKET, Key=shipper.prefix + 'index.json')['Body'].read())
+
+
+def test_chunks_concatenate_to_the_log(s3):
+    shipper = log_shipper.LogShipper(s3, BUCKET, '16s', 'p1', 'pipeline_p1', flush_seconds=3600)
+    for i in range(3):
+        shipper.write('stdout', 'line ' + str(i))
+        shipper.cut()
+    shipper.close()
+
+    index = index_of(s3, shipper)
+    assert index['complete'] and index['gaps'] == []
+    chunks = index['chunks']
+    assert chunks[0]['offset'] == 0
+    assert all(a['offset'] + a['length'] == b['offset'] for a, b in zip(chunks, chunks[1:]))
+    data = gzip.decompress(b''.join(s3.get_object(Bucket=BUCKET, Key=c['key'])['Body'].read()
+                                    for c in index['chunks'])).decode()
+    assert [l.split('] ', 1)[1] for l in data.splitlines()] == ['line 0', 'line 1', 'line 2']
+    assert log_shipper.fetch_range(s3, BUCKET, index, offset=index['chunks'][1]['offset'],
+                                   length=index['chunks'][1]['length']).decode().endswith('line 1\n')
+
+
+def test_dropped_chunks_are_recorded_as_gaps(s3, monkeypatch):
+    monkeypatch.setattr(log_shipper, 'MAX_PENDING', 2)
+    flaky   = Flaky(s3)
+    shipper = log_shipper.LogShipper(flaky, BUCKET, '16s', 'p1', 'pipeline_p1', flush_seconds=3600)
+    flaky.down = True
+    for i in range(4):
+        shipper.write('stdout', 'line ' + str(i))
+        shipper.cut()
+        shipper.ship()
+    flaky.down = False
+    shipper.close()
+
+    index = index_of(s3, shipper)
+    gaps, chunks = index['gaps'], index['chunks']
+    assert len(gaps) == 2 and len(chunks) == 2
+    # gaps and chunks cover the log without overlap or holes
+    spans = sorted((c['offset'], c['length']) for c in gaps + chunks)
+    assert spans[0][0] == 0
+    assert all(a[0] + a[1] == b[0] for a, b in zip(spans, spans[1:]))
+    assert index['bytes'] == spans[-1][0] + spans[-1][1]
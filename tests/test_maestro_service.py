@@ -0,0 +1,32 @@
+import maestro
+import maestro_service
+
+
+def job(**options):
+    return {'project_name': 'p1', 'db': '16s', 'seqs': 'seqs.txt', 'code': '2', 'link': 'https://gitlab.com/x',
+            'options': options}
+
+
+def test_validate_option_types():
+    assert maestro_service.validate(job(shards=4, sync=True, fetch_dir='out')) is None
+    assert maestro_service.validate(job(shards='4')) == "wrong option types shards (int)"
+    # JSON true is not a shard count, 1 is not a flag
+    assert maestro_service.validate(job(shards=True, pool=1)) == "wrong option types pool (bool), shards (int)"
+    assert maestro_service.validate(job(fetch_dir=3)) == "wrong option types fetch_dir (string)"
+
+
+def test_workflow_loads_config_once(s3, aws_conf, monkeypatch):
+    loads = []
+    def load_config():
+        loads.append(1)
+        return aws_conf
+    monkeypatch.setattr(maestro.main_pipe, 'load_config', load_config)
+    monkeypatch.setattr(maestro.main_upload, 'load_config', load_config)
+    monkeypatch.setattr(maestro.run_history.aws_deploy, 'load_config', load_config)
+    seen = []
+    monkeypatch.setattr(maestro, 'main_pipes', lambda opt, watcher, launched, conf: seen.append(conf) or True)
+
+    opt = maestro_service.job_options(dict(job(), code='3'))
+    assert maestro.run_workflow(opt)
+    assert loads == [1]
+    assert seen == [aws_conf]
@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+import results_fetch
+
+BUCKET = 'results'
+
+
+@pytest.fixture
+def bucket():
+    return BUCKET
+
+
+def put(s3, rel, body):
+    s3.put_object(Bucket=BUCKET, Key=results_fetch.results_prefix('p1') + rel, Body=body)
+
+
+def test_local_path(tmp_path):
+    dest = str(tmp_path)
+    assert results_fetch.local_path(dest, 'multiqc//report.html') == os.path.join(dest, 'multiqc', 'report.html')
+    assert results_fetch.local_path(dest, 'a/../b.txt') == os.path.join(dest, 'b.txt')
+    assert results_fetch.local_path(dest, '../evil.txt') is None
+    assert results_fetch.local_path(dest, 'a/../../evil.txt') is None
+    assert results_fetch.local_path(dest, '/etc/evil.txt') is None
+    assert results_fetch.local_path(dest, 'a/..') is None
+
+
+def test_fetch_refuses_keys_outside_dest(s3, tmp_path):
+    put(s3, 'multiqc/report.html', b'report')
+    put(s3, '../../evil.txt', b'evil')
+    dest = tmp_path / 'out'
+
+    fetched, skipped, failed = results_fetch.fetch_results(s3, BUCKET, 'p1', str(dest))
+
+    assert (fetched, skipped, failed) == (1, 0, 1)
+    assert (dest / 'p1' / 'multiqc' / 'report.html').read_bytes() == b'report'
+    assert not (tmp_path / 'evil.txt').exists()
+    assert not (dest / 'evil.txt').exists()
+
+
+def test_fetch_again_skips_current_files(s3, tmp_path):
+    put(s3, 'table.tsv', b'a\tb\n')
+    assert results_fetch.fetch_results(s3, BUCKET, 'p1', str(tmp_path)) == (1, 0, 0)
+    assert results_fetch.fetch_results(s3, BUCKET, 'p1', str(tmp_path)) == (0, 1, 0)
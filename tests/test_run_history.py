@@ -0,0 +1,53 @@
+import optparse
+
+import maestro
+import run_history
+import sizing
+
+GB = sizing.GB
+
+
+def project(tmp_path, samples):
+    fileseqs = tmp_path / 'fileseqs.txt'
+    fileseqs.write_text(''.join('http://host/s%d_R%d.fastq.gz\n' % (i, r) for i in range(samples) for r in (1, 2)))
+    return optparse.Values({'project_name': 'p1', 'db': '16s', 'seqs': str(fileseqs), 'code': '2', 'shards': 1})
+
+
+def add_run(history, input_bytes, samples):
+    history.add({'run_id': 'old:1', 'project': 'old', 'db': '16s', 'code': 2, 'started_at': 1.0,
+                 'ok': 1, 'input_bytes': input_bytes, 'samples': samples}, {})
+
+
+def test_fileseqs_without_history_uses_configured_type(aws_conf, tmp_path):
+    plan = run_history.plan_fileseqs(aws_conf, project(tmp_path, 4))
+    assert plan['type'] == 'c5.9xlarge'
+    assert plan['samples'] == 4
+    assert plan['memory'] == '70g'
+
+
+def test_fileseqs_sized_from_bytes_per_sample(aws_conf, tmp_path):
+    add_run(run_history.open_history(aws_conf), 40 * GB, 10)
+    # 4 GB per sample, 8 samples
+    plan = run_history.plan_fileseqs(aws_conf, project(tmp_path, 8))
+    assert plan['type'] == 'c5.9xlarge'
+    assert plan['bytes'] == 32 * GB
+    plan = run_history.plan_fileseqs(aws_conf, project(tmp_path, 1))
+    assert plan['type'] == 'c5.2xlarge'
+
+
+def test_pipelined_plan_ignores_empty_prefix(s3, aws_conf, tmp_path):
+    opt = project(tmp_path, 200)
+    # nothing uploaded yet, listing S3 gives the smallest row
+    assert maestro.plan_pipe(opt, aws_conf)['type'] == 'c5.2xlarge'
+    assert maestro.plan_pipe(opt, aws_conf, uploaded=False)['type'] == 'c5.9xlarge'
+
+
+def test_record_keeps_launched_type(aws_conf, tmp_path):
+    opt = project(tmp_path, 4)
+    opt.code, opt.shards = '3', 3
+    timer = run_history.PhaseTimer()
+    for type in ('c5.4xlarge', 'c5.2xlarge', 'c5.4xlarge'):
+        timer.launched(type)
+    run = run_history.record_workflow(opt, timer, False, aws_conf)
+    assert run['instance_type'] == 'c5.4xlarge'
+    assert run_history.open_history(aws_conf).runs()[0]['instance_type'] == 'c5.4xlarge'
@@ -0,0 +1,44 @@
+import sharding
+
+BUCKET = 'seqs'
+
+
+def put(s3, shard, rel, body):
+    s3.put_object(Bucket=BUCKET, Key=shard['results'] + rel, Body=body.encode())
+
+
+def get(s3, rel):
+    return s3.get_object(Bucket=BUCKET, Key='16s/p1/results/' + rel)['Body'].read().decode()
+
+
+def test_merge_results(s3):
+    shards = [sharding.shard_prefixes('16s', 'p1', i) for i in range(2)]
+    # per-sample table, same header in both shards
+    put(s3, shards[0], 'multiqc/multiqc_general_stats.txt', 'Sample\treads\nA\t10\n')
+    put(s3, shards[1], 'multiqc/multiqc_general_stats.txt', 'Sample\treads\nB\t20\n')
+    # per-feature table, one column per sample
+    put(s3, shards[0], 'asv/feature-table.tsv', '# Constructed from biom file\n#OTU ID\tA\nasv1\t5\nasv2\t1\n')
+    put(s3, shards[1], 'asv/feature-table.tsv', '# Constructed from biom file\n#OTU ID\tB\nasv1\t7\nasv3\t2\n')
+    put(s3, shards[0], 'multiqc/multiqc_report.html', '<html>0</html>')
+    put(s3, shards[1], 'multiqc/multiqc_report.html', '<html>1</html>')
+    put(s3, shards[1], 'samples/B/stats.txt', 'only shard 1')
+
+    assert sharding.merge_results(s3, BUCKET, 'p1', shards) == 5
+
+    assert get(s3, 'multiqc/multiqc_general_stats.txt') == 'Sample\treads\nA\t10\nB\t20\n'
+    assert get(s3, 'asv/feature-table.tsv') == ('# Constructed from biom file\n#OTU ID\tA\tB\n'
+                                                'asv1\t5\t7\nasv2\t1\t0\nasv3\t0\t2\n')
+    assert get(s3, 'samples/B/stats.txt') == 'only shard 1'
+    assert get(s3, 'shard0/multiqc/multiqc_report.html') == '<html>0</html>'
+    assert get(s3, 'shard1/multiqc/multiqc_report.html') == '<html>1</html>'
+
+
+def test_tables_that_do_not_line_up_are_kept_per_shard(s3):
+    shards = [sharding.shard_prefixes('16s', 'p1', i) for i in range(2)]
+    put(s3, shards[0], 'summary.csv', 'sample,reads\nA,10\n')
+    put(s3, shards[1], 'summary.csv', 'feature,B\nasv1,3\n')
+
+    sharding.merge_results(s3, BUCKET, 'p1', shards)
+
+    assert get(s3, 'shard0/summary.csv') == 'sample,reads\nA,10\n'
+    assert get(s3, 'shard1/summary.csv') == 'feature,B\nasv1,3\n'
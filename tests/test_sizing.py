@@ -0,0 +1,35 @@
+import gzip
+import os
+
+import sizing
+import upload_engine
+
+BUCKET = 'seqs'
+
+
+def fastq(n):
+    return b''.join(b'@r%d\nACGTACGTACGTAGCTAGCTAGGATCGATCGA\n+\nIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIII\n' % i for i in range(n))
+
+
+def test_local_plain_fastq_sized_as_uploaded(tmp_path):
+    data = fastq(20000)
+    (tmp_path / 'a_R1.fastq').write_bytes(data)
+    (tmp_path / 'b_R1.fastq.gz').write_bytes(gzip.compress(data))
+    # the gzipped copy is the one uploaded
+    (tmp_path / 'b_R1.fastq').write_bytes(data)
+    total, samples = sizing.local_input(str(tmp_path))
+    assert samples == 2
+    assert total == int(len(data) * sizing.GZIP_RATIO) + len(gzip.compress(data))
+
+
+def test_local_and_s3_input_choose_the_same_row(s3, tmp_path):
+    data = fastq(20000)
+    (tmp_path / 's1_R1.fastq').write_bytes(data)
+    upload_engine.upload_directory(s3, str(tmp_path), BUCKET, '16s', 'p1')
+    # the small row fits the gzipped size, not the plain one
+    table = [{'type': 'small', 'vcpus': 2, 'memory_gb': 4, 'max_gb': len(data) * 0.5 / sizing.GB, 'max_samples': None},
+             {'type': 'large', 'vcpus': 8, 'memory_gb': 16, 'max_gb': None, 'max_samples': None}]
+    local  = sizing.local_input(str(tmp_path))
+    remote = sizing.s3_input(s3, BUCKET, '16s', 'p1')
+    assert sizing.choose_row(table, *local)['type'] == 'small'
+    assert sizing.choose_row(table, *remote)['type'] == 'small'
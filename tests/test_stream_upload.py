@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+import stream_upload
+
+MB = 1024 * 1024
+BUCKET = 'seqs'
+
+
+def test_iter_parts_groups_chunks():
+    parts = list(stream_upload.iter_parts([b'a' * 3, b'b' * 4, b'c' * 2], part_size=4))
+    assert parts == [b'aaab', b'bbbc', b'c']
+
+
+def test_multipart_from_chunks_round_trip(s3):
+    data  = os.urandom(11 * MB)
+    sizes = []
+    chunks = (data[i:i + MB] for i in range(0, len(data), MB))
+    stream_upload.multipart_from_chunks(s3, BUCKET, 'k', chunks, part_size=5 * MB, callback=sizes.append)
+    assert sizes == [5 * MB, 5 * MB, MB]
+    assert s3.get_object(Bucket=BUCKET, Key='k')['Body'].read() == data
+
+
+def test_multipart_from_empty_stream(s3):
+    stream_upload.multipart_from_chunks(s3, BUCKET, 'k', iter([]))
+    assert s3.get_object(Bucket=BUCKET, Key='k')['Body'].read() == b''
+
+
+def test_multipart_aborts_when_the_source_fails(s3):
+    def chunks():
+        yield b'x' * (6 * MB)
+        raise IOError('disk gone')
+
+    with pytest.raises(IOError):
+        stream_upload.multipart_from_chunks(s3, BUCKET, 'k', chunks(), part_size=5 * MB)
+    assert s3.list_multipart_uploads(Bucket=BUCKET).get('Uploads', []) == []
+    assert 'Contents' not in s3.list_objects_v2(Bucket=BUCKET)
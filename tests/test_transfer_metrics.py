@@ -0,0 +1,33 @@
+import pytest
+from botocore.exceptions import ClientError
+
+import transfer_metrics
+
+BUCKET = 'seqs'
+
+
+@pytest.fixture
+def metrics(monkeypatch):
+    active = transfer_metrics.Metrics()
+    monkeypatch.setattr(transfer_metrics, 'active', active)
+    return active
+
+
+def test_counter_never_goes_down(metrics):
+    metrics.expect('16s/p1/backups/sample/a', 100)
+    metrics.progress('16s/p1/backups/sample/a', 60)
+    # s3transfer rolls a retried part back
+    metrics.progress('16s/p1/backups/sample/a', -40)
+    metrics.progress('16s/p1/backups/sample/a', 80)
+    text = metrics.render()
+    assert 'aws_connect_transfer_bytes_total{project="p1"} 140' in text
+    assert 'aws_connect_transfer_rollback_bytes_total{project="p1"} 40' in text
+    assert 'aws_connect_transfer_net_bytes{project="p1"} 100' in text
+
+
+def test_error_responses_are_counted(s3, metrics):
+    transfer_metrics.instrument(s3)
+    with pytest.raises(ClientError):
+        s3.head_object(Bucket=BUCKET, Key='missing')
+    s3.put_object(Bucket=BUCKET, Key='k', Body=b'x')
+    assert metrics.errors == {'HeadObject': 1}
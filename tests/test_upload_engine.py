@@ -0,0 +1,49 @@
+import gzip
+
+import upload_engine
+
+MB = 1024 * 1024
+BUCKET = 'seqs'
+
+
+def test_part_size_keeps_part_count_bounded():
+    assert upload_engine.part_size_for(10 * MB) == upload_engine.MIN_PART_SIZE
+    big = 100 * 1024 * MB
+    assert big / upload_engine.part_size_for(big) <= upload_engine.TARGET_PARTS
+
+
+def test_split_budget():
+    assert upload_engine.split_budget(2, 4, 16) == (2, 8)
+    assert upload_engine.split_budget(10, 4, 16) == (4, 4)
+    assert upload_engine.split_budget(10, 4, 2) == (4, 1)
+
+
+def test_list_sequences(tmp_path):
+    (tmp_path / 'a_R1.fastq.gz').write_bytes(b'x' * 30)
+    (tmp_path / 'b_R1.fastq').write_bytes(b'x' * 20)
+    # the gzipped copy wins over its plain file
+    (tmp_path / 'a_R1.fastq').write_bytes(b'x' * 10)
+    (tmp_path / 'notes.txt').write_bytes(b'x')
+    files = upload_engine.list_sequences(str(tmp_path))
+    assert [(name, size) for name, path, size in files] == [('a_R1.fastq.gz', 30), ('b_R1.fastq.gz', 20)]
+    assert files[1][1].endswith('b_R1.fastq')
+
+
+def test_upload_directory(s3, tmp_path):
+    (tmp_path / 'a_R1.fastq.gz').write_bytes(gzip.compress(b'@a\nACGT\n+\nIIII\n'))
+    (tmp_path / 'b_R1.fastq').write_bytes(b'@b\nACGT\n+\nIIII\n')
+    res = upload_engine.upload_directory(s3, str(tmp_path), BUCKET, '16s', 'p1', workers=2)
+    assert res['files'] == 2 and res['failed'] == []
+    for name, plain in (('a_R1.fastq.gz', b'@a\nACGT\n+\nIIII\n'), ('b_R1.fastq.gz', b'@b\nACGT\n+\nIIII\n')):
+        body = s3.get_object(Bucket=BUCKET, Key=upload_engine.sample_key('16s', 'p1', name))['Body'].read()
+        assert gzip.decompress(body) == plain
+
+
+def test_upload_directory_reports_failures(s3, tmp_path):
+    (tmp_path / 'a_R1.fastq.gz').write_bytes(b'x')
+
+    def broken(s3, bucket, key, path, size, threads):
+        raise IOError('network down')
+
+    res = upload_engine.upload_directory(s3, str(tmp_path), BUCKET, '16s', 'p1', uploader=broken)
+    assert res['files'] == 0 and res['failed'] == ['a_R1.fastq.gz']
@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+import upload_engine
+import upload_sync
+
+MB = 1024 * 1024
+BUCKET = 'seqs'
+
+
+@pytest.fixture
+def small_parts(monkeypatch):
+    # 5MB parts from 5MB up, real sizes would need gigabytes of test data
+    monkeypatch.setattr(upload_engine, 'SINGLE_PART_LIMIT', 5 * MB)
+    monkeypatch.setattr(upload_engine, 'part_size_for', lambda size: 5 * MB)
+
+
+def key(name):
+    return upload_engine.sample_key('16s', 'p1', name)
+
+
+# count upload_part calls, fail after a number of them
+def count_parts(monkeypatch, s3, fail_after=None):
+    sent = []
+    real = getattr(s3.upload_part, 'real', s3.upload_part)
+
+    def upload_part(**kwargs):
+        if fail_after is not None and len(sent) >= fail_after:
+            raise IOError('connection lost')
+        sent.append(kwargs['PartNumber'])
+        return real(**kwargs)
+
+    upload_part.real = real
+    monkeypatch.setattr(s3, 'upload_part', upload_part)
+    return sent
+
+
+def test_is_complete():
+    remote = {'size': 10, 'etag': 'e'}
+    entry  = {'size': 10, 'mtime': 5, 'etag': 'e', 'upload_id': None}
+    assert upload_sync.is_complete(entry, 10, 5, remote)
+    assert not upload_sync.is_complete(entry, 10, 6, remote)
+    assert not upload_sync.is_complete(entry, 10, 5, None)
+    assert not upload_sync.is_complete(dict(entry, upload_id='u'), 10, 5, remote)
+    # no manifest entry, the size decides, except for compressed uploads
+    assert upload_sync.is_complete(None, 10, 5, remote)
+    assert not upload_sync.is_complete(None, 10, 5, remote, compressed=True)
+    assert upload_sync.is_complete(entry, 10, 5, {'size': 4, 'etag': 'e'}, compressed=True)
+
+
+def test_interrupted_upload_resumes_missing_parts(s3, tmp_path, monkeypatch, small_parts):
+    data = os.urandom(23 * MB)
+    (tmp_path / 's1_R1.fastq.gz').write_bytes(data)
+
+    count_parts(monkeypatch, s3, fail_after=2)
+    res = upload_sync.sync_directory(s3, str(tmp_path), BUCKET, '16s', 'p1', workers=1, max_concurrency=1)
+    assert res['failed'] == ['s1_R1.fastq.gz']
+    entry = upload_sync.UploadManifest(str(tmp_path), BUCKET, key('')).get('s1_R1.fastq.gz')
+    assert entry['upload_id'] and sorted(entry['parts']) == ['1', '2']
+
+    sent = count_parts(monkeypatch, s3)
+    res  = upload_sync.sync_directory(s3, str(tmp_path), BUCKET, '16s', 'p1', workers=1, max_concurrency=1)
+    assert res['failed'] == []
+    assert sorted(sent) == [3, 4, 5]
+    assert s3.get_object(Bucket=BUCKET, Key=key('s1_R1.fastq.gz'))['Body'].read() == data
+    assert s3.list_multipart_uploads(Bucket=BUCKET).get('Uploads', []) == []
+
+
+def test_second_sync_skips_complete_files(s3, tmp_path, monkeypatch, small_parts):
+    (tmp_path / 'a_R1.fastq.gz').write_bytes(os.urandom(6 * MB))
+    (tmp_path / 'b_R1.fastq.gz').write_bytes(b'small')
+    (tmp_path / 'c_R1.fastq').write_bytes(b'@c\nACGT\n+\nIIII\n')
+    assert upload_sync.sync_directory(s3, str(tmp_path), BUCKET, '16s', 'p1')['files'] == 3
+
+    sent = count_parts(monkeypatch, s3)
+    res  = upload_sync.sync_directory(s3, str(tmp_path), BUCKET, '16s', 'p1')
+    assert res['files'] == 0 and sent == []
+
+    # a touched file goes again, the others stay skipped
+    os.utime(tmp_path / 'b_R1.fastq.gz', (1, 1))
+    res = upload_sync.sync_directory(s3, str(tmp_path), BUCKET, '16s', 'p1')
+    assert res['files'] == 1
@@ -0,0 +1,142 @@
+import time
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+import url_stream
+
+BUCKET = 'seqs'
+
+
+# file server counting the requests it serves at the same time
+class Server:
+    def __init__(self, files, delay=0.0, short=()):
+        self.files   = files
+        self.delay   = delay
+        self.short   = set(short)
+        self.lock    = threading.Lock()
+        self.active  = 0
+        self.peak    = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                name = self.path.lstrip('/')
+                body = server.files[name]
+                with server.lock:
+                    server.active += 1
+                    server.peak = max(server.peak, server.active)
+                try:
+                    time.sleep(server.delay)
+                    self.send_response(200)
+                    # announce the whole body, send half of it and hang up
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body[:len(body) // 2] if name in server.short else body)
+                    self.close_connection = True
+                finally:
+                    with server.lock:
+                        server.active -= 1
+
+        self.httpd  = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def url(self, name):
+        return 'http://127.0.0.1:' + str(self.httpd.server_address[1]) + '/' + name
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def fileseqs(tmp_path, lines):
+    path = tmp_path / 'fileseqs.txt'
+    path.write_text('\n'.join(lines) + '\n')
+    return str(path)
+
+
+def keys(s3):
+    return [o['Key'] for o in s3.list_objects_v2(Bucket=BUCKET).get('Contents', [])]
+
+
+def open_uploads(s3):
+    return s3.list_multipart_uploads(Bucket=BUCKET).get('Uploads', [])
+
+
+def test_per_host_cap(s3, tmp_path):
+    a = Server({'a%d.fastq.gz' % i: b'ACGT' * 1000 for i in range(6)}, delay=0.3)
+    b = Server({'b%d.fastq.gz' % i: b'ACGT' * 1000 for i in range(3)}, delay=0.3)
+    try:
+        lines = [a.url(n) for n in sorted(a.files)] + [b.url(n) for n in sorted(b.files)]
+        ok = url_stream.stream_fileseqs(s3, fileseqs(tmp_path, lines), BUCKET, '16s', 'p1',
+                                        concurrency=8, per_host=2)
+    finally:
+        a.stop()
+        b.stop()
+    assert ok
+    assert a.peak == 2
+    assert b.peak == 2
+    assert len(keys(s3)) == 9
+
+
+def test_md5_mismatch_aborts(s3, tmp_path):
+    body = b'ACGT' * 1000
+    srv  = Server({'s1.fastq.gz': body})
+    try:
+        ok = url_stream.stream_fileseqs(s3, fileseqs(tmp_path, [srv.url('s1.fastq.gz') + ' ' + '0' * 32]),
+                                        BUCKET, '16s', 'p1')
+    finally:
+        srv.stop()
+    assert not ok
+    assert keys(s3) == []
+    assert open_uploads(s3) == []
+
+
+def test_md5_match_is_stored(s3, tmp_path):
+    body = b'ACGT' * 1000
+    srv  = Server({'s1.fastq.gz': body})
+    try:
+        ok = url_stream.stream_fileseqs(s3, fileseqs(tmp_path, [srv.url('s1.fastq.gz') + ' ' + hashlib.md5(body).hexdigest()]),
+                                        BUCKET, '16s', 'p1')
+    finally:
+        srv.stop()
+    assert ok
+    key = url_stream.url_key('16s', 'p1', srv.url('s1.fastq.gz'))
+    assert s3.get_object(Bucket=BUCKET, Key=key)['Body'].read() == body
+
+
+def test_short_read_aborts(s3, tmp_path):
+    srv = Server({'s1.fastq.gz': b'ACGT' * 1000}, short=['s1.fastq.gz'])
+    try:
+        ok = url_stream.stream_fileseqs(s3, fileseqs(tmp_path, [srv.url('s1.fastq.gz')]), BUCKET, '16s', 'p1')
+    finally:
+        srv.stop()
+    assert not ok
+    assert keys(s3) == []
+    assert open_uploads(s3) == []
+
+
+def test_unreachable_url_leaves_no_upload(s3, tmp_path):
+    srv = Server({})
+    url = srv.url('s1.fastq.gz')
+    srv.stop()
+    ok = url_stream.stream_fileseqs(s3, fileseqs(tmp_path, [url]), BUCKET, '16s', 'p1')
+    assert not ok
+    assert open_uploads(s3) == []
+
+
+def test_duplicate_names_refused(s3, tmp_path):
+    srv = Server({'s1.fastq.gz': b'ACGT'})
+    try:
+        lines = [srv.url('s1.fastq.gz'), srv.url('s1.fastq.gz').replace('/s1', '/run2/s1')]
+        ok = url_stream.stream_fileseqs(s3, fileseqs(tmp_path, lines), BUCKET, '16s', 'p1')
+    finally:
+        srv.stop()
+    assert not ok
+    assert srv.peak == 0
+    assert keys(s3) == []